@@ -1,12 +1,14 @@
 import os
 from functools import wraps
-from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, send_file, make_response
+from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, send_file, make_response, Response, stream_with_context
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from flask_wtf.csrf import CSRFProtect
 from flask_migrate import Migrate
 from werkzeug.security import generate_password_hash, check_password_hash
+import csv
 import hashlib
 import hmac
+import json
 
 # Python 3.9 compatibility: Custom password check function that avoids scrypt
 def safe_check_password_hash(pwhash, password):
@@ -29,17 +31,41 @@ def safe_check_password_hash(pwhash, password):
 from werkzeug.utils import secure_filename
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from sqlalchemy import event as sqlalchemy_event
+from sqlalchemy.engine import Engine
 from database import db
-from models import User, Company, Contact, Deal, Task, Activity, Quote, QuoteItem, Invoice, InvoiceItem, OrgProfile, Team, LoginAttempt, SecurityLog, Email2FACode, GoogleCalendarConnection, PasswordResetToken
+from models import User, Company, CompanyTag, Contact, Deal, DealStageTransition, PipelineSnapshot, BackgroundJob, Task, Activity, Quote, QuoteItem, Invoice, InvoiceItem, OrgProfile, Team, LoginAttempt, SecurityLog, Email2FACode, GoogleCalendarConnection, PasswordResetToken
 from utils.export_utils import (
     export_companies_to_csv, export_companies_to_excel,
     export_deals_to_csv, export_deals_to_excel,
     export_activities_to_csv, export_activities_to_excel
 )
-from utils.import_utils import (
-    parse_csv_file, parse_excel_file,
-    validate_company_row, validate_deal_row
+from utils.pagination import keyset_paginate, parse_per_page
+from utils.jobs import (
+    create_job, submit_job, register_job_handler, artifact_path, job_to_dict,
+    resume_stalled_jobs, fail_stalled_jobs
 )
+from utils.cache import TTLCache, DataVersions, make_cache_key, clear_on_commit, bump_on_commit
+from utils.date_range import date_range_condition, month_range
+from utils.search_index import (
+    register_search_index_events, ensure_search_index,
+    search_condition, ranked_search, prefix_condition, prefix_sort_column
+)
+from utils.deal_metrics import (
+    register_deal_metrics_events, ensure_deal_metrics, deal_metrics, month_expr, move_team_metrics
+)
+from utils.analytics_cube import (
+    CubeError, query_cube, run_cube, summarize, label_dimensions, parse_filters as parse_cube_filters
+)
+from utils.pipeline_snapshots import (
+    ensure_pipeline_snapshot, start_pipeline_snapshot_scheduler, pipeline_snapshot_total, pipeline_trend
+)
+from utils.company_tags import ensure_company_tags
+from utils.stage_history import (
+    record_new_deal, record_deal_changes, ensure_stage_transitions, stage_funnel
+)
+from utils.import_utils import read_import_rows, peek_rows
+from utils.bulk_import import import_company_rows, import_deal_rows, is_warning_message, IMPORT_CHUNK_ROWS
 from utils.security import (
     validate_password_strength, log_login_attempt, check_login_attempts,
     log_security_event, generate_2fa_secret, get_2fa_provisioning_uri,
@@ -167,8 +193,22 @@ else:
         'echo': False
     }
 
+
+def _set_sqlite_wal_mode(dbapi_connection, connection_record):
+    """SQLiteをWALモードにする（エクスポートなど長い読み取りの間も書き込みがブロックされない）"""
+    import sqlite3
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.close()
+
+
+sqlalchemy_event.listen(Engine, 'connect', _set_sqlite_wal_mode)
+
 db.init_app(app)
 migrate = Migrate(app, db)
+register_search_index_events()
+register_deal_metrics_events()
 csrf = CSRFProtect(app)
 
 login_manager = LoginManager()
@@ -176,6 +216,31 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.session_protection = 'basic'  # セッション保護を基本レベルに
 
+# 既存テーブルに後から追加したインデックス（create_allは既存テーブルにインデックスを作成しないため）
+ADDED_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS ix_deals_created_at ON deals(created_at)',
+    'CREATE INDEX IF NOT EXISTS ix_deals_status_closed_at ON deals(status, closed_at)',
+    'CREATE INDEX IF NOT EXISTS ix_deals_status_stage_entered_at ON deals(status, stage_entered_at)',
+]
+
+# 既存テーブルに後から追加したカラム（create_allは既存テーブルにカラムを追加しないため）
+ADDED_COLUMNS = [
+    ('background_jobs', 'succeeded', 'INTEGER NOT NULL DEFAULT 0'),
+    ('background_jobs', 'failed', 'INTEGER NOT NULL DEFAULT 0'),
+    ('background_jobs', 'checkpoint_row', 'INTEGER'),
+    ('background_jobs', 'heartbeat_at', 'TIMESTAMP'),
+    ('background_jobs', 'claimed_by', 'VARCHAR(32)'),
+    ('background_jobs', 'attempts', 'INTEGER NOT NULL DEFAULT 0'),
+]
+
+def add_missing_columns():
+    """ADDED_COLUMNS のうち既存テーブルに無いカラムを追加"""
+    inspector = db.inspect(db.engine)
+    for table, column, ddl in ADDED_COLUMNS:
+        if column not in {c['name'] for c in inspector.get_columns(table)}:
+            db.session.execute(db.text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+    db.session.commit()
+
 # アプリケーション初期化時にデータベースマイグレーションを実行
 def init_db():
     """データベースの初期化とマイグレーション"""
@@ -249,7 +314,8 @@ def init_db():
                     CREATE INDEX IF NOT EXISTS ix_activities_company_id ON activities(company_id);
                     CREATE INDEX IF NOT EXISTS ix_activities_happened_at ON activities(happened_at);
                     CREATE INDEX IF NOT EXISTS ix_activities_company_happened ON activities(company_id, happened_at);
-                    """
+                    """,
+                    ';\n'.join(ADDED_INDEXES)
                 ]
                 for i, migration in enumerate(migrations, 1):
                     try:
@@ -259,9 +325,14 @@ def init_db():
                     except Exception as e:
                         print(f"Note: Migration {i} - {e}")
                         db.session.rollback()
+                add_missing_columns()
             else:
                 print("Running SQLite migration...")
                 db.create_all()
+                for statement in ADDED_INDEXES:
+                    db.session.execute(db.text(statement))
+                db.session.commit()
+                add_missing_columns()
                 print("✓ Tables created/updated")
         except Exception as e:
             # データベースが存在しない場合は新規作成
@@ -336,11 +407,68 @@ def init_db():
         except Exception as e:
             print(f"⚠️ マスターデータの初期化中にエラー: {e}")
             db.session.rollback()
+        
+        # 検索インデックス（PostgreSQL: pg_trgm / SQLite: FTS5）の作成
+        try:
+            ensure_search_index()
+            print("✓ 検索インデックスを確認しました")
+        except Exception as e:
+            print(f"⚠️ 検索インデックスの作成中にエラー: {e}")
+        
+        # 案件の月次集計テーブル（導入直後は案件テーブルから作成）
+        try:
+            ensure_deal_metrics()
+            print("✓ 案件の月次集計を確認しました")
+        except Exception as e:
+            print(f"⚠️ 案件の月次集計の作成中にエラー: {e}")
+        
+        # 企業タグの正規化テーブル（導入直後は companies.tags から作成）
+        try:
+            ensure_company_tags()
+            print("✓ 企業タグを確認しました")
+        except Exception as e:
+            print(f"⚠️ 企業タグの作成中にエラー: {e}")
+        
+        # ステージ遷移履歴（導入直後は案件の現在の状態から作成）
+        try:
+            ensure_stage_transitions()
+            print("✓ ステージ遷移履歴を確認しました")
+        except Exception as e:
+            print(f"⚠️ ステージ遷移履歴の作成中にエラー: {e}")
 
 # アプリケーション起動時にマイグレーションを実行
 init_db()
 
 
+def start_background_services():
+    """
+    Webサーバーのプロセスでだけ動かすバックグラウンド処理を開始
+    
+    gunicorn.conf.py のワーカー起動フックと `python app.py` から呼ぶ。
+    app を import するだけのメンテナンス用スクリプトでは動かさない。
+    """
+    # パイプラインの日次スナップショットを記録するジョブ（ENABLE_PIPELINE_SNAPSHOTS=False で無効化）
+    if os.environ.get('ENABLE_PIPELINE_SNAPSHOTS', 'True').lower() == 'true':
+        # 今日のスナップショットが無ければ記録（初回起動・ジョブ未実行）
+        try:
+            with app.app_context():
+                ensure_pipeline_snapshot()
+        except Exception as e:
+            print(f"⚠️ パイプラインのスナップショットの記録中にエラー: {e}")
+        try:
+            start_pipeline_snapshot_scheduler(app)
+        except Exception as e:
+            print(f"⚠️ パイプラインのスナップショットのジョブを開始できませんでした: {e}")
+    
+    # 中断したインポートのジョブをチェックポイントから再開（RESUME_IMPORT_JOBS=False で無効化）
+    if os.environ.get('RESUME_IMPORT_JOBS', 'True').lower() == 'true':
+        try:
+            with app.app_context():
+                resume_stalled_jobs(app)
+        except Exception as e:
+            print(f"⚠️ 中断したインポートのジョブを再開できませんでした: {e}")
+
+
 def has_role(user, *roles):
     return user.is_authenticated and user.role in roles
 
@@ -443,6 +571,24 @@ def apply_scope_to_query(query, user, view_scope):
         )
     return query
 
+
+def snapshot_scope_conditions(user, view_scope):
+    """apply_scope_to_query と同じ表示範囲をパイプラインのスナップショットに適用する条件"""
+    if view_scope == 'personal':
+        return [PipelineSnapshot.assignee_id == user.id]
+    if view_scope == 'team' and user.team_id:
+        return [db.or_(PipelineSnapshot.team_id == user.team_id, PipelineSnapshot.team_id.is_(None))]
+    return []
+
+
+def view_scope_owner(user, view_scope):
+    """表示範囲の対象（personal: ユーザーID / team: チームID）を返す（キャッシュキー用）"""
+    if view_scope == 'personal':
+        return user.id
+    if view_scope == 'team':
+        return user.team_id
+    return None
+
 @login_manager.unauthorized_handler
 def unauthorized():
     """Handle unauthorized access - clear session and redirect to login"""
@@ -964,42 +1110,103 @@ def analytics():
     """Cross-tabulation analytics page"""
     return render_template('analytics.html')
 
-@app.route('/companies')
-@login_required
-def companies():
-    from datetime import datetime, date, timedelta
-    
-    # 基本検索
-    search = request.args.get('search', '')
-    
-    # 高度なフィルタ
-    industry_filter = request.args.get('industry', '')
-    heat_score_filter = request.args.get('heat_score', '')
-    employee_min = request.args.get('employee_min', '')
-    employee_max = request.args.get('employee_max', '')
-    last_contact_filter = request.args.get('last_contact', '')
-    tag_filter = request.args.get('tag', '')
-    
-    # ソート機能
-    sort_by = request.args.get('sort_by', 'name')  # デフォルト: 企業名
-    sort_order = request.args.get('sort_order', 'asc')  # デフォルト: 昇順（あいうえお順）
-    
-    query = Company.query
-    
+# 最終接触日フィルタ → 該当する接触日区分（last_contact_bucket）
+LAST_CONTACT_FILTERS = {
+    '30days': ('30days', 'never'),
+    '60days': ('30days', '60days', 'never'),
+    '90days': ('30days', '60days', '90days', 'never'),
+    'over90days': ('over90days',),
+    'never': ('never',),
+}
+
+
+def last_contact_bucket(today=None):
+    """最終接触日を区分（30days/60days/90days/over90days/never）に分けるSQL式"""
+    from datetime import date, timedelta
+    today = today or date.today()
+    return db.case(
+        (Company.last_contacted_at.is_(None), 'never'),
+        (Company.last_contacted_at >= today - timedelta(days=30), '30days'),
+        (Company.last_contacted_at >= today - timedelta(days=60), '60days'),
+        (Company.last_contacted_at >= today - timedelta(days=90), '90days'),
+        else_='over90days'
+    )
+
+
+def last_contact_condition(last_contact_filter, today=None):
+    """最終接触日フィルタのWHERE条件（「N日以内」には未接触の企業も含む）"""
+    from datetime import date, timedelta
+    today = today or date.today()
+    within_days = {'30days': 30, '60days': 60, '90days': 90}
+    if last_contact_filter in within_days:
+        cutoff_date = today - timedelta(days=within_days[last_contact_filter])
+        return db.or_(
+            Company.last_contacted_at >= cutoff_date,
+            Company.last_contacted_at.is_(None)
+        )
+    if last_contact_filter == 'over90days':
+        return db.and_(
+            Company.last_contacted_at < today - timedelta(days=90),
+            Company.last_contacted_at.isnot(None)
+        )
+    return Company.last_contacted_at.is_(None)
+
+
+# 絞り込みパネルの件数（ファセット）キャッシュ：同じ条件での連続表示・戻る操作向けに短時間だけ保持
+FACET_CACHE_TTL = 30
+facet_cache = TTLCache(ttl=FACET_CACHE_TTL)
+
+# 件数集計に影響しない一覧画面のパラメータ
+NON_FILTER_ARGS = ('sort_by', 'sort_order', 'cursor', 'per_page')
+
+
+def count_facets(rows, facets, selected):
+    """
+    GROUP BY 結果からファセットごとの件数を集計
+
+    各ファセットの件数は「そのファセット以外の選択中フィルタ」を満たす行で数えるため、
+    選択中の値以外の選択肢に切り替えた場合の件数がそのまま表示できる。
+
+    Args:
+        rows: (ファセット値..., 件数) のタプル列
+        facets: [(ファセット名, 行内の位置, 値→該当する選択肢のリストを返す関数 or None)]
+        selected: {ファセット名: 選択中の値}（未選択は None）
+
+    Returns:
+        tuple: (全フィルタ適用後の件数, {ファセット名: {選択肢: 件数}})
+    """
+    total = 0
+    counts = {name: {} for name, _, _ in facets}
+    for row in rows:
+        row_count = row[-1]
+        options = {}
+        matches = {}
+        for name, index, expand in facets:
+            value = row[index]
+            options[name] = expand(value) if expand else ([] if value is None else [str(value)])
+            matches[name] = selected.get(name) is None or selected[name] in options[name]
+        if all(matches.values()):
+            total += row_count
+        for name, _, _ in facets:
+            if all(match for other, match in matches.items() if other != name):
+                for option in options[name]:
+                    counts[name][option] = counts[name].get(option, 0) + row_count
+    return total, counts
+
+
+def apply_company_filters(query, args):
+    """企業一覧・エクスポート共通の検索/フィルタ条件を適用"""
     # 基本検索
+    search = args.get('search', '')
     if search:
-        query = query.filter(
-            db.or_(
-                Company.name.ilike(f'%{search}%'),
-                Company.industry.ilike(f'%{search}%'),
-                Company.location.ilike(f'%{search}%')
-            )
-        )
+        query = query.filter(search_condition('companies', search))
     
     # 高度なフィルタ
+    industry_filter = args.get('industry', '')
     if industry_filter:
         query = query.filter(Company.industry == industry_filter)
     
+    heat_score_filter = args.get('heat_score', '')
     if heat_score_filter:
         try:
             heat_score = int(heat_score_filter)
@@ -1008,89 +1215,102 @@ def companies():
         except ValueError:
             pass
     
+    employee_min = args.get('employee_min', '')
     if employee_min:
         try:
             query = query.filter(Company.employee_size >= int(employee_min))
         except ValueError:
             pass
     
+    employee_max = args.get('employee_max', '')
     if employee_max:
         try:
             query = query.filter(Company.employee_size <= int(employee_max))
         except ValueError:
             pass
     
-    if last_contact_filter:
-        today = date.today()
-        if last_contact_filter == '30days':
-            cutoff_date = today - timedelta(days=30)
-            query = query.filter(
-                db.or_(
-                    Company.last_contacted_at >= cutoff_date,
-                    Company.last_contacted_at.is_(None)
-                )
-            )
-        elif last_contact_filter == '60days':
-            cutoff_date = today - timedelta(days=60)
-            query = query.filter(
-                db.or_(
-                    Company.last_contacted_at >= cutoff_date,
-                    Company.last_contacted_at.is_(None)
-                )
-            )
-        elif last_contact_filter == '90days':
-            cutoff_date = today - timedelta(days=90)
-            query = query.filter(
-                db.or_(
-                    Company.last_contacted_at >= cutoff_date,
-                    Company.last_contacted_at.is_(None)
-                )
-            )
-        elif last_contact_filter == 'over90days':
-            cutoff_date = today - timedelta(days=90)
-            query = query.filter(
-                db.and_(
-                    Company.last_contacted_at < cutoff_date,
-                    Company.last_contacted_at.isnot(None)
-                )
-            )
-        elif last_contact_filter == 'never':
-            query = query.filter(Company.last_contacted_at.is_(None))
+    last_contact_filter = args.get('last_contact', '')
+    if last_contact_filter in LAST_CONTACT_FILTERS:
+        query = query.filter(last_contact_condition(last_contact_filter))
     
+    tag_filter = args.get('tag', '').strip()
     if tag_filter:
-        # タグで検索（カンマ区切りのタグ文字列から検索）
-        query = query.filter(Company.tags.ilike(f'%{tag_filter}%'))
+        # タグで検索（company_tagsの (tag, company_id) インデックスで完全一致）
+        query = query.filter(Company.id.in_(
+            db.select(CompanyTag.company_id).where(CompanyTag.tag == tag_filter)
+        ))
+    
+    return query
+
+@app.route('/companies')
+@login_required
+def companies():
+    # 基本検索
+    search = request.args.get('search', '')
+    
+    # 高度なフィルタ
+    industry_filter = request.args.get('industry', '')
+    heat_score_filter = request.args.get('heat_score', '')
+    employee_min = request.args.get('employee_min', '')
+    employee_max = request.args.get('employee_max', '')
+    last_contact_filter = request.args.get('last_contact', '')
+    tag_filter = request.args.get('tag', '')
+    
+    # ソート機能
+    sort_by = request.args.get('sort_by', 'name')  # デフォルト: 企業名
+    sort_order = request.args.get('sort_order', 'asc')  # デフォルト: 昇順（あいうえお順）
+    
+    # ページネーション（キーセット方式）
+    cursor = request.args.get('cursor', '')
+    per_page = parse_per_page(request.args.get('per_page'))
+    
+    query = apply_company_filters(Company.query, request.args)
     
     # ソート処理
-    sort_column = None
-    if sort_by == 'name':
-        sort_column = Company.name
-    elif sort_by == 'last_contact':
+    nullable = False
+    if sort_by == 'last_contact':
         sort_column = Company.last_contacted_at
+        nullable = True
     elif sort_by == 'heat_score':
         sort_column = Company.heat_score
+        nullable = True
     elif sort_by == 'deal_count':
-        # 案件数でソート（関連テーブルをカウント）
-        # 計算が必要なため、一旦ソートはスキップ（後でPythonでソート）
-        pass
-    
-    if sort_column:
-        if sort_order == 'desc':
-            query = query.order_by(sort_column.desc())
-        else:
-            query = query.order_by(sort_column.asc())
+        # 案件数でソート（企業ごとの件数を集計したサブクエリをJOIN）
+        deal_counts = db.session.query(
+            Deal.company_id.label('company_id'),
+            db.func.count(Deal.id).label('deal_count')
+        ).group_by(Deal.company_id).subquery()
+        query = query.outerjoin(deal_counts, deal_counts.c.company_id == Company.id)
+        sort_column = db.func.coalesce(deal_counts.c.deal_count, 0)
     else:
-        # デフォルトソート（企業名昇順）
-        query = query.order_by(Company.name.asc())
+        # デフォルトソート（企業名）
+        sort_by = 'name'
+        sort_column = Company.name
     
-    companies_list = query.all()
+    companies_list, next_cursor = keyset_paginate(
+        query, sort_column, Company.id,
+        sort_key=f'{sort_by}:{sort_order}',
+        cursor=cursor,
+        per_page=per_page,
+        descending=(sort_order == 'desc'),
+        nullable=nullable
+    )
     
-    # 案件数でソートする場合（Pythonでソート）
-    if sort_by == 'deal_count':
-        companies_list.sort(
-            key=lambda c: len(c.deals) if hasattr(c, 'deals') else 0,
-            reverse=(sort_order == 'desc')
-        )
+    # ページ移動時に引き継ぐ検索・フィルタ・ソート条件
+    filter_args = {
+        key: value for key, value in {
+            'search': search,
+            'industry': industry_filter,
+            'heat_score': heat_score_filter,
+            'employee_min': employee_min,
+            'employee_max': employee_max,
+            'last_contact': last_contact_filter,
+            'tag': tag_filter,
+            'sort_by': sort_by,
+            'sort_order': sort_order,
+            'per_page': request.args.get('per_page', ''),
+        }.items() if value
+    }
     
     return render_template('companies.html', 
                          companies=companies_list, 
@@ -1103,123 +1323,513 @@ def companies():
                          tag_filter=tag_filter,
                          sort_by=sort_by,
                          sort_order=sort_order,
+                         cursor=cursor,
+                         next_cursor=next_cursor,
+                         filter_args=filter_args,
                          industries=INDUSTRY_CATEGORIES)
 
-@app.route('/companies/export')
+@app.route('/api/companies/tags')
 @login_required
-def export_companies():
-    """企業データをCSV/Excelでエクスポート"""
-    guard = ensure_import_export_permission('companies')
-    if guard:
-        return guard
-    format_type = request.args.get('format', 'csv')  # csv or excel
+def api_company_tag_facets():
+    """タグごとの企業数（現在の検索・フィルタ条件を適用、1回のGROUP BYで集計）"""
+    query = db.session.query(
+        CompanyTag.tag,
+        db.func.count(CompanyTag.company_id).label('count')
+    ).join(Company, Company.id == CompanyTag.company_id)
+    query = apply_company_filters(query, request.args)
     
-    # 現在のフィルタ条件を適用（companies()と同じロジック）
-    from datetime import datetime, date, timedelta
+    limit = max(1, min(request.args.get('limit', 100, type=int), 500))
+    results = query.group_by(CompanyTag.tag).order_by(
+        db.desc('count'), CompanyTag.tag
+    ).limit(limit).all()
     
-    search = request.args.get('search', '')
-    industry_filter = request.args.get('industry', '')
-    heat_score_filter = request.args.get('heat_score', '')
-    employee_min = request.args.get('employee_min', '')
-    employee_max = request.args.get('employee_max', '')
-    last_contact_filter = request.args.get('last_contact', '')
-    tag_filter = request.args.get('tag', '')
+    return jsonify({'data': [{'tag': tag, 'count': count} for tag, count in results]})
+
+@app.route('/api/companies/facets')
+@login_required
+def api_company_facets():
+    """
+    企業の絞り込みパネル用の件数（業界・温度感・最終接触日）
     
-    query = Company.query
+    業界×温度感×接触日区分の1回のGROUP BYで集計し、フィルタ条件ごとに短時間キャッシュする。
+    """
+    facet_keys = ('industry', 'heat_score', 'last_contact')
+    base_args = {
+        key: value for key, value in request.args.items()
+        if key not in facet_keys and key not in NON_FILTER_ARGS
+    }
+    selected = {
+        'industry': request.args.get('industry') or None,
+        'heat_score': request.args.get('heat_score') if request.args.get('heat_score') in ('1', '2', '3', '4', '5') else None,
+        'last_contact': request.args.get('last_contact') if request.args.get('last_contact') in LAST_CONTACT_FILTERS else None,
+    }
+    cache_key = make_cache_key('company_facets', **base_args, **selected)
     
-    # 基本検索
-    if search:
-        query = query.filter(
-            db.or_(
-                Company.name.ilike(f'%{search}%'),
-                Company.industry.ilike(f'%{search}%'),
-                Company.location.ilike(f'%{search}%')
-            )
+    def compute():
+        bucket = last_contact_bucket()
+        query = db.session.query(
+            Company.industry,
+            Company.heat_score,
+            bucket.label('last_contact_bucket'),
+            db.func.count(Company.id)
         )
+        rows = apply_company_filters(query, base_args).group_by(
+            Company.industry, Company.heat_score, bucket
+        ).all()
+        
+        # 接触日区分 → その区分を含む最終接触日フィルタ（「N日以内」は未接触も含む）
+        bucket_filters = {
+            bucket_name: [key for key, buckets in LAST_CONTACT_FILTERS.items() if bucket_name in buckets]
+            for bucket_name in ('30days', '60days', '90days', 'over90days', 'never')
+        }
+        total, counts = count_facets(rows, [
+            ('industry', 0, None),
+            ('heat_score', 1, None),
+            ('last_contact', 2, bucket_filters.get),
+        ], selected)
+        return {'total': total, 'facets': counts}
     
-    # 高度なフィルタ
-    if industry_filter:
-        query = query.filter(Company.industry == industry_filter)
+    return jsonify(facet_cache.get_or_set(cache_key, compute))
+
+def lookup_candidates(table_name, query, contains_condition):
+    """
+    選択フォームの候補検索（名前の前方一致、名前順にキーセット方式でページング）
     
-    if heat_score_filter:
+    1ページ目で前方一致の候補が足りない場合は部分一致の候補で補う
+    （「株式会社」などの接頭辞を省いて入力した場合向け）。
+    """
+    from sqlalchemy.orm import load_only
+    
+    model = query.column_descriptions[0]['entity']
+    q = request.args.get('q', '').strip()
+    cursor = request.args.get('cursor', '')
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    
+    query = query.options(load_only(model.id, model.name))
+    prefix_query = query.filter(prefix_condition(table_name, q)) if q else query
+    items, next_cursor = keyset_paginate(
+        prefix_query, prefix_sort_column(table_name), model.id,
+        sort_key=f'lookup:{q}', cursor=cursor, per_page=limit
+    )
+    
+    if q and not cursor and next_cursor is None and len(items) < limit:
+        items += query.filter(
+            contains_condition(q),
+            model.id.notin_([item.id for item in items])
+        ).order_by(model.name, model.id).limit(limit - len(items)).all()
+    
+    return jsonify({
+        'data': [{'id': item.id, 'name': item.name} for item in items],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/companies/lookup')
+@login_required
+def api_company_lookup():
+    """企業選択フォーム用の候補検索"""
+    # 部分一致は検索インデックスで絞り込んだうえで企業名に限定する
+    return lookup_candidates('companies', Company.query, lambda q: db.and_(
+        search_condition('companies', q),
+        Company.name.ilike(f'%{q}%')
+    ))
+
+@app.route('/api/users/lookup')
+@login_required
+def api_user_lookup():
+    """担当者選択フォーム用の候補検索（team_id指定時はそのチームのユーザーのみ）"""
+    query = User.query
+    team_id = request.args.get('team_id', type=int)
+    if team_id:
+        query = query.filter(User.team_id == team_id)
+    return lookup_candidates('users', query, lambda q: User.name.ilike(f'%{q}%'))
+
+# エクスポートで1回に読み込む行数（yield_per）
+EXPORT_BATCH_SIZE = 1000
+# 推定件数がこれを超えるエクスポートはバックグラウンドのジョブとして実行する
+EXPORT_ASYNC_THRESHOLD = int(os.environ.get('EXPORT_ASYNC_THRESHOLD', '20000'))
+EXCEL_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def csv_download_response(chunks, filename):
+    """CSVのチャンクを順に送るストリーミングレスポンス（全件をメモリに載せない）"""
+    response = Response(stream_with_context(chunks), mimetype='text/csv')
+    response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
+
+def companies_export_query(args, user):
+    """企業エクスポートの対象（companies()と同じフィルタ条件）"""
+    return apply_company_filters(Company.query, args)
+
+
+def deals_export_query(args, user):
+    """案件エクスポートの対象（deals()と同じ表示範囲・フィルタ条件）"""
+    from sqlalchemy.orm import contains_eager, joinedload
+    
+    view_scope = resolve_view_scope(user, args.get('view_scope', None))
+    
+    # 企業名・担当者名は行ごとに読み込まず、同じクエリで取得する
+    query = Deal.query.join(Company).options(contains_eager(Deal.company), joinedload(Deal.assignee_user))
+    query = apply_scope_to_query(query, user, view_scope)
+    return apply_deal_filters(query, args)
+
+
+def activities_export_query(args, user):
+    """活動履歴エクスポートの対象（企業・期間・活動タイプで絞り込み）"""
+    from sqlalchemy.orm import contains_eager, joinedload
+    
+    # 企業名・ユーザー名・案件名は行ごとに読み込まず、同じクエリで取得する
+    query = Activity.query.join(Company).join(User).options(
+        contains_eager(Activity.company), contains_eager(Activity.user), joinedload(Activity.deal)
+    )
+    
+    # 企業IDでフィルタ（指定されている場合）
+    company_id = args.get('company_id', '')
+    if company_id:
         try:
-            heat_score = int(heat_score_filter)
-            if 1 <= heat_score <= 5:
-                query = query.filter(Company.heat_score == heat_score)
+            query = query.filter(Activity.company_id == int(company_id))
         except ValueError:
             pass
     
-    if employee_min:
+    # 日付範囲でフィルタ（オプション）
+    from_date = args.get('from_date', '')
+    to_date = args.get('to_date', '')
+    
+    if from_date:
         try:
-            query = query.filter(Company.employee_size >= int(employee_min))
+            from_dt = datetime.strptime(from_date, '%Y-%m-%d')
+            query = query.filter(date_range_condition(Activity.happened_at, start_date=from_dt))
         except ValueError:
             pass
     
-    if employee_max:
+    if to_date:
         try:
-            query = query.filter(Company.employee_size <= int(employee_max))
+            to_dt = datetime.strptime(to_date, '%Y-%m-%d')
+            query = query.filter(date_range_condition(Activity.happened_at, end_date=to_dt))
         except ValueError:
             pass
     
-    if last_contact_filter:
-        today = date.today()
-        if last_contact_filter == '30days':
-            cutoff_date = today - timedelta(days=30)
-            query = query.filter(
-                db.or_(
-                    Company.last_contacted_at >= cutoff_date,
-                    Company.last_contacted_at.is_(None)
-                )
-            )
-        elif last_contact_filter == '60days':
-            cutoff_date = today - timedelta(days=60)
-            query = query.filter(
-                db.or_(
-                    Company.last_contacted_at >= cutoff_date,
-                    Company.last_contacted_at.is_(None)
-                )
-            )
-        elif last_contact_filter == '90days':
-            cutoff_date = today - timedelta(days=90)
-            query = query.filter(
-                db.or_(
-                    Company.last_contacted_at >= cutoff_date,
-                    Company.last_contacted_at.is_(None)
-                )
-            )
-        elif last_contact_filter == 'over90days':
-            cutoff_date = today - timedelta(days=90)
-            query = query.filter(
-                db.and_(
-                    Company.last_contacted_at < cutoff_date,
-                    Company.last_contacted_at.isnot(None)
-                )
-            )
-        elif last_contact_filter == 'never':
-            query = query.filter(Company.last_contacted_at.is_(None))
-    
-    if tag_filter:
-        query = query.filter(Company.tags.ilike(f'%{tag_filter}%'))
-    
-    companies_list = query.all()
+    # 活動タイプでフィルタ（オプション）
+    activity_type = args.get('type', '')
+    if activity_type:
+        query = query.filter(Activity.type == activity_type)
     
-    # ファイル名に現在の日時を含める
+    return query.order_by(Activity.happened_at.desc())
+
+
+def export_file_basename(entity, args):
+    """エクスポートファイル名（拡張子なし、現在の日時を含める）"""
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    if entity == 'activities':
+        company_id = args.get('company_id', '')
+        company = Company.query.get(company_id) if company_id else None
+        if company:
+            return f'活動履歴_{company.name}_{timestamp}'
+    return f'{EXPORTS[entity][3]}_{timestamp}'
+
+
+# エクスポートの種類 → (対象のクエリ, CSV出力, Excel出力, ファイル名)
+EXPORTS = {
+    'companies': (companies_export_query, export_companies_to_csv, export_companies_to_excel, '企業一覧'),
+    'deals': (deals_export_query, export_deals_to_csv, export_deals_to_excel, '案件一覧'),
+    'activities': (activities_export_query, export_activities_to_csv, export_activities_to_excel, '活動履歴'),
+}
+
+
+def export_response(entity):
+    """
+    エクスポートのレスポンス
     
+    推定件数が EXPORT_ASYNC_THRESHOLD を超える場合（または async=1 指定時）は
+    バックグラウンドのジョブとして受け付け、進捗ページ（JSON要求時は 202 とジョブ情報）を返す。
+    """
+    build_query, to_csv, to_excel, _ = EXPORTS[entity]
+    format_type = request.args.get('format', 'csv')  # csv or excel
+    query = build_query(request.args, current_user)
+    
+    total = None
+    if request.args.get('async') != '1':
+        total = query.order_by(None).count()
+    if total is None or total > EXPORT_ASYNC_THRESHOLD:
+        extension = 'xlsx' if format_type == 'excel' else 'csv'
+        job = create_job('export', current_user.id, {
+            'entity': entity,
+            'format': format_type,
+            'args': request.args.to_dict(flat=False),
+            'filename': f'{export_file_basename(entity, request.args)}.{extension}'
+        }, total=total)
+        submit_job(app, job.id)
+        return job_accepted_response(job)
+    
+    basename = export_file_basename(entity, request.args)
     if format_type == 'excel':
-        excel_file = export_companies_to_excel(companies_list)
+        excel_file = to_excel(query.yield_per(EXPORT_BATCH_SIZE))
         return send_file(
             excel_file,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            mimetype=EXCEL_MIMETYPE,
             as_attachment=True,
-            download_name=f'企業一覧_{timestamp}.xlsx'
+            download_name=f'{basename}.xlsx'
         )
     else:
-        csv_data = export_companies_to_csv(companies_list)
-        response = make_response(csv_data)
-        response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-        response.headers['Content-Disposition'] = f'attachment; filename=企業一覧_{timestamp}.csv'
-        return response
+        # CSVは EXPORT_BATCH_SIZE 件ずつ読み込みながら書き出す
+        csv_chunks = to_csv(query.yield_per(EXPORT_BATCH_SIZE))
+        return csv_download_response(csv_chunks, f'{basename}.csv')
+
+
+def run_export_job(job, progress):
+    """エクスポートのジョブ（ワーカープールで実行し、成果物をファイルに書き出す）"""
+    from werkzeug.datastructures import MultiDict
+    
+    params = json.loads(job.params)
+    build_query, to_csv, to_excel, _ = EXPORTS[params['entity']]
+    user = db.session.get(User, job.user_id)
+    query = build_query(MultiDict(params['args']), user)
+    if job.total is None:
+        progress.set_total(query.order_by(None).count())
+    records = progress.iterate(query.yield_per(EXPORT_BATCH_SIZE))
+    
+    if params['format'] == 'excel':
+        path = artifact_path(job.id, 'xlsx')
+        progress.set_artifact(path)
+        with open(path, 'wb') as output:
+            to_excel(records, output=output)
+    else:
+        path = artifact_path(job.id, 'csv')
+        progress.set_artifact(path)
+        with open(path, 'w', encoding='utf-8', newline='') as output:
+            output.writelines(to_csv(records))
+    return {'file_path': path, 'filename': params['filename']}
+
+
+register_job_handler('export', run_export_job)
+
+
+def job_accepted_response(job):
+    """ジョブを受け付けたレスポンス（JSON要求時は 202、それ以外は進捗ページへ）"""
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({
+            'job_id': job.id,
+            'status_url': url_for('api_job_status', job_id=job.id),
+            'page_url': url_for('job_status_page', job_id=job.id)
+        }), 202
+    return redirect(url_for('job_status_page', job_id=job.id))
+
+
+def get_own_job(job_id):
+    """ログインユーザーのジョブ（他のユーザーのジョブは 404）"""
+    return BackgroundJob.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+
+
+@app.route('/jobs/<job_id>')
+@login_required
+def job_status_page(job_id):
+    """ジョブの進捗ページ（完了するとダウンロードを開始）"""
+    job = get_own_job(job_id)
+    return render_template('job_status.html', job=job)
+
+
+@app.route('/api/jobs/<job_id>')
+@login_required
+def api_job_status(job_id):
+    """ジョブの進捗（完了時は download_url を含む）"""
+    job = get_own_job(job_id)
+    # ワーカーが停止して running のまま残ったジョブは失敗にする
+    if job.status in ('queued', 'running') and fail_stalled_jobs(job.id):
+        db.session.refresh(job)
+    result = job_to_dict(job)
+    if job.status == 'done' and job.file_path:
+        result['download_url'] = url_for('download_job_artifact', job_id=job.id)
+    return jsonify(result)
+
+
+@app.route('/api/jobs/<job_id>/download')
+@login_required
+def download_job_artifact(job_id):
+    """ジョブの成果物をダウンロード（期限切れ・未完了は 404）"""
+    job = get_own_job(job_id)
+    if job.status != 'done' or not job.file_path or not os.path.exists(job.file_path) \
+            or (job.expires_at and job.expires_at < datetime.utcnow()):
+        return jsonify({'error': 'ファイルが見つからないか、有効期限が切れています'}), 404
+    mimetype = EXCEL_MIMETYPE if job.file_path.endswith('.xlsx') else 'text/csv; charset=utf-8'
+    return send_file(job.file_path, mimetype=mimetype, as_attachment=True, download_name=job.filename)
+
+
+# インポートで1回の INSERT・コミットにまとめる行数
+COMPANY_IMPORT_CHUNK_ROWS = int(os.environ.get('COMPANY_IMPORT_CHUNK_ROWS', IMPORT_CHUNK_ROWS))
+DEAL_IMPORT_CHUNK_ROWS = int(os.environ.get('DEAL_IMPORT_CHUNK_ROWS', IMPORT_CHUNK_ROWS))
+
+# インポートのエラーレポート（CSV）の列
+IMPORT_REPORT_HEADERS = ['種別', '内容']
+IMPORT_ENTITY_LABELS = {'companies': '企業', 'deals': '案件'}
+
+
+def import_upload_path(job_id, file_ext):
+    """インポートのジョブが読むアップロードファイルのパス"""
+    return artifact_path(job_id, f'upload.{file_ext}')
+
+
+def import_report_path(job_id):
+    """インポートのエラーレポートのパス（エラー・警告が無ければ作成しない）"""
+    return artifact_path(job_id, 'errors.csv')
+
+
+def run_import_job(job, progress):
+    """
+    インポートのジョブ（アップロードを読みながらチャンクごとにコミットする）
+    
+    チャンクのコミットと同じトランザクションでチェックポイント（最終行番号・件数）を記録し、
+    再開時はチェックポイントの行まで読み飛ばして続きから処理する。
+    エラー・警告はコミットしたチャンクごとにエラーレポートへ追記する。
+    """
+    params = json.loads(job.params)
+    entity = params['entity']
+    upload_path = import_upload_path(job.id, params['file_ext'])
+    report_path = import_report_path(job.id)
+    progress.set_artifact(report_path)
+    resume_from = (job.checkpoint_row, job.succeeded, job.failed) if job.checkpoint_row else None
+    
+    def save_checkpoint(last_row, succeeded, failed):
+        progress.checkpoint(last_row, last_row - 1, succeeded, failed)
+    
+    def write_report(last_row, succeeded, failed, messages):
+        progress.processed = last_row - 1
+        if not messages:
+            return
+        new_report = not os.path.exists(report_path)
+        with open(report_path, 'a', encoding='utf-8-sig', newline='') as report:
+            writer = csv.writer(report)
+            if new_report:
+                writer.writerow(IMPORT_REPORT_HEADERS)
+            for message in messages:
+                writer.writerow(['警告' if is_warning_message(message) else 'エラー', message])
+    
+    # アップロードは再開に使うため、ここでは削除しない（終了時に cleanup_import_job で削除）
+    with open(upload_path, 'rb') as upload:
+        # 壊れたファイルなどの読み込みエラーは ValueError（再試行しない入力エラー）になる
+        rows = peek_rows(read_import_rows(upload, params['file_ext']))
+        if not rows:
+            raise ValueError('データが含まれていません。')
+        if entity == 'companies':
+            succeeded, _, _ = import_company_rows(
+                rows, INDUSTRY_CATEGORIES, COMPANY_IMPORT_CHUNK_ROWS, write_report,
+                checkpoint=save_checkpoint, resume_from=resume_from
+            )
+        else:
+            user = db.session.get(User, job.user_id)
+            succeeded, _, _ = import_deal_rows(
+                rows, user.team_id if user else None, job.user_id, DEAL_IMPORT_CHUNK_ROWS, write_report,
+                checkpoint=save_checkpoint, resume_from=resume_from
+            )
+    
+    # 一括INSERTはコミットフックを通らないため、集計キャッシュをここで無効化する
+    if succeeded:
+        if entity == 'companies':
+            analytics_versions.bump('companies')
+        else:
+            dashboard_cache.clear()
+            analytics_versions.bump('deals')
+    if not os.path.exists(report_path):
+        return {'file_path': None}
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    return {'file_path': report_path, 'filename': f'{entity}_import_errors_{timestamp}.csv'}
+
+
+def cleanup_import_job(job):
+    """
+    終了したインポートのアップロードを削除
+    
+    完了・入力エラー・再試行の上限に達した場合だけ呼ばれる。タイムアウトや接続断で止まった
+    ジョブのアップロードはチェックポイントからの再開に使うため残す。
+    """
+    upload_path = import_upload_path(job.id, json.loads(job.params)['file_ext'])
+    if os.path.exists(upload_path):
+        os.remove(upload_path)
+
+
+register_job_handler('import', run_import_job, resumable=True, cleanup=cleanup_import_job)
+
+
+def start_import_job(entity, file, file_ext):
+    """アップロードを保存してインポートのジョブを登録し、進捗ページ（JSON要求時は 202）を返す"""
+    job = create_job('import', current_user.id, {
+        'entity': entity, 'file_ext': file_ext, 'source_filename': file.filename
+    })
+    file.save(import_upload_path(job.id, file_ext))
+    submit_job(app, job.id)
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({
+            'job_id': job.id,
+            'status_url': url_for('api_import_status', job_id=job.id),
+            'page_url': url_for('import_status_page', job_id=job.id)
+        }), 202
+    return redirect(url_for('import_status_page', job_id=job.id))
+
+
+def get_own_import_job(job_id):
+    """ログインユーザーのインポートのジョブ（他のユーザーのジョブは 404）"""
+    return BackgroundJob.query.filter_by(id=job_id, user_id=current_user.id, kind='import').first_or_404()
+
+
+def import_job_to_dict(job):
+    """インポートのジョブの状態（/api/imports/<id> のレスポンス）"""
+    params = json.loads(job.params)
+    result = job_to_dict(job)
+    result.update({
+        'entity': params['entity'],
+        'source_filename': params.get('source_filename'),
+        'checkpoint_row': job.checkpoint_row,
+        'error_report_url': url_for('download_import_report', job_id=job.id)
+        if os.path.exists(import_report_path(job.id)) else None,
+    })
+    return result
+
+
+@app.route('/imports/<job_id>')
+@login_required
+def import_status_page(job_id):
+    """インポートの進捗ページ"""
+    job = get_own_import_job(job_id)
+    entity = json.loads(job.params)['entity']
+    return render_template('import_status.html', job=job, entity_label=IMPORT_ENTITY_LABELS[entity],
+                           back_url=url_for(entity))
+
+
+@app.route('/api/imports/<job_id>')
+@login_required
+def api_import_status(job_id):
+    """
+    インポートの状態（処理行数・成功/エラー件数・行/秒・エラーレポートのURL）
+    
+    ワーカーが停止して中断しているジョブは、ここでチェックポイントから再開する。
+    """
+    job = get_own_import_job(job_id)
+    if job.status in ('queued', 'running', 'retrying') and resume_stalled_jobs(app, job.id):
+        db.session.refresh(job)
+    return jsonify(import_job_to_dict(job))
+
+
+@app.route('/api/imports/<job_id>/errors')
+@login_required
+def download_import_report(job_id):
+    """インポートのエラーレポート（CSV。処理中はその時点までの内容）"""
+    job = get_own_import_job(job_id)
+    path = import_report_path(job.id)
+    if job.status == 'expired' or not os.path.exists(path):
+        return jsonify({'error': 'エラーレポートが見つからないか、有効期限が切れています'}), 404
+    entity = json.loads(job.params)['entity']
+    return send_file(path, mimetype='text/csv; charset=utf-8', as_attachment=True,
+                     download_name=job.filename or f'{entity}_import_errors.csv')
+
+
+@app.route('/companies/export')
+@login_required
+def export_companies():
+    """企業データをCSV/Excelでエクスポート"""
+    guard = ensure_import_export_permission('companies')
+    if guard:
+        return guard
+    return export_response('companies')
 
 @app.route('/companies/import', methods=['GET', 'POST'])
 @login_required
@@ -1242,117 +1852,13 @@ def import_companies():
         filename = secure_filename(file.filename)
         file_ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
         
-        if file_ext not in ['csv', 'xlsx', 'xls']:
-            flash('CSVまたはExcelファイルを選択してください。', 'error')
+        # 旧形式の .xls は openpyxl で読めないため受け付けない
+        if file_ext not in ['csv', 'xlsx']:
+            flash('CSVまたはExcel（.xlsx）ファイルを選択してください。', 'error')
             return redirect(url_for('companies'))
         
-        try:
-            # ファイルをパース
-            if file_ext == 'csv':
-                rows = parse_csv_file(file)
-            else:
-                rows = parse_excel_file(file)
-            
-            if not rows:
-                flash('データが含まれていません。', 'error')
-                return redirect(url_for('companies'))
-            
-            # データをインポート
-            success_count = 0
-            error_count = 0
-            errors = []
-            
-            for idx, row in enumerate(rows, start=2):  # 行番号は2から（ヘッダーを考慮）
-                # バリデーション
-                validation_errors = validate_company_row(row, idx, INDUSTRY_CATEGORIES)
-                if validation_errors:
-                    errors.extend(validation_errors)
-                    error_count += 1
-                    continue
-                
-                # 企業名を取得（日本語または英語ヘッダーに対応）
-                company_name = row.get('企業名') or row.get('name', '').strip()
-                if not company_name:
-                    errors.append(f"行{idx}: 企業名が空です")
-                    error_count += 1
-                    continue
-                
-                # 既存の企業をチェック（重複はスキップ）
-                existing_company = Company.query.filter_by(name=company_name).first()
-                if existing_company:
-                    # 重複は警告として記録するが、エラーカウントには含めない（スキップ）
-                    errors.append(f"行{idx}: 企業 '{company_name}' は既に存在するためスキップしました")
-                    continue  # エラーカウントを増やさず、この行をスキップ
-                
-                # 業界名を取得して正規化（バリデーションで正規化済みの場合はそれを使用）
-                industry_raw = row.get('業界') or row.get('industry', '')
-                industry = row.get('_normalized_industry')  # バリデーションで正規化された業界名を使用
-                
-                if not industry and industry_raw:
-                    from utils.import_utils import normalize_industry_name
-                    industry = normalize_industry_name(industry_raw)
-                    # 正規化後の業界名が有効な業界カテゴリに含まれていない場合はNoneにする
-                    if industry not in INDUSTRY_CATEGORIES:
-                        industry = None
-                
-                # マッピングが適用された場合は警告として記録
-                if row.get('_industry_mapped') and industry_raw:
-                    errors.append(f"行{idx}: 業界 '{industry_raw}' を '{industry}' に変換しました")
-                
-                # 新しい企業を作成
-                try:
-                    company = Company(
-                        name=company_name,
-                        industry=industry,
-                        location=row.get('所在地') or row.get('location', '') or None,
-                        hq_location=row.get('本社所在地') or row.get('hq_location', '') or None,
-                        employee_size=int(row.get('従業員数') or row.get('employee_size', '')) if row.get('従業員数') or row.get('employee_size') else None,
-                        website=row.get('ウェブサイト') or row.get('website', '') or None,
-                        heat_score=int(row.get('温度感スコア') or row.get('heat_score', '')) if row.get('温度感スコア') or row.get('heat_score') else None,
-                        tags=row.get('タグ') or row.get('tags', '') or None,
-                        memo=row.get('メモ') or row.get('memo', '') or None,
-                        needs=row.get('ニーズ') or row.get('needs', '') or None,
-                        kpi_current=row.get('現状KPI') or row.get('kpi_current', '') or None
-                    )
-                    
-                    db.session.add(company)
-                    success_count += 1
-                except Exception as e:
-                    errors.append(f"行{idx}: エラー - {str(e)}")
-                    error_count += 1
-            
-            db.session.commit()
-            
-            # 結果メッセージ
-            if success_count > 0:
-                flash(f'{success_count}件の企業をインポートしました。', 'success')
-            
-            # 警告（重複やスキップされた行、マッピング）とエラーを分けて表示
-            warnings = [e for e in errors if 'スキップ' in e or '変換しました' in e]
-            actual_errors = [e for e in errors if e not in warnings]
-            
-            if warnings:
-                warning_msg = f'{len(warnings)}件の警告: ' + '; '.join(warnings[:3])
-                if len(warnings) > 3:
-                    warning_msg += f' ... 他{len(warnings) - 3}件'
-                flash(warning_msg, 'warning')
-            
-            if actual_errors:
-                error_msg = f'{len(actual_errors)}件のエラーが発生しました。'
-                error_msg += ' 詳細: ' + '; '.join(actual_errors[:5])  # 最初の5件のみ表示
-                if len(actual_errors) > 5:
-                    error_msg += f' ... 他{len(actual_errors) - 5}件'
-                flash(error_msg, 'error')
-            elif error_count > 0 and not actual_errors:
-                # エラーカウントはあるが、実際のエラーがない場合（重複のみ）
-                flash(f'{len(warnings)}件の行をスキップしました（重複または警告のみ）。', 'info')
-            
-            return redirect(url_for('companies'))
-            
-        except Exception as e:
-            db.session.rollback()
-            flash(f'インポート中にエラーが発生しました: {str(e)}', 'error')
-            return redirect(url_for('companies'))
+        # アップロードを保存してインポートのジョブを登録（処理はワーカーでチャンクごとにコミット）
+        return start_import_job('companies', file, file_ext)
     
     return render_template('import_companies.html')
 
@@ -1466,9 +1972,8 @@ def contacts():
     if search:
         query = Contact.query.join(Company).filter(
             db.or_(
-                Contact.name.ilike(f'%{search}%'),
-                Contact.email.ilike(f'%{search}%'),
-                Company.name.ilike(f'%{search}%')
+                search_condition('contacts', search),
+                search_condition('companies', search)
             )
         )
     else:
@@ -1514,8 +2019,7 @@ def create_contact():
         flash('連絡先を追加しました。', 'success')
         return redirect(url_for('contacts'))
     
-    companies = Company.query.all()
-    return render_template('contact_form.html', contact=None, companies=companies)
+    return render_template('contact_form.html', contact=None)
 
 @app.route('/contacts/<int:id>/edit', methods=['GET', 'POST'])
 @login_required
@@ -1532,8 +2036,7 @@ def edit_contact(id):
         flash('連絡先情報を更新しました。', 'success')
         return redirect(url_for('contacts'))
     
-    companies = Company.query.all()
-    return render_template('contact_form.html', contact=contact, companies=companies)
+    return render_template('contact_form.html', contact=contact)
 
 @app.route('/contacts/<int:id>/delete', methods=['POST'])
 @login_required
@@ -1544,280 +2047,304 @@ def delete_contact(id):
     flash('連絡先を削除しました。', 'success')
     return redirect(url_for('contacts'))
 
-@app.route('/deals')
-@login_required
-def deals():
-    from datetime import datetime, date
-    
-    # 基本検索・フィルタ
-    search = request.args.get('search', '')
-    stage_filter = request.args.get('stage', '')
-    status_filter = request.args.get('status', '')
-    assignee_filter = request.args.get('assignee', '')
-    
-    # 高度なフィルタ
-    heat_score_filter = request.args.get('heat_score', '')
-    amount_min = request.args.get('amount_min', '')
-    amount_max = request.args.get('amount_max', '')
-    created_from = request.args.get('created_from', '')
-    created_to = request.args.get('created_to', '')
-    revenue_month = request.args.get('revenue_month', '')
-    
-    # ソート機能
-    sort_by = request.args.get('sort_by', 'created_at')  # デフォルト: 作成日
-    sort_order = request.args.get('sort_order', 'desc')  # デフォルト: 降順（新着順）
-    requested_scope = request.args.get('view_scope', None)
-    view_scope = resolve_view_scope(current_user, requested_scope)
-    
-    query = Deal.query.join(Company)
-    query = apply_scope_to_query(query, current_user, view_scope)
-    
+def apply_deal_filters(query, args):
+    """案件一覧・エクスポート共通の検索/フィルタ条件を適用（Companyとの結合済みクエリを想定）"""
     # 基本検索
+    search = args.get('search', '')
     if search:
         query = query.filter(
             db.or_(
-                Deal.title.ilike(f'%{search}%'),
-                Company.name.ilike(f'%{search}%')
+                search_condition('deals', search),
+                search_condition('companies', search)
             )
         )
     
     # 基本フィルタ
+    stage_filter = args.get('stage', '')
     if stage_filter:
         query = query.filter(Deal.stage == stage_filter)
     
+    status_filter = args.get('status', '')
     if status_filter:
         query = query.filter(Deal.status == status_filter)
     
+    assignee_filter = args.get('assignee', '')
     if assignee_filter:
         query = query.filter(Deal.assignee_id == int(assignee_filter))
     
-    # 高度なフィルタ
-    if heat_score_filter:
-        query = query.filter(Deal.heat_score == heat_score_filter)
-    
-    if amount_min:
-        try:
-            query = query.filter(Deal.amount >= float(amount_min))
-        except ValueError:
-            pass
-    
-    if amount_max:
-        try:
-            query = query.filter(Deal.amount <= float(amount_max))
-        except ValueError:
-            pass
-    
-    if created_from:
-        try:
-            from_date = datetime.strptime(created_from, '%Y-%m-%d').date()
-            query = query.filter(db.func.date(Deal.created_at) >= from_date)
-        except ValueError:
-            pass
-    
-    if created_to:
-        try:
-            to_date = datetime.strptime(created_to, '%Y-%m-%d').date()
-            query = query.filter(db.func.date(Deal.created_at) <= to_date)
-        except ValueError:
-            pass
-    
-    if revenue_month:
-        # 計上月フィルタ（YYYY-MM形式）- SQLiteとPostgreSQLの両方に対応
-        try:
-            year, month = map(int, revenue_month.split('-'))
-            db_url = app.config['SQLALCHEMY_DATABASE_URI']
-            is_postgres = 'postgresql' in db_url if db_url else False
-            
-            if is_postgres:
-                # PostgreSQL: use to_char
-                query = query.filter(
-                    Deal.status == 'WON',
-                    db.func.to_char(Deal.closed_at, 'YYYY-MM') == revenue_month
-                )
-            else:
-                # SQLite: use strftime
-                query = query.filter(
-                    Deal.status == 'WON',
-                    db.func.strftime('%Y-%m', Deal.closed_at) == revenue_month
-                )
-        except (ValueError, AttributeError):
-            pass
-    
-    # ソート処理
-    sort_column = None
-    if sort_by == 'created_at':
-        sort_column = Deal.created_at
-    elif sort_by == 'updated_at':
-        sort_column = Deal.updated_at
-    elif sort_by == 'amount':
-        sort_column = Deal.amount
-    elif sort_by == 'title':
-        sort_column = Deal.title
-    elif sort_by == 'stage_days':
-        # ステージ滞留日数（現在日時 - stage_entered_at）
-        # 計算が必要なため、一旦ソートはスキップ（後でPythonでソート）
-        pass
-    
-    if sort_column:
-        if sort_order == 'desc':
-            query = query.order_by(sort_column.desc())
-        else:
-            query = query.order_by(sort_column.asc())
-    else:
-        # デフォルトソート（作成日降順）
-        query = query.order_by(Deal.created_at.desc())
-    
-    deals_list = query.all()
-    
-    # ステージ滞留日数でソートする場合（Pythonでソート）
-    if sort_by == 'stage_days':
-        today = datetime.now()
-        deals_list.sort(
-            key=lambda d: (today - d.stage_entered_at).days if d.stage_entered_at else 0,
-            reverse=(sort_order == 'desc')
-        )
-    
-    # Get users for filter dropdown
-    users_query = User.query.order_by(User.name)
-    if not is_team_manager(current_user):
-        if current_user.team_id:
-            users_query = users_query.filter(User.team_id == current_user.team_id)
-        else:
-            users_query = users_query.filter(User.id == current_user.id)
-    users = users_query.all()
-    
-    return render_template('deals.html', 
-                         deals=deals_list, 
-                         search=search,
-                         stage_filter=stage_filter, 
-                         status_filter=status_filter,
-                         assignee_filter=assignee_filter,
-                         heat_score_filter=heat_score_filter,
-                         amount_min=amount_min,
-                         amount_max=amount_max,
-                         created_from=created_from,
-                         created_to=created_to,
-                         revenue_month=revenue_month,
-                         sort_by=sort_by,
-                         sort_order=sort_order,
-                         users=users,
-                         view_scope=view_scope,
-                         available_scopes=get_available_scopes(current_user),
-                         win_reasons=WIN_REASON_CATEGORIES, 
-                         loss_reasons=LOSS_REASON_CATEGORIES)
-
-@app.route('/deals/export')
-@login_required
-def export_deals():
-    """案件データをCSV/Excelでエクスポート"""
-    guard = ensure_import_export_permission('deals')
-    if guard:
-        return guard
-    format_type = request.args.get('format', 'csv')  # csv or excel
-    
-    # 現在のフィルタ条件を適用（deals()と同じロジック）
-    from datetime import datetime, date
-    
-    search = request.args.get('search', '')
-    stage_filter = request.args.get('stage', '')
-    status_filter = request.args.get('status', '')
-    assignee_filter = request.args.get('assignee', '')
-    heat_score_filter = request.args.get('heat_score', '')
-    amount_min = request.args.get('amount_min', '')
-    amount_max = request.args.get('amount_max', '')
-    created_from = request.args.get('created_from', '')
-    created_to = request.args.get('created_to', '')
-    revenue_month = request.args.get('revenue_month', '')
-    requested_scope = request.args.get('view_scope', None)
-    view_scope = resolve_view_scope(current_user, requested_scope)
-    
-    query = Deal.query.join(Company)
-    query = apply_scope_to_query(query, current_user, view_scope)
-    
-    if search:
-        query = query.filter(
-            db.or_(
-                Deal.title.ilike(f'%{search}%'),
-                Company.name.ilike(f'%{search}%')
-            )
-        )
-    
-    if stage_filter:
-        query = query.filter(Deal.stage == stage_filter)
-    
-    if status_filter:
-        query = query.filter(Deal.status == status_filter)
-    
-    if assignee_filter:
-        query = query.filter(Deal.assignee_id == int(assignee_filter))
-    
+    # 高度なフィルタ
+    heat_score_filter = args.get('heat_score', '')
     if heat_score_filter:
         query = query.filter(Deal.heat_score == heat_score_filter)
     
+    amount_min = args.get('amount_min', '')
     if amount_min:
         try:
             query = query.filter(Deal.amount >= float(amount_min))
         except ValueError:
             pass
     
+    amount_max = args.get('amount_max', '')
     if amount_max:
         try:
             query = query.filter(Deal.amount <= float(amount_max))
         except ValueError:
             pass
     
+    created_from = args.get('created_from', '')
     if created_from:
         try:
             from_date = datetime.strptime(created_from, '%Y-%m-%d').date()
-            query = query.filter(db.func.date(Deal.created_at) >= from_date)
+            query = query.filter(date_range_condition(Deal.created_at, start_date=from_date))
         except ValueError:
             pass
     
+    created_to = args.get('created_to', '')
     if created_to:
         try:
             to_date = datetime.strptime(created_to, '%Y-%m-%d').date()
-            query = query.filter(db.func.date(Deal.created_at) <= to_date)
+            query = query.filter(date_range_condition(Deal.created_at, end_date=to_date))
         except ValueError:
             pass
     
+    revenue_month = args.get('revenue_month', '')
     if revenue_month:
+        # 計上月フィルタ（YYYY-MM形式）- 成約日時がその月に入る受注案件
         try:
             year, month = map(int, revenue_month.split('-'))
-            db_url = app.config['SQLALCHEMY_DATABASE_URI']
-            is_postgres = 'postgresql' in db_url if db_url else False
-            
-            if is_postgres:
-                query = query.filter(
-                    Deal.status == 'WON',
-                    db.func.to_char(Deal.closed_at, 'YYYY-MM') == revenue_month
-                )
-            else:
-                query = query.filter(
-                    Deal.status == 'WON',
-                    db.func.strftime('%Y-%m', Deal.closed_at) == revenue_month
-                )
+            query = query.filter(
+                Deal.status == 'WON',
+                date_range_condition(Deal.closed_at, *month_range(year, month))
+            )
         except (ValueError, AttributeError):
             pass
     
-    deals_list = query.all()
+    return query
+
+@app.route('/deals')
+@login_required
+def deals():
+    from sqlalchemy.orm import contains_eager, joinedload
     
-    # ファイル名に現在の日時を含める
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    # 基本検索・フィルタ
+    search = request.args.get('search', '')
+    stage_filter = request.args.get('stage', '')
+    status_filter = request.args.get('status', '')
+    assignee_filter = request.args.get('assignee', '')
     
-    if format_type == 'excel':
-        excel_file = export_deals_to_excel(deals_list)
-        return send_file(
-            excel_file,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=f'案件一覧_{timestamp}.xlsx'
-        )
+    # 高度なフィルタ
+    heat_score_filter = request.args.get('heat_score', '')
+    amount_min = request.args.get('amount_min', '')
+    amount_max = request.args.get('amount_max', '')
+    created_from = request.args.get('created_from', '')
+    created_to = request.args.get('created_to', '')
+    revenue_month = request.args.get('revenue_month', '')
+    
+    # ソート機能
+    sort_by = request.args.get('sort_by', 'created_at')  # デフォルト: 作成日
+    sort_order = request.args.get('sort_order', 'desc')  # デフォルト: 降順（新着順）
+    requested_scope = request.args.get('view_scope', None)
+    view_scope = resolve_view_scope(current_user, requested_scope)
+    
+    # ページネーション（キーセット方式）
+    cursor = request.args.get('cursor', '')
+    per_page = parse_per_page(request.args.get('per_page'))
+    
+    # 一覧で表示する企業・担当者はJOINで同時に取得（行ごとの遅延ロードを防ぐ）
+    query = Deal.query.join(Company).options(
+        contains_eager(Deal.company),
+        joinedload(Deal.assignee_user)
+    )
+    query = apply_scope_to_query(query, current_user, view_scope)
+    query = apply_deal_filters(query, request.args)
+    
+    # ソート処理
+    descending = (sort_order == 'desc')
+    nullable = False
+    if sort_by == 'amount':
+        sort_column = Deal.amount
+        nullable = True
+    elif sort_by == 'title':
+        sort_column = Deal.title
+    elif sort_by == 'stage_days':
+        # ステージ滞留日数（現在日時 - stage_entered_at）は stage_entered_at の逆順と等価
+        sort_column = Deal.stage_entered_at
+        nullable = True
+        descending = not descending
     else:
-        csv_data = export_deals_to_csv(deals_list)
-        response = make_response(csv_data)
-        response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-        response.headers['Content-Disposition'] = f'attachment; filename=案件一覧_{timestamp}.csv'
-        return response
+        # デフォルトソート（作成日）
+        sort_by = 'created_at'
+        sort_column = Deal.created_at
+        nullable = True
+    
+    deals_list, next_cursor = keyset_paginate(
+        query, sort_column, Deal.id,
+        sort_key=f'{sort_by}:{sort_order}:{view_scope}',
+        cursor=cursor,
+        per_page=per_page,
+        descending=descending,
+        nullable=nullable
+    )
+    
+    # Get users for filter dropdown
+    users_query = User.query.order_by(User.name)
+    if not is_team_manager(current_user):
+        if current_user.team_id:
+            users_query = users_query.filter(User.team_id == current_user.team_id)
+        else:
+            users_query = users_query.filter(User.id == current_user.id)
+    users = users_query.all()
+    
+    # ページ移動時に引き継ぐ検索・フィルタ・ソート条件
+    filter_args = {
+        key: value for key, value in {
+            'search': search,
+            'stage': stage_filter,
+            'status': status_filter,
+            'assignee': assignee_filter,
+            'heat_score': heat_score_filter,
+            'amount_min': amount_min,
+            'amount_max': amount_max,
+            'created_from': created_from,
+            'created_to': created_to,
+            'revenue_month': revenue_month,
+            'sort_by': sort_by,
+            'sort_order': sort_order,
+            'view_scope': requested_scope,
+            'per_page': request.args.get('per_page', ''),
+        }.items() if value
+    }
+    
+    return render_template('deals.html', 
+                         deals=deals_list, 
+                         search=search,
+                         stage_filter=stage_filter, 
+                         status_filter=status_filter,
+                         assignee_filter=assignee_filter,
+                         heat_score_filter=heat_score_filter,
+                         amount_min=amount_min,
+                         amount_max=amount_max,
+                         created_from=created_from,
+                         created_to=created_to,
+                         revenue_month=revenue_month,
+                         sort_by=sort_by,
+                         sort_order=sort_order,
+                         cursor=cursor,
+                         next_cursor=next_cursor,
+                         filter_args=filter_args,
+                         users=users,
+                         view_scope=view_scope,
+                         available_scopes=get_available_scopes(current_user),
+                         win_reasons=WIN_REASON_CATEGORIES, 
+                         loss_reasons=LOSS_REASON_CATEGORIES)
+
+def stale_deal_condition(days=Deal.STALE_DAYS):
+    """ステージ滞留が days 日以上の進行中案件の条件（status, stage_entered_at のインデックスを使用）"""
+    return db.and_(
+        Deal.status.in_(Deal.OPEN_STATUSES),
+        Deal.stage_entered_at <= datetime.utcnow() - timedelta(days=days)
+    )
+
+@app.route('/api/deals/stale')
+@login_required
+def api_stale_deals():
+    """
+    滞留案件の一覧（ステージ滞留日数の長い順、キーセット方式でページング）
+    
+    assignee_id を指定すると担当者ごとの滞留案件（リマインド用）を返す。
+    """
+    from sqlalchemy.orm import contains_eager, joinedload
+    
+    days = max(1, request.args.get('days', Deal.STALE_DAYS, type=int) or Deal.STALE_DAYS)
+    assignee_id = request.args.get('assignee_id', type=int)
+    view_scope = resolve_view_scope(current_user, request.args.get('view_scope'))
+    cursor = request.args.get('cursor', '')
+    per_page = parse_per_page(request.args.get('per_page'))
+    
+    query = Deal.query.filter(stale_deal_condition(days))
+    query = apply_scope_to_query(query, current_user, view_scope)
+    if assignee_id:
+        query = query.filter(Deal.assignee_id == assignee_id)
+    # 件数はJOINなしで（インデックスのみで）数える
+    total = query.with_entities(db.func.count(Deal.id)).scalar() or 0
+    
+    query = query.join(Company).options(contains_eager(Deal.company), joinedload(Deal.assignee_user))
+    deals_list, next_cursor = keyset_paginate(
+        query, Deal.stage_entered_at, Deal.id,
+        sort_key=f'stale:{days}:{assignee_id}:{view_scope}',
+        cursor=cursor,
+        per_page=per_page
+    )
+    
+    return jsonify({
+        'days': days,
+        'total': total,
+        'data': [{
+            'id': deal.id,
+            'title': deal.title,
+            'company_id': deal.company_id,
+            'company_name': deal.company.name,
+            'stage': deal.stage,
+            'status': deal.status,
+            'amount': deal.amount,
+            'assignee_id': deal.assignee_id,
+            'assignee_name': deal.get_assignee_name(),
+            'stage_entered_at': deal.stage_entered_at.isoformat(),
+            'days_in_stage': deal.days_in_stage
+        } for deal in deals_list],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/deals/facets')
+@login_required
+def api_deal_facets():
+    """
+    案件の絞り込みパネル用の件数（ステージ・ステータス・担当者・温度感）
+    
+    表示範囲（view_scope）と検索条件を適用した1回のGROUP BYで集計し、
+    フィルタ条件と表示範囲ごとに短時間キャッシュする。
+    """
+    facet_keys = ('stage', 'status', 'assignee', 'heat_score')
+    base_args = {
+        key: value for key, value in request.args.items()
+        if key not in facet_keys and key not in NON_FILTER_ARGS and key != 'view_scope'
+    }
+    selected = {key: request.args.get(key) or None for key in facet_keys}
+    view_scope = resolve_view_scope(current_user, request.args.get('view_scope'))
+    cache_key = make_cache_key('deal_facets', view_scope, view_scope_owner(current_user, view_scope),
+                               **base_args, **selected)
+    
+    def compute():
+        query = db.session.query(
+            Deal.stage,
+            Deal.status,
+            Deal.assignee_id,
+            Deal.heat_score,
+            db.func.count(Deal.id)
+        ).join(Company)
+        query = apply_scope_to_query(query, current_user, view_scope)
+        rows = apply_deal_filters(query, base_args).group_by(
+            Deal.stage, Deal.status, Deal.assignee_id, Deal.heat_score
+        ).all()
+        
+        total, counts = count_facets(rows, [
+            ('stage', 0, None),
+            ('status', 1, None),
+            ('assignee', 2, None),
+            ('heat_score', 3, None),
+        ], selected)
+        return {'total': total, 'facets': counts}
+    
+    return jsonify(facet_cache.get_or_set(cache_key, compute))
+
+@app.route('/deals/export')
+@login_required
+def export_deals():
+    """案件データをCSV/Excelでエクスポート"""
+    guard = ensure_import_export_permission('deals')
+    if guard:
+        return guard
+    return export_response('deals')
 
 @app.route('/deals/import', methods=['GET', 'POST'])
 @login_required
@@ -1840,139 +2367,15 @@ def import_deals():
         filename = secure_filename(file.filename)
         file_ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
         
-        if file_ext not in ['csv', 'xlsx', 'xls']:
-            flash('CSVまたはExcelファイルを選択してください。', 'error')
+        # 旧形式の .xls は openpyxl で読めないため受け付けない
+        if file_ext not in ['csv', 'xlsx']:
+            flash('CSVまたはExcel（.xlsx）ファイルを選択してください。', 'error')
             return redirect(url_for('deals'))
         
-        try:
-            # ファイルをパース
-            if file_ext == 'csv':
-                rows = parse_csv_file(file)
-            else:
-                rows = parse_excel_file(file)
-            
-            if not rows:
-                flash('データが含まれていません。', 'error')
-                return redirect(url_for('deals'))
-            
-            # 企業名のマッピングを作成（企業名 → Companyオブジェクト）
-            companies_dict = {}
-            for company in Company.query.all():
-                companies_dict[company.name] = company
-            
-            # データをインポート
-            success_count = 0
-            error_count = 0
-            errors = []
-            
-            for idx, row in enumerate(rows, start=2):  # 行番号は2から
-                # バリデーション
-                validation_errors = validate_deal_row(row, idx, companies_dict)
-                if validation_errors:
-                    errors.extend(validation_errors)
-                    error_count += 1
-                    continue
-                
-                # 必須フィールドを取得
-                company_name = row.get('企業名') or row.get('company_name', '').strip()
-                deal_title = row.get('案件名') or row.get('title', '').strip()
-                
-                if not company_name or not deal_title:
-                    errors.append(f"行{idx}: 企業名と案件名は必須です")
-                    error_count += 1
-                    continue
-                
-                company = companies_dict.get(company_name)
-                if not company:
-                    errors.append(f"行{idx}: 企業 '{company_name}' が見つかりません")
-                    error_count += 1
-                    continue
-                
-                # 新しい案件を作成
-                try:
-                    # ステータスの変換
-                    status = row.get('ステータス') or row.get('status', 'OPEN')
-                    status_map = {'進行中': 'OPEN', '受注': 'WON', '失注': 'LOST', '成約': 'WON'}
-                    if status in status_map:
-                        status = status_map[status]
-                    
-                    # 日付のパース
-                    appointment_date = None
-                    if row.get('アポイント日') or row.get('appointment_date'):
-                        try:
-                            date_str = row.get('アポイント日') or row.get('appointment_date', '')
-                            appointment_date = datetime.strptime(date_str, '%Y-%m-%d').date()
-                        except (ValueError, AttributeError):
-                            pass
-                    
-                    closed_at = None
-                    if row.get('クローズ日') or row.get('closed_at'):
-                        try:
-                            closed_str = row.get('クローズ日') or row.get('closed_at', '')
-                            if len(closed_str) > 10:
-                                closed_at = datetime.strptime(closed_str, '%Y-%m-%d %H:%M:%S')
-                            else:
-                                closed_at = datetime.strptime(closed_str, '%Y-%m-%d')
-                        except (ValueError, AttributeError):
-                            pass
-                    
-                    team_id = current_user.team_id
-                    deal = Deal(
-                        company_id=company.id,
-                        title=deal_title,
-                        stage=row.get('ステージ') or row.get('stage', '初回接触'),
-                        amount=float(row.get('金額') or row.get('amount', 0)) if row.get('金額') or row.get('amount') else 0,
-                        status=status,
-                        heat_score=row.get('温度感スコア') or row.get('heat_score', 'C'),
-                        assignee=row.get('担当者') or row.get('assignee', '') or None,
-                        appointment_date=appointment_date,
-                        next_action=row.get('次回アクション') or row.get('next_action', '') or None,
-                        win_reason_category=row.get('受注理由カテゴリ') or row.get('win_reason_category', '') or None,
-                        win_reason_detail=row.get('受注理由詳細') or row.get('win_reason_detail', '') or None,
-                        lost_reason_category=row.get('失注理由カテゴリ') or row.get('lost_reason_category', '') or None,
-                        lost_reason_detail=row.get('失注理由詳細') or row.get('lost_reason_detail', '') or None,
-                        closed_at=closed_at,
-                        note=row.get('メモ') or row.get('note', '') or None,
-                        meeting_minutes=row.get('議事録') or row.get('meeting_minutes', '') or None,
-                        team_id=team_id
-                    )
-                    
-                    # 担当者IDを設定（担当者名から検索）
-                    assignee_name = row.get('担当者') or row.get('assignee', '')
-                    if assignee_name:
-                        user = User.query.filter_by(name=assignee_name).first()
-                        if user:
-                            deal.assignee_id = user.id
-                            deal.team_id = user.team_id or deal.team_id
-                    
-                    db.session.add(deal)
-                    success_count += 1
-                except Exception as e:
-                    errors.append(f"行{idx}: エラー - {str(e)}")
-                    error_count += 1
-            
-            db.session.commit()
-            
-            # 結果メッセージ
-            if success_count > 0:
-                flash(f'{success_count}件の案件をインポートしました。', 'success')
-            if error_count > 0:
-                error_msg = f'{error_count}件のエラーが発生しました。'
-                if errors:
-                    error_msg += ' 詳細: ' + '; '.join(errors[:5])
-                    if len(errors) > 5:
-                        error_msg += f' ... 他{len(errors) - 5}件'
-                flash(error_msg, 'error')
-            
-            return redirect(url_for('deals'))
-            
-        except Exception as e:
-            db.session.rollback()
-            flash(f'インポート中にエラーが発生しました: {str(e)}', 'error')
-            return redirect(url_for('deals'))
+        # アップロードを保存してインポートのジョブを登録（処理はワーカーでチャンクごとにコミット）
+        return start_import_job('deals', file, file_ext)
     
-    companies = Company.query.order_by(Company.name).all()
-    return render_template('import_deals.html', companies=companies)
+    return render_template('import_deals.html')
 
 @app.route('/deals/create', methods=['GET', 'POST'])
 @login_required
@@ -2071,19 +2474,17 @@ def create_deal():
                     deal.lost_date = None
         
         db.session.add(deal)
+        record_new_deal(deal, current_user.id)
         db.session.commit()
         flash('案件を追加しました。', 'success')
         return redirect(url_for('deals'))
     
-    companies = Company.query.all()
-    users = User.query.order_by(User.name).all()
-    teams = Team.query.order_by(Team.name).all()
     from models import LeadSource
-    companies = Company.query.all()
-    users = User.query.order_by(User.name).all()
+    # 企業詳細ページからの作成時は企業を選択済みにする（企業・担当者の候補は画面から非同期検索）
+    selected_company = db.session.get(Company, request.args.get('company_id', type=int) or 0)
     teams = Team.query.order_by(Team.name).all()
     lead_sources = LeadSource.query.order_by(LeadSource.sort_order).all()
-    return render_template('deal_form.html', deal=None, companies=companies, users=users, teams=teams,
+    return render_template('deal_form.html', deal=None, selected_company=selected_company, teams=teams,
                          win_reasons=WIN_REASON_CATEGORIES, loss_reasons=LOSS_REASON_CATEGORIES,
                          lead_sources=lead_sources)
 
@@ -2106,6 +2507,8 @@ def edit_deal(id):
     deal = Deal.query.get_or_404(id)
     
     if request.method == 'POST':
+        old_stage, old_status = deal.stage, deal.status
+        
         # Check if stage has changed - update stage_entered_at if so
         new_stage = request.form.get('stage')
         if deal.stage != new_stage:
@@ -2204,16 +2607,17 @@ def edit_deal(id):
             deal.win_reason_category = None
             deal.win_reason_detail = None
         
+        # ステージ遷移履歴
+        record_deal_changes(deal, old_stage, old_status, current_user.id)
+        
         db.session.commit()
         flash('案件情報を更新しました。', 'success')
         return redirect(url_for('deals'))
     
     from models import LeadSource
-    companies = Company.query.all()
-    users = User.query.order_by(User.name).all()
     teams = Team.query.order_by(Team.name).all()
     lead_sources = LeadSource.query.order_by(LeadSource.sort_order).all()
-    return render_template('deal_form.html', deal=deal, companies=companies, users=users, teams=teams,
+    return render_template('deal_form.html', deal=deal, selected_company=deal.company, teams=teams,
                          win_reasons=WIN_REASON_CATEGORIES, loss_reasons=LOSS_REASON_CATEGORIES,
                          lead_sources=lead_sources)
 
@@ -2235,12 +2639,7 @@ def tasks():
     query = Task.query
     
     if search:
-        query = query.filter(
-            db.or_(
-                Task.title.ilike(f'%{search}%'),
-                Task.deal_name.ilike(f'%{search}%')
-            )
-        )
+        query = query.filter(search_condition('tasks', search))
     
     if status_filter:
         query = query.filter(Task.status == status_filter)
@@ -2493,9 +2892,16 @@ def delete_team(id):
     if default_team:
         User.query.filter_by(team_id=id).update({'team_id': default_team.id})
         Deal.query.filter_by(team_id=id).update({'team_id': default_team.id})
+        # 一括UPDATEはマッパーイベントを通らないため、月次集計・スナップショットも同じトランザクションで付け替える
+        move_team_metrics(db.session.connection(), id, default_team.id)
+        PipelineSnapshot.query.filter_by(team_id=id).update({'team_id': default_team.id})
     
     db.session.delete(team)
     db.session.commit()
+    if default_team:
+        # コミットフック（bump_on_commit）も通らないため、集計キャッシュをここで無効化する
+        dashboard_cache.clear()
+        analytics_versions.bump('deals')
     
     flash('チームを削除しました。', 'success')
     return redirect(url_for('teams'))
@@ -3246,6 +3652,72 @@ def save_org_profile():
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)}), 400
 
+@app.route('/api/search')
+@login_required
+def api_search():
+    """企業・案件・連絡先・タスクを横断検索し、関連度順のヒットを返す"""
+    from sqlalchemy.orm import joinedload
+    
+    term = request.args.get('q', '').strip()
+    requested_types = [t for t in request.args.get('types', '').split(',') if t]
+    types = [t for t in ('companies', 'deals', 'contacts', 'tasks') if not requested_types or t in requested_types]
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+    
+    if not term:
+        return jsonify({'query': term, 'results': []})
+    
+    results = []
+    
+    if 'companies' in types:
+        for company, score in ranked_search(Company.query, 'companies', term).limit(limit).all():
+            results.append({
+                'type': 'company',
+                'id': company.id,
+                'title': company.name,
+                'subtitle': ' / '.join(v for v in (company.industry, company.location) if v),
+                'url': url_for('view_company', id=company.id),
+                'score': float(score or 0)
+            })
+    
+    if 'deals' in types:
+        view_scope = resolve_view_scope(current_user, request.args.get('view_scope'))
+        query = apply_scope_to_query(Deal.query.options(joinedload(Deal.company)), current_user, view_scope)
+        for deal, score in ranked_search(query, 'deals', term).limit(limit).all():
+            results.append({
+                'type': 'deal',
+                'id': deal.id,
+                'title': deal.title,
+                'subtitle': deal.company.name if deal.company else '',
+                'url': url_for('view_deal', id=deal.id),
+                'score': float(score or 0)
+            })
+    
+    if 'contacts' in types:
+        query = Contact.query.options(joinedload(Contact.company))
+        for contact, score in ranked_search(query, 'contacts', term).limit(limit).all():
+            results.append({
+                'type': 'contact',
+                'id': contact.id,
+                'title': contact.name,
+                'subtitle': contact.company.name if contact.company else '',
+                'url': url_for('edit_contact', id=contact.id),
+                'score': float(score or 0)
+            })
+    
+    if 'tasks' in types:
+        for task, score in ranked_search(Task.query, 'tasks', term).limit(limit).all():
+            results.append({
+                'type': 'task',
+                'id': task.id,
+                'title': task.title,
+                'subtitle': task.deal_name or '',
+                'url': url_for('edit_task', id=task.id),
+                'score': float(score or 0)
+            })
+    
+    results.sort(key=lambda r: r['score'], reverse=True)
+    return jsonify({'query': term, 'results': results})
+
 @app.route('/api/dashboard-data')
 @login_required
 def api_dashboard_data():
@@ -3267,6 +3739,61 @@ def api_dashboard_data():
         'tasks_by_status': [{'status': status, 'count': count} for status, count in tasks_by_status]
     })
 
+# ダッシュボードKPIのキャッシュ（案件・活動の追加/更新/削除をコミットした時点で消去）
+DASHBOARD_CACHE_TTL = 60
+dashboard_cache = TTLCache(ttl=DASHBOARD_CACHE_TTL)
+clear_on_commit(dashboard_cache, Deal, Activity)
+
+# 分析APIのレスポンスキャッシュ
+# キーに案件・企業・活動のバージョンを含め、更新のコミット時にバージョンを上げて古い結果を使わない
+ANALYTICS_CACHE_TTL = 600
+analytics_cache = TTLCache(ttl=ANALYTICS_CACHE_TTL, maxsize=1024)
+analytics_versions = DataVersions()
+bump_on_commit(analytics_versions, 'deals', Deal, DealStageTransition)
+bump_on_commit(analytics_versions, 'companies', Company)
+bump_on_commit(analytics_versions, 'activities', Activity)
+ANALYTICS_DATA = ('deals', 'companies', 'activities')
+
+
+def analytics_cache_key(endpoint, args):
+    """分析結果のキャッシュキー（エンドポイント・条件・表示範囲・データのバージョン・日付）"""
+    from datetime import date
+    
+    view_scope = resolve_view_scope(current_user, args.get('view_scope'))
+    return make_cache_key(
+        endpoint, date.today(), analytics_versions.get(*ANALYTICS_DATA),
+        view_scope, view_scope_owner(current_user, view_scope),
+        **args
+    )
+
+
+def cached_analytics(f):
+    """
+    分析APIのレスポンスをキャッシュし、ETagを付けて返す
+    
+    ブラウザは If-None-Match で再検証し、結果が変わっていなければ 304 を受け取る。
+    """
+    from werkzeug.http import generate_etag
+    
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        cache_key = analytics_cache_key(request.endpoint, request.args.to_dict())
+        entry = analytics_cache.get(cache_key)
+        if entry is None:
+            response = app.make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            entry = (body, response.mimetype, generate_etag(body))
+            analytics_cache.set(cache_key, entry)
+        
+        body, mimetype, etag = entry
+        response = app.response_class(body, mimetype=mimetype)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
+    return wrapped
+
 @app.route('/api/dashboard-kpis')
 @login_required
 def api_dashboard_kpis():
@@ -3353,219 +3880,120 @@ def api_dashboard_kpis():
         last_revenue_month_end = last_period_end_temp.strftime('%Y-%m')
     
     if period in ['current_month', 'last_month']:
-        current_month_revenue = db.session.query(
-            db.func.coalesce(db.func.sum(Deal.amount), 0)
-        ).filter(
-            db.or_(Deal.status == '受注', Deal.status == 'WON'),
-            Deal.revenue_month == current_revenue_month
-        ).scalar()
-        
-        last_month_revenue = db.session.query(
-            db.func.coalesce(db.func.sum(Deal.amount), 0)
-        ).filter(
-            db.or_(Deal.status == '受注', Deal.status == 'WON'),
-            Deal.revenue_month == last_revenue_month
-        ).scalar()
-    else:
-        # For year/custom, filter by revenue_month range (using >= and <=)
-        current_month_revenue = db.session.query(
-            db.func.coalesce(db.func.sum(Deal.amount), 0)
-        ).filter(
-            db.or_(Deal.status == '受注', Deal.status == 'WON'),
-            Deal.revenue_month >= current_revenue_month_start,
-            Deal.revenue_month <= current_revenue_month_end
-        ).scalar()
-        
-        last_month_revenue = db.session.query(
-            db.func.coalesce(db.func.sum(Deal.amount), 0)
-        ).filter(
-            db.or_(Deal.status == '受注', Deal.status == 'WON'),
-            Deal.revenue_month >= last_revenue_month_start,
-            Deal.revenue_month <= last_revenue_month_end
-        ).scalar()
-    
-    # Pipeline value by stage - filtered by revenue_month period (consistent with revenue filtering)
-    pipeline_filter = db.or_(Deal.status == '進行中', Deal.status == 'OPEN')
-    
-    if period in ['current_month', 'last_month']:
-        # Filter by revenue_month for monthly view (exact match, no NULL)
-        current_revenue_month = current_period_start.strftime('%Y-%m')
-        pipeline_by_stage = db.session.query(
-            Deal.stage, 
-            db.func.sum(Deal.amount).label('total')
-        ).filter(
-            pipeline_filter,
-            db.or_(
-                Deal.revenue_month == current_revenue_month,
-                Deal.revenue_month.is_(None)
-            )
-        ).group_by(Deal.stage).all()
+        current_months = (current_revenue_month, current_revenue_month)
+        last_months = (last_revenue_month, last_revenue_month)
     else:
-        # For year/custom, filter by revenue_month range (include NULL for open deals)
-        pipeline_by_stage = db.session.query(
-            Deal.stage, 
-            db.func.sum(Deal.amount).label('total')
-        ).filter(
-            pipeline_filter,
-            db.or_(
-                db.and_(Deal.revenue_month >= current_revenue_month_start, Deal.revenue_month <= current_revenue_month_end),
-                Deal.revenue_month.is_(None)
-            )
-        ).group_by(Deal.stage).all()
+        current_months = (current_revenue_month_start, current_revenue_month_end)
+        last_months = (last_revenue_month_start, last_revenue_month_end)
     
-    total_pipeline = sum(stage[1] for stage in pipeline_by_stage if stage[1])
+    # 表示範囲（view_scope指定時のみ絞り込み、未指定は全案件）
+    requested_scope = request.args.get('view_scope')
+    view_scope = resolve_view_scope(current_user, requested_scope) if requested_scope else 'all'
     
-    # Active deals count - same period filter as pipeline (using revenue_month, include NULL)
-    if period in ['current_month', 'last_month']:
-        current_revenue_month = current_period_start.strftime('%Y-%m')
-        active_deals = Deal.query.filter(
-            pipeline_filter,
-            db.or_(Deal.revenue_month == current_revenue_month, Deal.revenue_month.is_(None))
-        ).count()
-        won_deals = Deal.query.filter(
-            db.or_(Deal.status == '受注', Deal.status == 'WON'),
-            Deal.revenue_month == current_revenue_month
-        ).count()
-        lost_deals = Deal.query.filter(
-            db.or_(Deal.status == '失注', Deal.status == 'LOST'),
-            Deal.revenue_month == current_revenue_month
-        ).count()
+    cache_key = make_cache_key(
+        'dashboard_kpis', period, current_period_start, current_period_end,
+        view_scope, view_scope_owner(current_user, view_scope)
+    )
+    cached = dashboard_cache.get(cache_key)
+    if cached is not None:
+        return jsonify(cached)
+    
+    is_won = Deal.status.in_(['受注', 'WON'])
+    is_lost = Deal.status.in_(['失注', 'LOST'])
+    is_open = Deal.status.in_(['進行中', 'OPEN'])
+    in_current_months = Deal.revenue_month.between(*current_months)
+    in_last_months = Deal.revenue_month.between(*last_months)
+    # パイプラインは計上月が期間内または未設定の進行中案件
+    current_pipeline = db.and_(is_open, db.or_(in_current_months, Deal.revenue_month.is_(None)))
+    last_pipeline = db.and_(is_open, db.or_(in_last_months, Deal.revenue_month.is_(None)))
+    
+    def count_if(condition):
+        return db.func.sum(db.case((condition, 1), else_=0))
+    
+    def sum_if(condition, value):
+        return db.func.sum(db.case((condition, value), else_=0))
+    
+    # 案件側の指標はステージ別の1回の集計で求める（ステージ別パイプライン以外は合算）
+    stage_query = db.session.query(
+        Deal.stage,
+        sum_if(db.and_(is_won, in_current_months), Deal.amount),
+        sum_if(db.and_(is_won, in_last_months), Deal.amount),
+        sum_if(current_pipeline, Deal.amount),
+        count_if(current_pipeline),
+        sum_if(last_pipeline, Deal.amount),
+        count_if(db.and_(is_won, in_current_months)),
+        count_if(db.and_(is_lost, in_current_months)),
+        count_if(db.and_(is_won, in_last_months)),
+        count_if(db.and_(is_lost, in_last_months)),
+        count_if(date_range_condition(Deal.created_at, current_period_start, current_period_end)),
+        count_if(date_range_condition(Deal.created_at, last_period_start, last_period_end)),
+        sum_if(is_open, Deal.amount)
+    )
+    stage_query = apply_scope_to_query(stage_query, current_user, view_scope)
+    stage_rows = stage_query.group_by(Deal.stage).all()
+    
+    totals = [sum(row[i] or 0 for row in stage_rows) for i in range(1, 13)]
+    (current_month_revenue, last_month_revenue, total_pipeline, active_deals, last_pipeline_total,
+     won_deals, lost_deals, last_won_deals, last_lost_deals,
+     new_leads_count, last_new_leads_count, open_pipeline_total) = totals
+    
+    # パイプラインの前期比較: 期間末時点の進行中案件の金額を日次スナップショットで比較する
+    # （今日以降は現在の案件、過去はその日以前で最新のスナップショット。無い場合は計上月から推定）
+    snapshot_conditions = snapshot_scope_conditions(current_user, view_scope)
+    
+    def pipeline_at(day):
+        if day >= today:
+            return {'snapshot_date': today, 'amount_sum': open_pipeline_total}
+        return pipeline_snapshot_total(day, snapshot_conditions)
+    
+    pipeline_compare_end = pipeline_at(current_period_end)
+    pipeline_compare_start = pipeline_at(last_period_end)
+    if pipeline_compare_end and pipeline_compare_start:
+        pipeline_compare_value = pipeline_compare_end['amount_sum']
+        pipeline_compare_date = pipeline_compare_end['snapshot_date'].isoformat()
+        last_pipeline_total = pipeline_compare_start['amount_sum']
+        last_pipeline_date = pipeline_compare_start['snapshot_date'].isoformat()
     else:
-        active_deals = Deal.query.filter(
-            pipeline_filter,
-            db.or_(
-                db.and_(Deal.revenue_month >= current_revenue_month_start, Deal.revenue_month <= current_revenue_month_end),
-                Deal.revenue_month.is_(None)
-            )
-        ).count()
-        won_deals = Deal.query.filter(
-            db.or_(Deal.status == '受注', Deal.status == 'WON'),
-            Deal.revenue_month >= current_revenue_month_start,
-            Deal.revenue_month <= current_revenue_month_end
-        ).count()
-        lost_deals = Deal.query.filter(
-            db.or_(Deal.status == '失注', Deal.status == 'LOST'),
-            Deal.revenue_month >= current_revenue_month_start,
-            Deal.revenue_month <= current_revenue_month_end
-        ).count()
+        pipeline_compare_value = total_pipeline
+        pipeline_compare_date = None
+        last_pipeline_date = None
+    
+    # ステージ滞留30日以上の進行中案件（status, stage_entered_at のインデックスでCOUNT）
+    stale_count = apply_scope_to_query(
+        db.session.query(db.func.count(Deal.id)).filter(stale_deal_condition()),
+        current_user, view_scope
+    ).scalar() or 0
+    pipeline_by_stage = [(row[0], row[3] or 0) for row in stage_rows if row[4]]
     
     # Win rate
     total_closed = won_deals + lost_deals
     win_rate = (won_deals / total_closed * 100) if total_closed > 0 else 0
     
     # Top companies by deal value - same period filter as pipeline (include NULL)
-    if period in ['current_month', 'last_month']:
-        current_revenue_month = current_period_start.strftime('%Y-%m')
-        top_companies = db.session.query(
-            Company.id,
-            Company.name,
-            db.func.sum(Deal.amount).label('total_value'),
-            db.func.count(Deal.id).label('deal_count')
-        ).join(Deal).filter(
-            pipeline_filter,
-            db.or_(Deal.revenue_month == current_revenue_month, Deal.revenue_month.is_(None))
-        ).group_by(Company.id, Company.name).order_by(
-            db.text('total_value DESC')
-        ).limit(5).all()
-    else:
-        top_companies = db.session.query(
-            Company.id,
-            Company.name,
-            db.func.sum(Deal.amount).label('total_value'),
-            db.func.count(Deal.id).label('deal_count')
-        ).join(Deal).filter(
-            pipeline_filter,
-            db.or_(
-                db.and_(Deal.revenue_month >= current_revenue_month_start, Deal.revenue_month <= current_revenue_month_end),
-                Deal.revenue_month.is_(None)
-            )
-        ).group_by(Company.id, Company.name).order_by(
-            db.text('total_value DESC')
-        ).limit(5).all()
-    
-    # Deals with long stage duration (30+ days)
-    stale_deals = Deal.query.filter(
-        Deal.status == '進行中',
-        Deal.stage_entered_at != None
-    ).all()
-    
-    stale_count = sum(1 for deal in stale_deals if deal.days_in_stage and deal.days_in_stage >= 30)
-    
-    # Activities in selected period - use raw SQL to avoid "count" column conflict
-    activities_sql = db.text("""
-        SELECT COUNT(*) FROM activities
-        WHERE happened_at >= :start_date AND happened_at <= :end_date
-    """)
-    activities_count = db.session.execute(activities_sql, {
-        'start_date': current_period_start,
-        'end_date': current_period_end
-    }).scalar() or 0
-    
-    # New leads (deals created in the period)
-    new_leads_count = Deal.query.filter(
-        Deal.created_at >= datetime.combine(current_period_start, datetime.min.time()),
-        Deal.created_at <= datetime.combine(current_period_end, datetime.max.time())
-    ).count()
-    
-    # Last period new leads for comparison
-    last_new_leads_count = Deal.query.filter(
-        Deal.created_at >= datetime.combine(last_period_start, datetime.min.time()),
-        Deal.created_at <= datetime.combine(last_period_end, datetime.max.time())
-    ).count()
-    
-    # Last period pipeline value for comparison
-    if period in ['current_month', 'last_month']:
-        last_revenue_month = last_period_start.strftime('%Y-%m')
-        last_pipeline_by_stage = db.session.query(
-            db.func.sum(Deal.amount).label('total')
-        ).filter(
-            pipeline_filter,
-            db.or_(Deal.revenue_month == last_revenue_month, Deal.revenue_month.is_(None))
-        ).scalar()
-        last_pipeline_total = float(last_pipeline_by_stage) if last_pipeline_by_stage else 0
-        
-        # Last period win rate
-        last_won_deals = Deal.query.filter(
-            db.or_(Deal.status == '受注', Deal.status == 'WON'),
-            Deal.revenue_month == last_revenue_month
-        ).count()
-        last_lost_deals = Deal.query.filter(
-            db.or_(Deal.status == '失注', Deal.status == 'LOST'),
-            Deal.revenue_month == last_revenue_month
-        ).count()
-    else:
-        last_pipeline_by_stage = db.session.query(
-            db.func.sum(Deal.amount).label('total')
-        ).filter(
-            pipeline_filter,
-            db.or_(
-                db.and_(Deal.revenue_month >= last_revenue_month_start, Deal.revenue_month <= last_revenue_month_end),
-                Deal.revenue_month.is_(None)
-            )
-        ).scalar()
-        last_pipeline_total = float(last_pipeline_by_stage) if last_pipeline_by_stage else 0
-        
-        # Last period win rate
-        last_won_deals = Deal.query.filter(
-            db.or_(Deal.status == '受注', Deal.status == 'WON'),
-            Deal.revenue_month >= last_revenue_month_start,
-            Deal.revenue_month <= last_revenue_month_end
-        ).count()
-        last_lost_deals = Deal.query.filter(
-            db.or_(Deal.status == '失注', Deal.status == 'LOST'),
-            Deal.revenue_month >= last_revenue_month_start,
-            Deal.revenue_month <= last_revenue_month_end
-        ).count()
+    top_companies_query = db.session.query(
+        Company.id,
+        Company.name,
+        db.func.sum(Deal.amount).label('total_value'),
+        db.func.count(Deal.id).label('deal_count')
+    ).join(Deal).filter(current_pipeline)
+    top_companies = apply_scope_to_query(top_companies_query, current_user, view_scope).group_by(
+        Company.id, Company.name
+    ).order_by(db.text('total_value DESC')).limit(5).all()
+    
+    # Activities in selected period
+    activities_count = db.session.query(db.func.count(Activity.id)).filter(
+        date_range_condition(Activity.happened_at, current_period_start, current_period_end)
+    ).scalar() or 0
     
     last_total_closed = last_won_deals + last_lost_deals
     last_win_rate = (last_won_deals / last_total_closed * 100) if last_total_closed > 0 else 0
     
     # Calculate growth rates
-    pipeline_growth = ((total_pipeline - last_pipeline_total) / last_pipeline_total * 100) if last_pipeline_total > 0 else 0
+    pipeline_growth = ((pipeline_compare_value - last_pipeline_total) / last_pipeline_total * 100) if last_pipeline_total > 0 else 0
     win_rate_change = win_rate - last_win_rate
     new_leads_growth = ((new_leads_count - last_new_leads_count) / last_new_leads_count * 100) if last_new_leads_count > 0 else 0
     
-    return jsonify({
+    result = {
         'revenue': {
             'current_month': float(current_month_revenue) if current_month_revenue else 0,
             'last_month': float(last_month_revenue) if last_month_revenue else 0,
@@ -3573,7 +4001,11 @@ def api_dashboard_kpis():
         },
         'pipeline': {
             'total_value': float(total_pipeline) if total_pipeline else 0,
-            'last_value': last_pipeline_total,
+            # growth_rate は last_value → compare_value の増減（スナップショット比較時は計上月で絞り込まない期間末の進行中金額）
+            'compare_value': float(pipeline_compare_value) if pipeline_compare_value else 0,
+            'compare_date': pipeline_compare_date,
+            'last_value': float(last_pipeline_total),
+            'last_snapshot_date': last_pipeline_date,
             'growth_rate': round(pipeline_growth, 1),
             'active_deals': active_deals,
             'by_stage': [{'stage': stage, 'value': float(value)} for stage, value in pipeline_by_stage]
@@ -3588,7 +4020,7 @@ def api_dashboard_kpis():
         'top_companies': [{
             'id': comp[0],
             'name': comp[1],
-            'value': float(comp[2]),
+            'value': float(comp[2] or 0),
             'deal_count': comp[3]
         } for comp in top_companies],
         'alerts': {
@@ -3600,7 +4032,9 @@ def api_dashboard_kpis():
         'new_leads': new_leads_count,
         'new_leads_last': last_new_leads_count,
         'new_leads_growth': round(new_leads_growth, 1)
-    })
+    }
+    dashboard_cache.set(cache_key, result)
+    return jsonify(result)
 
 @app.route('/api/dashboard/revenue-by-assignee')
 @login_required
@@ -3627,30 +4061,24 @@ def api_revenue_by_assignee():
         period_start = date(today.year, today.month, 1)
         period_end = today
     
-    # Query revenue by assignee
-    query = db.session.query(
-        User.id,
-        User.name,
-        db.func.sum(Deal.amount).label('total_revenue'),
-        db.func.count(Deal.id).label('deal_count')
-    ).join(Deal, Deal.assignee_id == User.id).filter(
-        Deal.status == 'WON',
-        db.func.date(Deal.closed_at) >= period_start,
-        db.func.date(Deal.closed_at) <= period_end
-    ).group_by(User.id, User.name).order_by(db.text('total_revenue DESC'))
-    
-    results = query.all()
+    # 担当者別の受注額（キューブ集計。月単位の部分は deal_metrics_monthly から集計）
+    metrics = label_dimensions([
+        m for m in run_cube(['assignee'], ['won', 'revenue'], period_start, period_end)
+        if m['assignee'] is not None and m['won']
+    ], ['assignee'])
+    metrics = [m for m in metrics if m['assignee_name'] is not None]
+    metrics.sort(key=lambda m: m['revenue'], reverse=True)
     
     return jsonify({
         'period': period,
         'period_start': period_start.isoformat(),
         'period_end': period_end.isoformat(),
         'data': [{
-            'user_id': r[0],
-            'user_name': r[1],
-            'total_revenue': float(r[2]) if r[2] else 0,
-            'deal_count': r[3]
-        } for r in results]
+            'user_id': m['assignee'],
+            'user_name': m['assignee_name'],
+            'total_revenue': float(m['revenue']) if m['revenue'] else 0,
+            'deal_count': m['won']
+        } for m in metrics]
     })
 
 @app.route('/api/dashboard/revenue-by-month')
@@ -3678,39 +4106,70 @@ def api_revenue_by_month():
         period_start = date(today.year, 1, 1)
         period_end = today
     
-    # Query revenue by month (compatible with both SQLite and PostgreSQL)
-    db_url = app.config['SQLALCHEMY_DATABASE_URI']
-    is_postgres = 'postgresql' in db_url if db_url else False
-    
-    if is_postgres:
-        # PostgreSQL: use to_char
-        month_expr = db.func.to_char(Deal.closed_at, 'YYYY-MM')
-    else:
-        # SQLite: use strftime
-        month_expr = db.func.strftime('%Y-%m', Deal.closed_at)
+    # 月別の受注額（キューブ集計。月単位の部分は deal_metrics_monthly から集計）
+    metrics = sorted(
+        (m for m in run_cube(['month'], ['won', 'revenue'], period_start, period_end) if m['won']),
+        key=lambda m: m['month']
+    )
     
-    query = db.session.query(
-        month_expr.label('month'),
-        db.func.sum(Deal.amount).label('total_revenue'),
-        db.func.count(Deal.id).label('deal_count')
-    ).filter(
-        Deal.status == 'WON',
-        db.func.date(Deal.closed_at) >= period_start,
-        db.func.date(Deal.closed_at) <= period_end
-    ).group_by('month').order_by('month')
+    return jsonify({
+        'period': period,
+        'period_start': period_start.isoformat(),
+        'period_end': period_end.isoformat(),
+        'data': [{
+            'month': m['month'],
+            'total_revenue': float(m['revenue']) if m['revenue'] else 0,
+            'deal_count': m['won']
+        } for m in metrics]
+    })
+
+# パイプライン推移の最大日数と内訳（group_by → スナップショットのカラム）
+PIPELINE_TREND_MAX_DAYS = 730
+PIPELINE_TREND_GROUPS = {'stage': 'stage', 'team': 'team_id', 'assignee': 'assignee_id'}
+
+@app.route('/api/dashboard/pipeline-trend')
+@login_required
+def api_pipeline_trend():
+    """
+    パイプライン（進行中案件の件数・金額）の日次推移（?days=90&group_by=stage&view_scope=...）
     
-    results = query.all()
+    日次スナップショット（pipeline_snapshots）をスナップショット日の範囲で読む。
+    """
+    from datetime import date, timedelta
+    
+    days = min(max(request.args.get('days', 90, type=int), 1), PIPELINE_TREND_MAX_DAYS)
+    group_by = request.args.get('group_by')
+    if group_by and group_by not in PIPELINE_TREND_GROUPS:
+        return jsonify({'error': f"group_by は {' / '.join(PIPELINE_TREND_GROUPS)} のいずれかを指定してください"}), 400
+    requested_scope = request.args.get('view_scope')
+    view_scope = resolve_view_scope(current_user, requested_scope) if requested_scope else 'all'
+    
+    end_date = date.today()
+    start_date = end_date - timedelta(days=days - 1)
+    conditions = snapshot_scope_conditions(current_user, view_scope)
+    group_column = PIPELINE_TREND_GROUPS[group_by] if group_by else None
+    
+    totals = {}
+    groups = {}
+    for row in pipeline_trend(start_date, end_date, group_column, conditions):
+        snapshot_date = row[0].isoformat()
+        total = totals.setdefault(snapshot_date, {'date': snapshot_date, 'deal_count': 0, 'amount': 0.0})
+        total['deal_count'] += row[-2] or 0
+        total['amount'] += float(row[-1] or 0)
+        if group_column:
+            groups.setdefault(row[1], []).append({
+                'date': snapshot_date, 'deal_count': row[-2] or 0, 'amount': float(row[-1] or 0)
+            })
     
-    return jsonify({
-        'period': period,
-        'period_start': period_start.isoformat(),
-        'period_end': period_end.isoformat(),
-        'data': [{
-            'month': r[0],
-            'total_revenue': float(r[1]) if r[1] else 0,
-            'deal_count': r[2]
-        } for r in results]
-    })
+    result = {
+        'period_start': start_date.isoformat(),
+        'period_end': end_date.isoformat(),
+        'view_scope': view_scope,
+        'data': list(totals.values())
+    }
+    if group_column:
+        result['groups'] = [{'key': key, 'data': series} for key, series in groups.items()]
+    return jsonify(result)
 
 # ============================================================
 # Activities API
@@ -3723,72 +4182,7 @@ def export_activities():
     guard = ensure_import_export_permission('companies')
     if guard:
         return guard
-    format_type = request.args.get('format', 'csv')  # csv or excel
-    company_id = request.args.get('company_id', '')
-    
-    query = Activity.query.join(Company).join(User)
-    
-    # 企業IDでフィルタ（指定されている場合）
-    if company_id:
-        try:
-            query = query.filter(Activity.company_id == int(company_id))
-        except ValueError:
-            pass
-    
-    # 日付範囲でフィルタ（オプション）
-    from_date = request.args.get('from_date', '')
-    to_date = request.args.get('to_date', '')
-    
-    if from_date:
-        try:
-            from_dt = datetime.strptime(from_date, '%Y-%m-%d')
-            query = query.filter(db.func.date(Activity.happened_at) >= from_dt.date())
-        except ValueError:
-            pass
-    
-    if to_date:
-        try:
-            to_dt = datetime.strptime(to_date, '%Y-%m-%d')
-            query = query.filter(db.func.date(Activity.happened_at) <= to_dt.date())
-        except ValueError:
-            pass
-    
-    # 活動タイプでフィルタ（オプション）
-    activity_type = request.args.get('type', '')
-    if activity_type:
-        query = query.filter(Activity.type == activity_type)
-    
-    activities_list = query.order_by(Activity.happened_at.desc()).all()
-    
-    # ファイル名に現在の日時を含める
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    
-    if format_type == 'excel':
-        excel_file = export_activities_to_excel(activities_list)
-        filename = f'活動履歴_{timestamp}.xlsx'
-        if company_id:
-            company = Company.query.get(company_id)
-            if company:
-                filename = f'活動履歴_{company.name}_{timestamp}.xlsx'
-        
-        return send_file(
-            excel_file,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
-        )
-    else:
-        csv_data = export_activities_to_csv(activities_list)
-        filename = f'活動履歴_{timestamp}.csv'
-        if company_id:
-            company = Company.query.get(company_id)
-            if company:
-                filename = f'活動履歴_{company.name}_{timestamp}.csv'
-        
-        response = make_response(csv_data)
-        response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-        response.headers['Content-Disposition'] = f'attachment; filename={filename}'
-        return response
+    return export_response('activities')
 
 @app.route('/api/companies/<int:company_id>/activities', methods=['GET'])
 @login_required
@@ -4234,8 +4628,10 @@ def close_deal(deal_id):
             deal.win_reason_detail = None
         
         # Update deal status and closed_at
+        old_status = deal.status
         deal.status = status
         deal.closed_at = datetime.utcnow()
+        record_deal_changes(deal, deal.stage, old_status, current_user.id, at=deal.closed_at)
         
         db.session.commit()
         
@@ -4259,6 +4655,7 @@ def close_deal(deal_id):
 
 @app.route('/api/analytics/win_rate', methods=['GET'])
 @login_required
+@cached_analytics
 def analytics_win_rate():
     """Get win rate analytics for a period"""
     try:
@@ -4290,23 +4687,16 @@ def analytics_win_rate():
             current_period_start = date(today.year, today.month, 1)
             current_period_end = today
         
-        # Build query
-        # Use date comparison to include full day
-        query = Deal.query.filter(
-            Deal.status.in_(['WON', 'LOST']),
-            db.func.date(Deal.closed_at) >= current_period_start,
-            db.func.date(Deal.closed_at) <= current_period_end
-        )
-        
-        deals = query.all()
+        # 受注・失注件数（キューブ集計。月単位の部分は deal_metrics_monthly から集計）
+        totals = run_cube([], ['won', 'lost', 'win_rate'], current_period_start, current_period_end)
+        totals = totals[0] if totals else {'won': 0, 'lost': 0, 'win_rate': 0}
         
-        won = sum(1 for d in deals if d.status == 'WON')
-        lost = sum(1 for d in deals if d.status == 'LOST')
+        won = totals['won']
+        lost = totals['lost']
         total_closed = won + lost
-        win_rate = (won / total_closed) if total_closed > 0 else 0
         
         return jsonify({
-            'win_rate': round(win_rate, 4),
+            'win_rate': totals['win_rate'],
             'won': won,
             'lost': lost,
             'total_closed': total_closed
@@ -4316,6 +4706,7 @@ def analytics_win_rate():
 
 @app.route('/api/analytics/win_reasons', methods=['GET'])
 @login_required
+@cached_analytics
 def analytics_win_reasons():
     """Get win reasons distribution"""
     try:
@@ -4354,8 +4745,7 @@ def analytics_win_reasons():
         ).filter(
             Deal.status == 'WON',
             Deal.win_reason_category.isnot(None),
-            db.func.date(Deal.closed_at) >= current_period_start,
-            db.func.date(Deal.closed_at) <= current_period_end
+            date_range_condition(Deal.closed_at, current_period_start, current_period_end)
         )
         
         results = query.group_by(Deal.win_reason_category).order_by(db.text('count DESC')).all()
@@ -4368,6 +4758,7 @@ def analytics_win_reasons():
 
 @app.route('/api/analytics/loss_reasons', methods=['GET'])
 @login_required
+@cached_analytics
 def analytics_loss_reasons():
     """Get loss reasons distribution"""
     try:
@@ -4406,8 +4797,7 @@ def analytics_loss_reasons():
         ).filter(
             Deal.status == 'LOST',
             Deal.lost_reason_category.isnot(None),
-            db.func.date(Deal.closed_at) >= current_period_start,
-            db.func.date(Deal.closed_at) <= current_period_end
+            date_range_condition(Deal.closed_at, current_period_start, current_period_end)
         )
         
         results = query.group_by(Deal.lost_reason_category).order_by(db.text('count DESC')).all()
@@ -4420,6 +4810,7 @@ def analytics_loss_reasons():
 
 @app.route('/api/analytics/reasons_top5', methods=['GET'])
 @login_required
+@cached_analytics
 def analytics_reasons_top5():
     """Get top 5 win and loss reasons"""
     try:
@@ -4489,6 +4880,7 @@ def analytics_reasons_top5():
 
 @app.route('/api/analytics/industry/win_rate_ranking', methods=['GET'])
 @login_required
+@cached_analytics
 def industry_win_rate_ranking():
     """Get win rate ranking by industry"""
     try:
@@ -4519,35 +4911,12 @@ def industry_win_rate_ranking():
             from_date = date(today.year, today.month, 1)
             to_date = today
         
-        # Query deals with companies, filter by closed date and status
-        query = db.session.query(
-            Company.industry,
-            db.func.sum(db.case((Deal.status == 'WON', 1), else_=0)).label('won'),
-            db.func.sum(db.case((Deal.status == 'LOST', 1), else_=0)).label('lost')
-        ).join(Deal, Deal.company_id == Company.id).filter(
-            Deal.status.in_(['WON', 'LOST']),
-            Company.industry.isnot(None),
-            db.func.date(Deal.closed_at) >= from_date,
-            db.func.date(Deal.closed_at) <= to_date
-        ).group_by(Company.industry)
-        
-        results = query.all()
-        
-        # Calculate win rate and format data
-        data = []
-        for r in results:
-            industry = r[0]
-            won = r[1] or 0
-            lost = r[2] or 0
-            total = won + lost
-            win_rate = (won / total) if total > 0 else 0
-            
-            data.append({
-                'industry': industry,
-                'win_rate': round(win_rate, 4),
-                'won': won,
-                'lost': lost
-            })
+        # 業界別の受注・失注件数（キューブ集計。月単位の部分は deal_metrics_monthly から集計）
+        data = [
+            {'industry': m['industry'], 'win_rate': m['win_rate'], 'won': m['won'], 'lost': m['lost']}
+            for m in run_cube(['industry'], ['won', 'lost', 'win_rate'], from_date, to_date)
+            if m['industry'] is not None and m['won'] + m['lost'] > 0
+        ]
         
         # Sort by win_rate descending
         data.sort(key=lambda x: x['win_rate'], reverse=True)
@@ -4558,6 +4927,7 @@ def industry_win_rate_ranking():
 
 @app.route('/api/analytics/industry/avg_amount', methods=['GET'])
 @login_required
+@cached_analytics
 def industry_avg_amount():
     """Get average deal amount for a specific industry"""
     try:
@@ -4576,35 +4946,22 @@ def industry_avg_amount():
             from_date = date(today.year, today.month, 1)
             to_date = today
         
-        # Build query
-        query = db.session.query(
-            db.func.avg(Deal.amount).label('avg_amount'),
-            db.func.count(Deal.id).label('count')
-        ).join(Company, Deal.company_id == Company.id).filter(
-            Deal.status == 'WON',
-            db.func.date(Deal.closed_at) >= from_date,
-            db.func.date(Deal.closed_at) <= to_date
-        )
-        
-        # Add industry filter if specified
-        if industry:
-            query = query.filter(Company.industry == industry)
-        
-        result = query.first()
-        
-        avg_amount = float(result[0]) if result[0] else 0
-        count = result[1] or 0
+        # 受注件数・平均受注額（キューブ集計。月単位の部分は deal_metrics_monthly から集計）
+        totals = run_cube([], ['won', 'avg_amount'], from_date, to_date,
+                          filters={'industry': industry} if industry else None)
+        totals = totals[0] if totals else {'won': 0, 'avg_amount': 0}
         
         return jsonify({
             'industry': industry or 'すべて',
-            'avg_amount': round(avg_amount, 2),
-            'count': count
+            'avg_amount': round(float(totals['avg_amount']), 2),
+            'count': totals['won']
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/analytics/industry/win_rate', methods=['GET'])
 @login_required
+@cached_analytics
 def industry_win_rate():
     """Get win rate for a specific industry"""
     try:
@@ -4623,30 +4980,17 @@ def industry_win_rate():
             from_date = date(today.year, today.month, 1)
             to_date = today
         
-        # Build query
-        query = db.session.query(
-            db.func.sum(db.case((Deal.status == 'WON', 1), else_=0)).label('won'),
-            db.func.sum(db.case((Deal.status == 'LOST', 1), else_=0)).label('lost')
-        ).join(Company, Deal.company_id == Company.id).filter(
-            Deal.status.in_(['WON', 'LOST']),
-            db.func.date(Deal.closed_at) >= from_date,
-            db.func.date(Deal.closed_at) <= to_date
-        )
-        
-        # Add industry filter if specified
-        if industry:
-            query = query.filter(Company.industry == industry)
-        
-        result = query.first()
+        # 受注・失注件数（キューブ集計。月単位の部分は deal_metrics_monthly から集計）
+        totals = run_cube([], ['won', 'lost', 'win_rate'], from_date, to_date,
+                          filters={'industry': industry} if industry else None)
+        totals = totals[0] if totals else {'won': 0, 'lost': 0, 'win_rate': 0}
         
-        won = result[0] or 0
-        lost = result[1] or 0
-        total = won + lost
-        win_rate = (won / total) if total > 0 else 0
+        won = totals['won']
+        lost = totals['lost']
         
         return jsonify({
             'industry': industry or 'すべて',
-            'win_rate': round(win_rate, 4),
+            'win_rate': totals['win_rate'],
             'won': won,
             'lost': lost
         })
@@ -4655,6 +4999,7 @@ def industry_win_rate():
 
 @app.route('/api/analytics/industry/win_reasons', methods=['GET'])
 @login_required
+@cached_analytics
 def industry_win_reasons():
     """Get win reasons distribution for a specific industry"""
     try:
@@ -4680,8 +5025,7 @@ def industry_win_reasons():
         ).join(Company, Deal.company_id == Company.id).filter(
             Deal.status == 'WON',
             Deal.win_reason_category.isnot(None),
-            db.func.date(Deal.closed_at) >= from_date,
-            db.func.date(Deal.closed_at) <= to_date
+            date_range_condition(Deal.closed_at, from_date, to_date)
         )
         
         # Add industry filter if specified
@@ -4698,6 +5042,7 @@ def industry_win_reasons():
 
 @app.route('/api/analytics/industry/loss_reasons', methods=['GET'])
 @login_required
+@cached_analytics
 def industry_loss_reasons():
     """Get loss reasons distribution for a specific industry"""
     try:
@@ -4723,8 +5068,7 @@ def industry_loss_reasons():
         ).join(Company, Deal.company_id == Company.id).filter(
             Deal.status == 'LOST',
             Deal.lost_reason_category.isnot(None),
-            db.func.date(Deal.closed_at) >= from_date,
-            db.func.date(Deal.closed_at) <= to_date
+            date_range_condition(Deal.closed_at, from_date, to_date)
         )
         
         # Add industry filter if specified
@@ -4754,8 +5098,7 @@ def quotes():
 @login_required
 def new_quote():
     """New quote form"""
-    companies = Company.query.order_by(Company.name).all()
-    return render_template('quote_form.html', companies=companies)
+    return render_template('quote_form.html')
 
 @app.route('/quotes/<int:id>')
 @login_required
@@ -4775,8 +5118,7 @@ def edit_quote(id):
     if not quote:
         flash('見積が見つかりませんでした', 'error')
         return redirect(url_for('quotes'))
-    companies = Company.query.order_by(Company.name).all()
-    return render_template('quote_form.html', quote=quote, companies=companies)
+    return render_template('quote_form.html', quote=quote)
 
 @app.route('/api/quotes', methods=['POST'])
 @login_required
@@ -4990,8 +5332,7 @@ def invoices():
 @login_required
 def new_invoice():
     """New invoice form"""
-    companies = Company.query.order_by(Company.name).all()
-    return render_template('invoice_form.html', companies=companies)
+    return render_template('invoice_form.html')
 
 @app.route('/invoices/<int:id>')
 @login_required
@@ -5011,8 +5352,7 @@ def edit_invoice(id):
     if not invoice:
         flash('請求が見つかりませんでした', 'error')
         return redirect(url_for('invoices'))
-    companies = Company.query.order_by(Company.name).all()
-    return render_template('invoice_form.html', invoice=invoice, companies=companies)
+    return render_template('invoice_form.html', invoice=invoice)
 
 @app.route('/api/invoices', methods=['POST'])
 @login_required
@@ -5284,32 +5624,39 @@ def get_cross_tab_date_range():
     return start_date, end_date
 
 
-@app.route('/api/analytics/lead-source')
-@login_required
-def api_analytics_lead_source():
-    """Cross-tabulation: Lead Source × Results (Optimized with aggregation queries)"""
-    from models import LeadSource
-    
-    start_date, end_date = get_cross_tab_date_range()
+# 期間の案件集計（リードソース別・業界別・担当者別の分析で共有する軸と指標）
+PERIOD_DEAL_DIMENSIONS = ['lead_source', 'industry', 'assignee']
+PERIOD_DEAL_MEASURES = ['count', 'won', 'first_contact', 'revenue', 'avg_lead_time']
+
+
+def period_deal_stats(start_date, end_date, shared):
+    """
+    期間の案件をリードソース・業界・担当者の組み合わせごとに集計（キューブ集計1クエリ）
     
-    # Use aggregation query to avoid N+1
-    # Subquery for deals with outcomes in period (won or lost)
-    lead_source_stats = db.session.query(
-        Deal.lead_source_id,
-        db.func.count(Deal.id).label('total_deals'),
-        db.func.sum(db.case((Deal.status == 'WON', 1), else_=0)).label('won_count'),
-        db.func.sum(db.case((Deal.first_contact_date != None, 1), else_=0)).label('has_first_contact'),
-        db.func.sum(db.case((Deal.status == 'WON', Deal.amount), else_=0)).label('won_amount')
-    ).filter(
-        db.or_(
-            db.and_(Deal.status == 'WON', Deal.won_date >= start_date, Deal.won_date <= end_date),
-            db.and_(Deal.status == 'LOST', Deal.lost_date >= start_date, Deal.lost_date <= end_date),
-            db.and_(Deal.status == 'OPEN', Deal.created_at >= datetime.combine(start_date, datetime.min.time()))
-        )
-    ).group_by(Deal.lead_source_id).all()
+    リードソース別・業界別・担当者別の分析はこの結果を合算して求める。
+    shared に保持し、一括取得（/api/analytics/batch）では複数の分析で使い回す。
+    """
+    key = ('period_deal_stats', start_date, end_date)
+    if key not in shared:
+        shared[key] = query_cube(PERIOD_DEAL_DIMENSIONS, PERIOD_DEAL_MEASURES,
+                                 start_date, end_date, basis='outcome')
+    return shared[key]
+
+
+def sum_period_deal_stats(start_date, end_date, shared, dimension):
+    """period_deal_stats を1つの軸（lead_source / industry / assignee）で合算 → 軸の値: 指標"""
+    return {
+        item[dimension]: item
+        for item in summarize(period_deal_stats(start_date, end_date, shared),
+                              PERIOD_DEAL_DIMENSIONS, [dimension], PERIOD_DEAL_MEASURES)
+    }
+
+
+def analytics_lead_source_data(start_date, end_date, args, shared):
+    """Cross-tabulation: Lead Source × Results"""
+    from models import LeadSource
     
-    # Build lookup
-    stats_map = {s.lead_source_id: s for s in lead_source_stats}
+    stats_map = sum_period_deal_stats(start_date, end_date, shared, 'lead_source')
     
     # Get all lead sources
     lead_sources = LeadSource.query.order_by(LeadSource.sort_order).all()
@@ -5319,11 +5666,8 @@ def api_analytics_lead_source():
         stats = stats_map.get(ls.id)
         if not stats:
             continue
-            
-        total = stats.total_deals or 0
-        won = stats.won_count or 0
-        has_fc = stats.has_first_contact or 0
-        amount = stats.won_amount or 0
+        
+        total, won, has_fc, amount = stats['count'], stats['won'], stats['first_contact'], stats['revenue']
         
         results.append({
             'lead_source': ls.name,
@@ -5336,11 +5680,9 @@ def api_analytics_lead_source():
     
     # Add deals without lead_source
     unknown_stats = stats_map.get(None)
-    if unknown_stats and unknown_stats.total_deals > 0:
-        total = unknown_stats.total_deals or 0
-        won = unknown_stats.won_count or 0
-        has_fc = unknown_stats.has_first_contact or 0
-        amount = unknown_stats.won_amount or 0
+    if unknown_stats:
+        total, won, has_fc, amount = (unknown_stats['count'], unknown_stats['won'],
+                                      unknown_stats['first_contact'], unknown_stats['revenue'])
         results.append({
             'lead_source': '未設定',
             'lead_count': total,
@@ -5350,66 +5692,36 @@ def api_analytics_lead_source():
             'avg_ltv': 0
         })
     
-    return jsonify({'data': results, 'period': {'start': str(start_date), 'end': str(end_date)}})
+    return {'data': results, 'period': {'start': str(start_date), 'end': str(end_date)}}
 
 
-@app.route('/api/analytics/industry')
-@login_required
-def api_analytics_industry():
-    """Cross-tabulation: Industry × Win Rate / Revenue (Optimized)"""
-    start_date, end_date = get_cross_tab_date_range()
-    
-    # Use aggregation query with proper date filtering
-    industry_stats = db.session.query(
-        Company.industry,
-        db.func.count(Deal.id).label('total_deals'),
-        db.func.sum(db.case((Deal.status == 'WON', 1), else_=0)).label('won_count'),
-        db.func.sum(db.case((Deal.status == 'WON', Deal.amount), else_=0)).label('won_amount'),
-        db.func.avg(db.case(
-            (db.and_(Deal.status == 'WON', Deal.first_contact_date != None, Deal.won_date != None),
-             Deal.won_date - Deal.first_contact_date),
-            else_=None
-        )).label('avg_lead_time')
-    ).join(Company).filter(
-        Company.industry != None,
-        Company.industry != '',
-        db.or_(
-            db.and_(Deal.status == 'WON', Deal.won_date >= start_date, Deal.won_date <= end_date),
-            db.and_(Deal.status == 'LOST', Deal.lost_date >= start_date, Deal.lost_date <= end_date),
-            db.and_(Deal.status == 'OPEN', Deal.created_at >= datetime.combine(start_date, datetime.min.time()))
-        )
-    ).group_by(Company.industry).all()
-    
+def analytics_industry_data(start_date, end_date, args, shared):
+    """Cross-tabulation: Industry × Win Rate / Revenue"""
     results = []
-    for stats in industry_stats:
-        if not stats.industry:
+    for industry, stats in sum_period_deal_stats(start_date, end_date, shared, 'industry').items():
+        if not industry:
             continue
-            
-        total = stats.total_deals or 0
-        won = stats.won_count or 0
-        revenue = stats.won_amount or 0
+        
+        total, won, revenue = stats['count'], stats['won'], stats['revenue']
+        avg_lead_time = stats['avg_lead_time']
         
         results.append({
-            'industry': stats.industry,
+            'industry': industry,
             'deal_count': total,
             'win_rate': round(won / total * 100, 1) if total > 0 else 0,
             'total_revenue': revenue,
             'avg_amount': round(revenue / won) if won > 0 else 0,
-            'avg_lead_time_days': round(stats.avg_lead_time) if stats.avg_lead_time else None
+            'avg_lead_time_days': round(avg_lead_time) if avg_lead_time else None
         })
     
     # Sort by total_revenue desc
     results.sort(key=lambda x: x['total_revenue'], reverse=True)
     
-    return jsonify({'data': results, 'period': {'start': str(start_date), 'end': str(end_date)}})
+    return {'data': results, 'period': {'start': str(start_date), 'end': str(end_date)}}
 
 
-@app.route('/api/analytics/assignee-activity')
-@login_required
-def api_analytics_assignee_activity():
-    """Cross-tabulation: Assignee × Activity × Win Rate (Optimized)"""
-    start_date, end_date = get_cross_tab_date_range()
-    
+def analytics_assignee_activity_data(start_date, end_date, args, shared):
+    """Cross-tabulation: Assignee × Activity × Win Rate"""
     # Activity counts by user (using happened_at for period filtering)
     # Use raw SQL to avoid ORM issues with "count" column name
     activity_sql = db.text("""
@@ -5425,20 +5737,11 @@ def api_analytics_assignee_activity():
     activity_map = {row[0]: (row[1] or 0) for row in activity_result}
     
     # Deal stats by assignee (using won_date/lost_date for period filtering)
-    deal_stats = db.session.query(
-        Deal.assignee_id,
-        db.func.count(Deal.id).label('total_deals'),
-        db.func.sum(db.case((Deal.status == 'WON', 1), else_=0)).label('won_count'),
-        db.func.sum(db.case((Deal.status == 'WON', Deal.amount), else_=0)).label('won_amount')
-    ).filter(
-        Deal.assignee_id != None,
-        db.or_(
-            db.and_(Deal.status == 'WON', Deal.won_date >= start_date, Deal.won_date <= end_date),
-            db.and_(Deal.status == 'LOST', Deal.lost_date >= start_date, Deal.lost_date <= end_date),
-            db.and_(Deal.status == 'OPEN', Deal.created_at >= datetime.combine(start_date, datetime.min.time()))
-        )
-    ).group_by(Deal.assignee_id).all()
-    deal_map = {d.assignee_id: d for d in deal_stats}
+    deal_map = {
+        assignee_id: stats
+        for assignee_id, stats in sum_period_deal_stats(start_date, end_date, shared, 'assignee').items()
+        if assignee_id is not None
+    }
     
     # Get users with either activities or deals
     user_ids = set(activity_map.keys()) | set(deal_map.keys())
@@ -5447,11 +5750,8 @@ def api_analytics_assignee_activity():
     results = []
     for user in users:
         activity_count = activity_map.get(user.id, 0)
-        d_stats = deal_map.get(user.id)
-        
-        total_deals = d_stats.total_deals if d_stats else 0
-        won_count = d_stats.won_count if d_stats else 0
-        total_revenue = d_stats.won_amount if d_stats else 0
+        stats = deal_map.get(user.id, {'count': 0, 'won': 0, 'revenue': 0})
+        total_deals, won_count, total_revenue = stats['count'], stats['won'], stats['revenue']
         
         results.append({
             'assignee': user.name,
@@ -5463,174 +5763,204 @@ def api_analytics_assignee_activity():
             'total_revenue': total_revenue or 0
         })
     
-    return jsonify({'data': results, 'period': {'start': str(start_date), 'end': str(end_date)}})
+    return {'data': results, 'period': {'start': str(start_date), 'end': str(end_date)}}
 
 
-@app.route('/api/analytics/stage-funnel')
-@login_required
-def api_analytics_stage_funnel():
-    """Cross-tabulation: Stage Funnel Analysis (Optimized)"""
-    start_date, end_date = get_cross_tab_date_range()
-    
+def analytics_stage_funnel_data(start_date, end_date, args, shared):
+    """Cross-tabulation: Stage Funnel Analysis"""
     stage_order = ['リード', 'アポ', 'ヒアリング', '見積・提案', '最終調整', '受注', '失注']
     
-    # Use aggregation query for current stage distribution
-    stage_stats = db.session.query(
-        Deal.stage,
-        db.func.count(Deal.id).label('count'),
-        db.func.sum(Deal.amount).label('amount')
-    ).filter(
-        Deal.stage.in_(stage_order)
-    ).group_by(Deal.stage).all()
-    
-    stats_map = {s.stage: {'count': s.count or 0, 'amount': s.amount or 0} for s in stage_stats}
+    # ステージ遷移履歴から、期間内に各ステージに入った案件の件数・滞留日数・転換率を集計
+    funnel = stage_funnel(stage_order, start_date, end_date)
     
     results = []
     prev_count = None
     
     for stage_name in stage_order:
-        stats = stats_map.get(stage_name, {'count': 0, 'amount': 0})
+        stats = funnel.get(stage_name, {'count': 0, 'amount': 0, 'converted': 0,
+                                        'avg_days': None, 'median_days': None})
         count = stats['count']
-        amount = stats['amount']
         
         # Transition rate from previous stage
         transition_rate = None
         if prev_count is not None and prev_count > 0:
             transition_rate = round(count / prev_count * 100, 1)
         
+        # 次のステージ以降に進んだ割合（受注・失注は最終ステージのため無し）
+        conversion_rate = None
+        if stage_name not in ['受注', '失注'] and count > 0:
+            conversion_rate = round(stats['converted'] / count * 100, 1)
+        
         results.append({
             'stage': stage_name,
             'count': count,
-            'amount': amount,
+            'amount': stats['amount'],
             'transition_rate': transition_rate,
-            'avg_days': 0  # Simplified - avg stage time requires more complex query
+            'conversion_rate': conversion_rate,
+            'avg_days': stats['avg_days'] or 0,
+            'median_days': stats['median_days'] or 0
         })
         
         if stage_name not in ['受注', '失注']:
             prev_count = count
     
-    return jsonify({'data': results, 'period': {'start': str(start_date), 'end': str(end_date)}})
+    return {'data': results, 'period': {'start': str(start_date), 'end': str(end_date)}}
 
 
-@app.route('/api/analytics/lost-reason')
-@login_required
-def api_analytics_lost_reason():
-    """Cross-tabulation: Lost Reason × Industry / Assignee"""
-    start_date, end_date = get_cross_tab_date_range()
-    mode = request.args.get('mode', 'industry')  # 'industry' or 'assignee'
+def analytics_lost_reason_data(start_date, end_date, args, shared):
+    """
+    Cross-tabulation: Lost Reason × Industry / Assignee
+    
+    失注理由 × 業界（mode=industry）または担当者（mode=assignee）を1回のGROUP BYで集計し、
+    理由別の合計（data）とヒートマップ用の行列（matrix）を返す。
+    """
+    mode = args.get('mode', 'industry')  # 'industry' or 'assignee'
     
-    # Get lost deals - use closed_at or lost_date for filtering
-    lost_deals_query = Deal.query.filter(Deal.status == 'LOST')
+    reason = db.func.coalesce(Deal.lost_reason_category, '未設定')
+    if mode == 'industry':
+        dimension = db.func.coalesce(db.func.nullif(Company.industry, ''), '未設定')
+    else:
+        mode = 'assignee'
+        # 担当者（User）が無い場合は旧来の担当者名、どちらも無ければ未割当
+        dimension = db.func.coalesce(User.name, db.func.nullif(Deal.assignee, ''), '未割当')
+    
+    query = db.session.query(reason, dimension, db.func.count(Deal.id)).select_from(Deal)
+    if mode == 'industry':
+        query = query.outerjoin(Company, Company.id == Deal.company_id)
+    else:
+        query = query.outerjoin(User, User.id == Deal.assignee_id)
     
     # Filter by date range using closed_at or lost_date
-    lost_deals_query = lost_deals_query.filter(
+    rows = query.filter(
+        Deal.status == 'LOST',
         db.or_(
-            db.and_(Deal.closed_at.isnot(None), Deal.closed_at >= datetime.combine(start_date, datetime.min.time()), Deal.closed_at <= datetime.combine(end_date, datetime.max.time())),
+            db.and_(Deal.closed_at.isnot(None), date_range_condition(Deal.closed_at, start_date, end_date)),
             db.and_(Deal.lost_date.isnot(None), Deal.lost_date >= start_date, Deal.lost_date <= end_date),
             db.and_(Deal.closed_at.is_(None), Deal.lost_date.is_(None))  # Include deals without dates
         )
-    )
+    ).group_by(reason, dimension).all()
     
-    lost_deals = lost_deals_query.all()
+    reason_totals = {}
+    column_totals = {}
+    cells = {}
+    for reason_name, column, count in rows:
+        reason_totals[reason_name] = reason_totals.get(reason_name, 0) + count
+        column_totals[column] = column_totals.get(column, 0) + count
+        cells[(reason_name, column)] = count
     
-    if mode == 'industry':
-        # Group by lost_reason_category - simple count by reason
-        reason_counts = {}
-        for d in lost_deals:
-            reason = d.lost_reason_category or '未設定'
-            reason_counts[reason] = reason_counts.get(reason, 0) + 1
-        
-        # Format for JavaScript: expects 'reason' and 'count'
-        results = [{'reason': reason, 'count': count} for reason, count in reason_counts.items()]
-        results.sort(key=lambda x: x['count'], reverse=True)
-        
-    else:  # mode == 'assignee'
-        # Group by assignee, then by reason
-        assignee_reason_counts = {}
-        for d in lost_deals:
-            assignee_name = d.get_assignee_name() or '未割当'
-            reason = d.lost_reason_category or '未設定'
-            
-            if assignee_name not in assignee_reason_counts:
-                assignee_reason_counts[assignee_name] = {}
-            assignee_reason_counts[assignee_name][reason] = assignee_reason_counts[assignee_name].get(reason, 0) + 1
-        
-        # Flatten to reason counts across all assignees
-        reason_counts = {}
-        for assignee, reasons in assignee_reason_counts.items():
-            for reason, count in reasons.items():
-                reason_counts[reason] = reason_counts.get(reason, 0) + count
-        
-        # Format for JavaScript: expects 'reason' and 'count'
-        results = [{'reason': reason, 'count': count} for reason, count in reason_counts.items()]
-        results.sort(key=lambda x: x['count'], reverse=True)
+    # 件数の多い順（同数は名前順）
+    reasons = sorted(reason_totals, key=lambda name: (-reason_totals[name], name))
+    columns = sorted(column_totals, key=lambda name: (-column_totals[name], name))
+    
+    # Format for JavaScript: expects 'reason' and 'count'
+    results = [{'reason': name, 'count': reason_totals[name]} for name in reasons]
     
-    return jsonify({'data': results, 'mode': mode, 'period': {'start': str(start_date), 'end': str(end_date)}})
+    return {
+        'data': results,
+        'mode': mode,
+        'matrix': {
+            'reasons': reasons,
+            'columns': columns,
+            'counts': [[cells.get((name, column), 0) for column in columns] for name in reasons]
+        },
+        'period': {'start': str(start_date), 'end': str(end_date)}
+    }
 
 
-@app.route('/api/analytics/monthly-trend')
-@login_required
-def api_analytics_monthly_trend():
-    """Cross-tabulation: Monthly Trend (Revenue, New Customers, Win Rate)"""
-    from dateutil.relativedelta import relativedelta
-    from datetime import date
-    
-    months = int(request.args.get('months', 6))
-    today = date.today()
-    
-    results = []
-    for i in range(months - 1, -1, -1):
-        month_date = today - relativedelta(months=i)
-        month_str = month_date.strftime('%Y-%m')
-        month_start = date(month_date.year, month_date.month, 1)
-        if i == 0:
-            month_end = today
-        else:
-            month_end = (month_start + relativedelta(months=1)) - relativedelta(days=1)
-        
-        # Revenue (won deals with revenue_month)
-        revenue = db.session.query(db.func.coalesce(db.func.sum(Deal.amount), 0)).filter(
-            db.or_(Deal.status == 'WON', Deal.status == '受注'),
-            Deal.revenue_month == month_str
-        ).scalar() or 0
-        
-        # New customers (companies created in this month)
-        new_customers = Company.query.filter(
-            Company.created_at >= datetime.combine(month_start, datetime.min.time()),
-            Company.created_at <= datetime.combine(month_end, datetime.max.time())
-        ).count()
-        
-        # Win rate (closed deals in this month)
-        closed_deals = Deal.query.filter(
-            Deal.closed_at >= datetime.combine(month_start, datetime.min.time()),
-            Deal.closed_at <= datetime.combine(month_end, datetime.max.time())
-        ).all()
-        
-        won_count = len([d for d in closed_deals if d.status == 'WON'])
-        total_closed = len(closed_deals)
-        win_rate = round(won_count / total_closed * 100, 1) if total_closed > 0 else 0
-        
-        results.append({
-            'month': month_str,
-            'month_label': f"{month_date.year}年{month_date.month}月",
-            'revenue': revenue,
-            'new_customers': new_customers,
-            'win_rate': win_rate,
-            'won_count': won_count,
-            'closed_count': total_closed
-        })
-    
-    return jsonify({'data': results})
+# 月次推移の最大月数と、分割集計のキー（group_by → 案件のカラム, 名前の取得元）
+MONTHLY_TREND_MAX_MONTHS = 120
+MONTHLY_TREND_GROUPS = {
+    'team': ('team_id', Team),
+    'assignee': ('assignee_id', User),
+}
 
 
-@app.route('/api/analytics/kpi-summary')
-@login_required
-def api_analytics_kpi_summary():
-    """Enhanced KPI Summary for Cross-Tab Dashboard (Optimized)"""
+def analytics_monthly_trend_data(start_date, end_date, args, shared):
+    """Cross-tabulation: Monthly Trend (Revenue, New Customers, Win Rate)（期間ではなく months で指定）"""
+    from dateutil.relativedelta import relativedelta
     from datetime import date
     
-    start_date, end_date = get_cross_tab_date_range()
+    months = min(max(args.get('months', 6, type=int) or 6, 1), MONTHLY_TREND_MAX_MONTHS)
+    group_by = args.get('group_by')
+    if group_by and group_by not in MONTHLY_TREND_GROUPS:
+        raise ValueError('group_by は team または assignee を指定してください')
     
+    today = date.today()
+    first_month = date(today.year, today.month, 1) - relativedelta(months=months - 1)
+    month_keys = [(first_month + relativedelta(months=i)).strftime('%Y-%m') for i in range(months)]
+    group_column = MONTHLY_TREND_GROUPS[group_by][0] if group_by else None
+    
+    # 売上（受注案件の計上月ごと）: 1クエリ
+    revenue_columns = [Deal.revenue_month] + ([getattr(Deal, group_column)] if group_column else [])
+    revenue_rows = db.session.query(
+        *revenue_columns, db.func.coalesce(db.func.sum(Deal.amount), 0)
+    ).filter(
+        Deal.status.in_(['WON', '受注']),
+        Deal.revenue_month.between(month_keys[0], month_keys[-1])
+    ).group_by(*revenue_columns).all()
+    
+    # 新規顧客（企業の登録月ごと）: 1クエリ（企業は担当者・チームを持たないため合計のみ）
+    created_month = month_expr(Company.created_at)
+    new_customers = dict(db.session.query(created_month, db.func.count(Company.id)).filter(
+        date_range_condition(Company.created_at, first_month, today)
+    ).group_by(created_month).all())
+    
+    # 成約・受注件数（成約月ごと）: 月単位の部分は deal_metrics_monthly から集計
+    closed_metrics = deal_metrics(first_month, today, group_by=('month', 'status') + ((group_column,) if group_column else ()))
+    
+    def empty_series():
+        return {month: {'revenue': 0, 'won_count': 0, 'closed_count': 0} for month in month_keys}
+    
+    totals = empty_series()
+    groups = {}
+    for row in revenue_rows:
+        if row[0] not in totals:
+            continue
+        totals[row[0]]['revenue'] += row[-1]
+        if group_column:
+            groups.setdefault(row[1], empty_series())[row[0]]['revenue'] += row[-1]
+    for m in closed_metrics:
+        targets = [totals] + ([groups.setdefault(m[group_column], empty_series())] if group_column else [])
+        for series in targets:
+            series[m['month']]['closed_count'] += m['deal_count']
+            if m['status'] == 'WON':
+                series[m['month']]['won_count'] += m['deal_count']
+    
+    def format_series(series, with_new_customers):
+        data = []
+        for month in month_keys:
+            values = series[month]
+            year, month_number = month.split('-')
+            item = {
+                'month': month,
+                'month_label': f"{int(year)}年{int(month_number)}月",
+                'revenue': values['revenue'],
+                'win_rate': round(values['won_count'] / values['closed_count'] * 100, 1) if values['closed_count'] > 0 else 0,
+                'won_count': values['won_count'],
+                'closed_count': values['closed_count']
+            }
+            if with_new_customers:
+                item['new_customers'] = new_customers.get(month, 0)
+            data.append(item)
+        return data
+    
+    result = {'data': format_series(totals, True)}
+    if group_by:
+        model = MONTHLY_TREND_GROUPS[group_by][1]
+        keys = [key for key in groups if key is not None]
+        names = dict(db.session.query(model.id, model.name).filter(model.id.in_(keys)).all()) if keys else {}
+        result['group_by'] = group_by
+        result['groups'] = [{
+            'id': key,
+            'name': names.get(key, '未設定') if key is not None else '未設定',
+            'data': format_series(series, False)
+        } for key, series in sorted(groups.items(), key=lambda item: (item[0] is None, item[0] or 0))]
+    
+    return result
+
+
+def analytics_kpi_summary_data(start_date, end_date, args, shared):
+    """Enhanced KPI Summary for Cross-Tab Dashboard"""
     # Revenue (won in period by won_date, fallback to closed_at if NULL)
     revenue = db.session.query(db.func.coalesce(db.func.sum(Deal.amount), 0)).filter(
         Deal.status == 'WON',
@@ -5639,8 +5969,7 @@ def api_analytics_kpi_summary():
             db.and_(
                 Deal.won_date.is_(None),
                 Deal.closed_at.isnot(None),
-                db.func.date(Deal.closed_at) >= start_date,
-                db.func.date(Deal.closed_at) <= end_date
+                date_range_condition(Deal.closed_at, start_date, end_date)
             )
         )
     ).scalar() or 0
@@ -5654,8 +5983,7 @@ def api_analytics_kpi_summary():
             db.and_(
                 Deal.won_date.is_(None),
                 Deal.closed_at.isnot(None),
-                db.func.date(Deal.closed_at) >= start_date,
-                db.func.date(Deal.closed_at) <= end_date
+                date_range_condition(Deal.closed_at, start_date, end_date)
             )
         )
     ).scalar() or 0
@@ -5669,8 +5997,7 @@ def api_analytics_kpi_summary():
             db.and_(
                 Deal.won_date.is_(None),
                 Deal.closed_at.isnot(None),
-                db.func.date(Deal.closed_at) >= start_date,
-                db.func.date(Deal.closed_at) <= end_date
+                date_range_condition(Deal.closed_at, start_date, end_date)
             )
         )
     ).scalar() or 0
@@ -5683,8 +6010,7 @@ def api_analytics_kpi_summary():
             db.and_(
                 Deal.lost_date.is_(None),
                 Deal.closed_at.isnot(None),
-                db.func.date(Deal.closed_at) >= start_date,
-                db.func.date(Deal.closed_at) <= end_date
+                date_range_condition(Deal.closed_at, start_date, end_date)
             )
         )
     ).scalar() or 0
@@ -5698,15 +6024,175 @@ def api_analytics_kpi_summary():
         Deal.first_contact_date <= end_date
     ).scalar() or 0
     
-    return jsonify({
+    return {
         'revenue': float(revenue),
         'new_wins': new_won_count,
         'win_rate': win_rate,
         'new_leads': new_leads,
         'period': {'start': str(start_date), 'end': str(end_date)}
+    }
+
+
+# 分析画面のウィジェット（名前 → 集計関数）
+ANALYTICS_WIDGETS = {
+    'kpi-summary': analytics_kpi_summary_data,
+    'lead-source': analytics_lead_source_data,
+    'industry': analytics_industry_data,
+    'assignee-activity': analytics_assignee_activity_data,
+    'stage-funnel': analytics_stage_funnel_data,
+    'lost-reason': analytics_lost_reason_data,
+    'monthly-trend': analytics_monthly_trend_data,
+}
+
+
+def analytics_widget_response(name):
+    """ウィジェット単体のAPIレスポンス"""
+    start_date, end_date = get_cross_tab_date_range()
+    try:
+        return jsonify(ANALYTICS_WIDGETS[name](start_date, end_date, request.args, {}))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/api/analytics/lead-source')
+@login_required
+@cached_analytics
+def api_analytics_lead_source():
+    return analytics_widget_response('lead-source')
+
+
+@app.route('/api/analytics/industry')
+@login_required
+@cached_analytics
+def api_analytics_industry():
+    return analytics_widget_response('industry')
+
+
+@app.route('/api/analytics/assignee-activity')
+@login_required
+@cached_analytics
+def api_analytics_assignee_activity():
+    return analytics_widget_response('assignee-activity')
+
+
+@app.route('/api/analytics/stage-funnel')
+@login_required
+@cached_analytics
+def api_analytics_stage_funnel():
+    return analytics_widget_response('stage-funnel')
+
+
+@app.route('/api/analytics/lost-reason')
+@login_required
+@cached_analytics
+def api_analytics_lost_reason():
+    return analytics_widget_response('lost-reason')
+
+
+@app.route('/api/analytics/monthly-trend')
+@login_required
+@cached_analytics
+def api_analytics_monthly_trend():
+    return analytics_widget_response('monthly-trend')
+
+
+@app.route('/api/analytics/kpi-summary')
+@login_required
+@cached_analytics
+def api_analytics_kpi_summary():
+    return analytics_widget_response('kpi-summary')
+
+
+@app.route('/api/analytics/batch')
+@login_required
+@cached_analytics
+def api_analytics_batch():
+    """
+    分析画面のウィジェットを一括取得（?widgets=kpi-summary,lead-source,...&period=...）
+    
+    1リクエスト・1トランザクション内で集計し、期間の案件集計など共通の中間結果は使い回す。
+    ウィジェット固有のパラメータ（mode, months など）はそのまま各ウィジェットに渡す。
+    """
+    names = [name.strip() for name in request.args.get('widgets', '').split(',') if name.strip()]
+    names = names or list(ANALYTICS_WIDGETS)
+    unknown = [name for name in names if name not in ANALYTICS_WIDGETS]
+    if unknown:
+        return jsonify({'error': f"不明なウィジェットです: {', '.join(unknown)}"}), 400
+    
+    start_date, end_date = get_cross_tab_date_range()
+    
+    # PostgreSQLでは全ウィジェットを同じスナップショットで集計する
+    if 'postgresql' in (app.config['SQLALCHEMY_DATABASE_URI'] or ''):
+        db.session.rollback()
+        db.session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+    
+    shared = {}
+    widgets = {}
+    errors = {}
+    for name in names:
+        try:
+            widgets[name] = ANALYTICS_WIDGETS[name](start_date, end_date, request.args, shared)
+        except ValueError as e:
+            errors[name] = str(e)
+    
+    return jsonify({
+        'widgets': widgets,
+        'errors': errors,
+        'period': {'start': str(start_date), 'end': str(end_date)}
     })
 
 
+
+@app.route('/api/analytics/cube')
+@login_required
+@cached_analytics
+def api_analytics_cube():
+    """
+    軸 × 指標の汎用集計（?dimensions=industry,month&measures=won,win_rate&basis=closed&period=...）
+    
+    - dimensions: industry / lead_source / assignee / team / month / stage / new_or_existing / probability_rank
+    - measures: count / won / lost / win_rate / revenue / gross_profit / avg_amount / avg_lead_time / first_contact
+    - basis: 期間の基準日（closed: 成約日 / created: 作成日 / outcome: 受注日・失注日・作成日）
+    - 絞り込み: <軸>=値[,値...] または status=...
+    - order_by（指標名、降順）・limit で並べ替え・件数制限
+    """
+    dimensions = [name.strip() for name in request.args.get('dimensions', '').split(',') if name.strip()]
+    measures = [name.strip() for name in request.args.get('measures', '').split(',') if name.strip()]
+    measures = measures or ['count', 'won', 'lost', 'win_rate', 'revenue']
+    basis = request.args.get('basis', 'closed')
+    order_by = request.args.get('order_by')
+    limit = request.args.get('limit', type=int)
+    if order_by and order_by not in measures:
+        return jsonify({'error': 'order_by には measures の指標を指定してください'}), 400
+    
+    start_date, end_date = get_cross_tab_date_range()
+    try:
+        filters = parse_cube_filters(request.args)
+        items = run_cube(dimensions, measures, start_date, end_date, basis=basis, filters=filters)
+    except CubeError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if order_by:
+        items.sort(key=lambda item: item[order_by] if item[order_by] is not None else float('-inf'), reverse=True)
+    else:
+        items.sort(key=lambda item: tuple((item[name] is None, str(item[name])) for name in dimensions))
+    if limit:
+        items = items[:limit]
+    for item in items:
+        for measure in ('avg_amount', 'avg_lead_time'):
+            if item.get(measure) is not None:
+                item[measure] = round(float(item[measure]), 2)
+    label_dimensions(items, dimensions)
+    
+    return jsonify({
+        'dimensions': dimensions,
+        'measures': measures,
+        'basis': basis,
+        'filters': filters,
+        'data': items,
+        'period': {'start': str(start_date), 'end': str(end_date)}
+    })
+
 if __name__ == '__main__':
     with app.app_context():
         # データベースの初期化とマイグレーション
@@ -5818,4 +6304,7 @@ if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))  # デフォルトを5001に変更（5000が使用中の場合）
     # 本番環境ではデフォルトでFalse、開発時は環境変数FLASK_DEBUG=Trueで有効化
     debug = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
+    # デバッグ時はリローダーの子プロセス（実際にリクエストを処理するプロセス）でだけ開始する
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
     app.run(host='0.0.0.0', port=port, debug=debug)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Excelエクスポートのベンチマークスクリプト
+従来の方式（通常モードのブックに ws.cell() で書き込み、全セルを走査して列幅を調整し BytesIO に保存）と、
+書き込み専用モード（write_excel: 行を追記しながら列幅を求め、一時ファイルに保存）の
+所要時間・ピークメモリを案件データで比較します。
+
+使い方:
+    python benchmark_export.py [件数 ...]    # 既定: 10000 100000 500000
+
+一時SQLiteファイルにダミー案件データを投入して計測します（件数ごとに追加投入）。
+ピークメモリは tracemalloc で計測するため、所要時間は通常の実行より長くなります。
+"""
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+SIZES = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 500000]
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'benchmark_export.db')
+os.environ['ENABLE_PIPELINE_SNAPSHOTS'] = 'False'
+
+from openpyxl import Workbook
+from openpyxl.styles import Font, Alignment, PatternFill
+from openpyxl.utils import get_column_letter
+from sqlalchemy.orm import contains_eager, joinedload
+
+from app import app, db, EXPORT_BATCH_SIZE
+from models import Company, Deal
+from utils.export_utils import DEAL_HEADERS, _deal_row, export_deals_to_excel
+
+STAGES = ['リード', 'アポ', 'ヒアリング', '見積・提案', '最終調整']
+STATUSES = ['OPEN', 'OPEN', 'WON', 'LOST']
+
+
+def seed_deals(rows, offset):
+    """ダミー案件データを投入（企業は100件を共有）"""
+    random.seed(offset)
+    if not Company.query.first():
+        db.session.execute(Company.__table__.insert(), [
+            {'name': f'株式会社ベンチマーク{i:03d}', 'heat_score': 1} for i in range(100)
+        ])
+    company_ids = [row[0] for row in db.session.query(Company.id).all()]
+    now = datetime.utcnow()
+    batch = []
+    for i in range(offset, offset + rows):
+        batch.append({
+            'company_id': random.choice(company_ids),
+            'title': f'案件{i}',
+            'stage': random.choice(STAGES),
+            'amount': random.randint(1, 1000) * 10000,
+            'status': random.choice(STATUSES),
+            'assignee': f'担当者{i % 20}',
+            'next_action': '次回打ち合わせの日程調整' if i % 3 else None,
+            'note': 'メモ' * (i % 30),
+            'created_at': now - timedelta(minutes=i),
+        })
+        if len(batch) >= 5000:
+            db.session.execute(Deal.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(Deal.__table__.insert(), batch)
+    db.session.commit()
+
+
+def legacy_export_deals_to_excel(deals):
+    """従来の方式（通常モードのブック + 全セル走査の列幅調整 + BytesIO）"""
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "案件一覧"
+
+    header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
+    header_font = Font(bold=True, color="FFFFFF")
+    for col_idx, header in enumerate(DEAL_HEADERS, 1):
+        cell = ws.cell(row=1, column=col_idx, value=header)
+        cell.fill = header_fill
+        cell.font = header_font
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+
+    for row_idx, deal in enumerate(deals, 2):
+        for col_idx, value in enumerate(_deal_row(deal), 1):
+            ws.cell(row=row_idx, column=col_idx, value=value)
+
+    for col_idx in range(1, len(DEAL_HEADERS) + 1):
+        max_length = 0
+        column = get_column_letter(col_idx)
+        for cell in ws[column]:
+            if len(str(cell.value)) > max_length:
+                max_length = len(str(cell.value))
+        ws.column_dimensions[column].width = min(max_length + 2, 50)
+
+    output = io.BytesIO()
+    wb.save(output)
+    output.seek(0)
+    return output
+
+
+def deals_query():
+    return Deal.query.join(Company).options(contains_eager(Deal.company), joinedload(Deal.assignee_user))
+
+
+def measure(export):
+    """所要時間（秒）・ピークメモリ（MB）・ファイルサイズ（MB）"""
+    db.session.expunge_all()
+    tracemalloc.start()
+    start = time.perf_counter()
+    output = export()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    output.seek(0, os.SEEK_END)
+    size = output.tell()
+    output.close()
+    db.session.expunge_all()
+    return elapsed, peak / 1024 / 1024, size / 1024 / 1024
+
+
+def run_benchmark():
+    with app.app_context():
+        print("=" * 78)
+        print("Excelエクスポート ベンチマーク（案件）")
+        print("=" * 78)
+        print(f"{'件数':>10}{'従来(秒)':>12}{'従来(MB)':>12}{'書込専用(秒)':>14}{'書込専用(MB)':>14}{'サイズ(MB)':>12}")
+        print("-" * 78)
+
+        seeded = 0
+        for size in sorted(SIZES):
+            seed_deals(size - seeded, seeded)
+            seeded = size
+
+            legacy = measure(lambda: legacy_export_deals_to_excel(deals_query().all()))
+            streaming = measure(lambda: export_deals_to_excel(deals_query().yield_per(EXPORT_BATCH_SIZE)))
+            print(f"{size:>10}{legacy[0]:>12.1f}{legacy[1]:>12.0f}{streaming[0]:>14.1f}{streaming[1]:>14.0f}{streaming[2]:>12.1f}")
+
+
+if __name__ == '__main__':
+    run_benchmark()
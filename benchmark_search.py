@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+検索インデックスのベンチマークスクリプト
+従来の ILIKE '%語%' による検索と、検索インデックス（SQLite: FTS5 / PostgreSQL: pg_trgm）
+による検索の所要時間を比較します。
+
+使い方:
+    python benchmark_search.py [企業数]
+
+DATABASE_URL が未設定の場合は一時SQLiteファイルにダミーデータを投入して計測します。
+（既存DBを指定した場合はデータを投入せず、そのまま計測します）
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+USE_TEMP_DB = not os.environ.get('DATABASE_URL')
+if USE_TEMP_DB:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'benchmark_search.db')
+
+from app import app, db, INDUSTRY_CATEGORIES
+from models import Company
+from utils.search_index import search_condition, ensure_search_index
+
+PREFIXES = ['株式会社', '有限会社', '合同会社', '']
+WORDS = ['テクノ', 'グローバル', 'さくら', '未来', 'ネクスト', 'ソリューションズ', '物産', '商事',
+         'システム', 'ホールディングス', '工業', 'メディカル', 'フーズ', 'ロジスティクス']
+CITIES = ['東京都渋谷区', '大阪府大阪市', '愛知県名古屋市', '福岡県福岡市', '北海道札幌市']
+TERMS = ['テクノ', '商事', 'ネクストシステム', 'さくら物産', '札幌', 'IT']
+REPEAT = 5
+
+
+def seed_companies(rows):
+    """ダミー企業データを投入"""
+    random.seed(0)
+    batch = []
+    for i in range(rows):
+        name = random.choice(PREFIXES) + random.choice(WORDS) + random.choice(WORDS) + str(i)
+        batch.append({
+            'name': name,
+            'industry': random.choice(INDUSTRY_CATEGORIES),
+            'location': random.choice(CITIES)
+        })
+        if len(batch) >= 5000:
+            db.session.execute(Company.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(Company.__table__.insert(), batch)
+    db.session.commit()
+    # Core INSERTはORMイベントを通らないため索引を作り直す
+    ensure_search_index(rebuild=True)
+
+
+def ilike_condition(term):
+    """従来の検索条件"""
+    return db.or_(
+        Company.name.ilike(f'%{term}%'),
+        Company.industry.ilike(f'%{term}%'),
+        Company.location.ilike(f'%{term}%')
+    )
+
+
+def measure(condition):
+    """件数取得と先頭50件取得の平均時間（ミリ秒）"""
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        count = Company.query.filter(condition).count()
+        Company.query.filter(condition).order_by(Company.name).limit(50).all()
+        db.session.expunge_all()
+    return (time.perf_counter() - start) / REPEAT * 1000, count
+
+
+def run_benchmark():
+    with app.app_context():
+        print("=" * 60)
+        print("検索インデックス ベンチマーク")
+        print("=" * 60)
+        print(f"DB: {db.engine.dialect.name}")
+
+        if USE_TEMP_DB:
+            print(f"ダミー企業データを {ROWS} 件投入しています...")
+            seed_companies(ROWS)
+        print(f"企業数: {Company.query.count()}\n")
+
+        print(f"{'検索語':<20}{'ILIKE(ms)':>12}{'INDEX(ms)':>12}{'件数':>10}")
+        print("-" * 60)
+        for term in TERMS:
+            ilike_ms, ilike_count = measure(ilike_condition(term))
+            index_ms, index_count = measure(search_condition('companies', term))
+            note = '' if ilike_count == index_count else f'  (ILIKE: {ilike_count}件)'
+            print(f"{term:<20}{ilike_ms:>12.1f}{index_ms:>12.1f}{index_count:>10}{note}")
+
+
+if __name__ == '__main__':
+    run_benchmark()
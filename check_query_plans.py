@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+日付範囲検索の実行計画チェックスクリプト
+案件・活動履歴の日付範囲条件（utils.date_range.date_range_condition）や滞留案件の条件が
+インデックスを使った検索になっているかを EXPLAIN で確認します。
+
+使い方:
+    python check_query_plans.py
+
+DATABASE_URL が未設定の場合は一時SQLiteファイルで確認します。
+PostgreSQL では件数が少ないと全件走査が選ばれるため、enable_seqscan を無効にして確認します。
+"""
+import os
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+
+if not os.environ.get('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'check_query_plans.db')
+
+from app import app, db
+from models import Deal, Activity
+from utils.date_range import date_range_condition, month_range
+
+INDEX_MARKERS = {
+    'sqlite': ('USING INDEX', 'USING COVERING INDEX', 'USING INTEGER PRIMARY KEY'),
+    'postgresql': ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan'),
+}
+
+
+def build_queries():
+    """確認対象のクエリ（名前, SELECT文）"""
+    today = date.today()
+    period_start = today - timedelta(days=90)
+    return [
+        ('案件一覧: 作成日', db.select(Deal.id).where(
+            date_range_condition(Deal.created_at, period_start, today))),
+        ('案件一覧: 計上月', db.select(Deal.id).where(
+            Deal.status == 'WON',
+            date_range_condition(Deal.closed_at, *month_range(today.year, today.month)))),
+        ('分析: 期間内の受注', db.select(db.func.sum(Deal.amount)).where(
+            Deal.status == 'WON',
+            date_range_condition(Deal.closed_at, period_start, today))),
+        ('分析: 期間内の成約', db.select(db.func.count(Deal.id)).where(
+            date_range_condition(Deal.closed_at, period_start, today))),
+        ('活動履歴エクスポート', db.select(Activity.id).where(
+            date_range_condition(Activity.happened_at, period_start, today))),
+        ('ダッシュボード: 滞留案件数', db.select(db.func.count(Deal.id)).where(
+            Deal.status.in_(Deal.OPEN_STATUSES),
+            Deal.stage_entered_at <= datetime.utcnow() - timedelta(days=Deal.STALE_DAYS))),
+    ]
+
+
+def explain(conn, statement):
+    compiled = statement.compile(dialect=conn.dialect, compile_kwargs={'literal_binds': True})
+    prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+    rows = conn.execute(db.text(prefix + str(compiled))).all()
+    return [str(row[-1]) for row in rows]
+
+
+def run_check():
+    with app.app_context():
+        dialect = db.engine.dialect.name
+        markers = INDEX_MARKERS.get(dialect)
+        if markers is None:
+            print(f"未対応のデータベースです: {dialect}")
+            return 1
+
+        print("=" * 60)
+        print(f"日付範囲検索の実行計画チェック（{dialect}）")
+        print("=" * 60)
+
+        failures = 0
+        with db.engine.connect() as conn:
+            if dialect == 'postgresql':
+                conn.execute(db.text('SET enable_seqscan = off'))
+            for name, statement in build_queries():
+                plan = explain(conn, statement)
+                uses_index = any(marker in line for line in plan for marker in markers)
+                failures += 0 if uses_index else 1
+                print(f"{'✓' if uses_index else '✗'} {name}")
+                for line in plan:
+                    print(f"    {line}")
+
+        print("-" * 60)
+        print("すべてインデックス検索です" if not failures else f"{failures}件のクエリが全件走査です")
+        return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(run_check())
@@ -0,0 +1,12 @@
+"""
+gunicorn の設定（`gunicorn app:app` を実行するディレクトリにあれば自動的に読み込まれる）
+
+バックグラウンド処理（app.start_background_services）はワーカーのプロセスでだけ開始する。
+app を import するだけのメンテナンス用スクリプトでは動かさない。
+"""
+
+
+def post_worker_init(worker):
+    """ワーカーがアプリを読み込んだ後にバックグラウンド処理を開始"""
+    from app import start_background_services
+    start_background_services()
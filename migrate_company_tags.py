@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+Database migration helper: create the company_tags table and backfill it
+from the comma-separated companies.tags column.
+"""
+from app import app, db
+from utils.company_tags import rebuild_company_tags
+
+
+def run_migration():
+    with app.app_context():
+        print("=" * 70)
+        print("CONNECT+ Company Tags Migration")
+        print("=" * 70)
+
+        print("Creating/Updating tables via SQLAlchemy...")
+        db.create_all()
+        print("✓ company_tags table ensured")
+
+        # Rebuild from the tags column so the migration can be re-run safely
+        with db.engine.begin() as conn:
+            scanned, inserted = rebuild_company_tags(conn)
+
+        print(f"✓ {scanned} companies scanned, {inserted} tag rows written")
+        print("=" * 70)
+        print("Migration completed successfully.")
+
+
+if __name__ == '__main__':
+    run_migration()
@@ -1,4 +1,5 @@
 from database import db
+from sqlalchemy.orm import validates
 from flask_login import UserMixin
 from datetime import datetime, timedelta
 
@@ -88,7 +89,7 @@ class Company(db.Model):
     heat_score = db.Column(db.Integer, nullable=True, default=1)  # 1-5段階の温度感スコア
     last_contacted_at = db.Column(db.DateTime, nullable=True)
     next_action_at = db.Column(db.DateTime, nullable=True)
-    tags = db.Column(db.String(500), nullable=True)  # Comma-separated for now, can migrate to JSON later
+    tags = db.Column(db.String(500), nullable=True)  # Comma-separated display copy; company_tags is the source for filtering
     
     # Analysis & Classification fields (v3.0.0)
     company_size_id = db.Column(db.Integer, db.ForeignKey('company_sizes.id'), nullable=True, index=True)  # 企業規模
@@ -100,19 +101,54 @@ class Company(db.Model):
     activities = db.relationship('Activity', backref='company', lazy=True, cascade='all, delete-orphan')
     company_size = db.relationship('CompanySize', backref='companies')
     customer_status = db.relationship('CustomerStatus', backref='companies')
+    tag_links = db.relationship('CompanyTag', backref='company', lazy=True, cascade='all, delete-orphan',
+                                order_by='CompanyTag.id')
     
     def __repr__(self):
         return f'<Company {self.name}>'
     
+    @staticmethod
+    def parse_tags(value):
+        """Split a comma-separated tag string into a de-duplicated list"""
+        tags = []
+        for tag in (value or '').split(','):
+            tag = tag.strip()[:100]
+            if tag and tag not in tags:
+                tags.append(tag)
+        return tags
+    
+    @validates('tags')
+    def _sync_tag_links(self, key, value):
+        """Keep company_tags rows in sync whenever the tags string is assigned"""
+        existing = {link.tag: link for link in self.tag_links}
+        self.tag_links = [existing.get(tag) or CompanyTag(tag=tag) for tag in self.parse_tags(value)]
+        return value
+    
     def get_tags_list(self):
         """Helper method to get tags as a list"""
-        if self.tags:
-            return [tag.strip() for tag in self.tags.split(',') if tag.strip()]
-        return []
+        return [link.tag for link in self.tag_links]
     
     def set_tags_list(self, tags_list):
         """Helper method to set tags from a list"""
-        self.tags = ','.join(tags_list) if tags_list else None
+        self.tags = ','.join(self.parse_tags(','.join(tags_list or []))) or None
+
+
+class CompanyTag(db.Model):
+    """Normalized company tags (one row per company/tag pair)"""
+    __tablename__ = 'company_tags'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    company_id = db.Column(db.Integer, db.ForeignKey('companies.id', ondelete='CASCADE'), nullable=False)
+    tag = db.Column(db.String(100), nullable=False)
+    
+    # Tag filtering and tag facets look up by tag first
+    __table_args__ = (
+        db.Index('ix_company_tags_tag_company', 'tag', 'company_id'),
+        db.UniqueConstraint('company_id', 'tag', name='uq_company_tags_company_tag'),
+    )
+    
+    def __repr__(self):
+        return f'<CompanyTag {self.tag}>'
 
 class Contact(db.Model):
     __tablename__ = 'contacts'
@@ -142,7 +178,7 @@ class Deal(db.Model):
     amount = db.Column(db.Float, default=0)
     status = db.Column(db.String(50), nullable=False, index=True)  # 'OPEN', 'WON', 'LOST'
     note = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     team_id = db.Column(db.Integer, db.ForeignKey('teams.id'), nullable=True, index=True)
     
     # Extended fields
@@ -179,6 +215,20 @@ class Deal(db.Model):
     lead_source = db.relationship('LeadSource', backref='deals')
     tasks = db.relationship('Task', backref='deal', lazy=True, cascade='all, delete-orphan')
     activities = db.relationship('Activity', backref='deal', lazy=True, cascade='all, delete-orphan')
+    stage_transitions = db.relationship('DealStageTransition', backref='deal', lazy=True,
+                                        cascade='all, delete-orphan',
+                                        order_by='DealStageTransition.entered_at')
+    
+    # 受注/失注の期間集計（status = ? AND closed_at の範囲検索）用の複合インデックス
+    # 滞留案件（status = ? AND stage_entered_at <= ?）の検索用の複合インデックス
+    __table_args__ = (
+        db.Index('ix_deals_status_closed_at', 'status', 'closed_at'),
+        db.Index('ix_deals_status_stage_entered_at', 'status', 'stage_entered_at'),
+    )
+    
+    # 進行中のステータス値と、滞留案件とみなすステージ滞留日数
+    OPEN_STATUSES = ('進行中', 'OPEN')
+    STALE_DAYS = 30
     
     def __repr__(self):
         return f'<Deal {self.title}>'
@@ -190,6 +240,11 @@ class Deal(db.Model):
             return (datetime.utcnow() - self.stage_entered_at).days
         return 0
     
+    @property
+    def is_stale(self):
+        """進行中でステージ滞留が STALE_DAYS 日以上か"""
+        return self.status in self.OPEN_STATUSES and self.days_in_stage >= self.STALE_DAYS
+    
     
     def get_assignee_name(self):
         """Get assignee name (from User if assignee_id exists, else from assignee string)"""
@@ -199,6 +254,103 @@ class Deal(db.Model):
             return self.assignee
         return None
 
+
+class DealStageTransition(db.Model):
+    """Stage history of a deal (one row per stage entry; closing is recorded as 受注/失注)"""
+    __tablename__ = 'deal_stage_transitions'
+
+    id = db.Column(db.Integer, primary_key=True)
+    deal_id = db.Column(db.Integer, db.ForeignKey('deals.id'), nullable=False)
+    from_stage = db.Column(db.String(50), nullable=True)
+    stage = db.Column(db.String(50), nullable=False)
+    entered_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+
+    # Per-deal history (window over deal_id) and per-stage period queries
+    __table_args__ = (
+        db.Index('ix_deal_stage_transitions_deal_entered', 'deal_id', 'entered_at'),
+        db.Index('ix_deal_stage_transitions_stage_entered', 'stage', 'entered_at'),
+    )
+
+    def __repr__(self):
+        return f'<DealStageTransition {self.deal_id} {self.from_stage} -> {self.stage}>'
+
+
+class DealMetricsMonthly(db.Model):
+    """Monthly deal rollup by closed month (maintained by utils/deal_metrics.py)"""
+    __tablename__ = 'deal_metrics_monthly'
+
+    id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.String(7), nullable=False)  # closed_at の 'YYYY-MM'
+    team_id = db.Column(db.Integer, nullable=True)
+    assignee_id = db.Column(db.Integer, nullable=True)
+    industry = db.Column(db.String(100), nullable=True)
+    lead_source_id = db.Column(db.Integer, nullable=True)
+    status = db.Column(db.String(50), nullable=False)
+    deal_count = db.Column(db.Integer, nullable=False, default=0)
+    amount_sum = db.Column(db.Float, nullable=False, default=0)
+    gross_profit_sum = db.Column(db.Float, nullable=False, default=0)
+
+    # Analytics read by month range and status first
+    __table_args__ = (
+        db.Index('ix_deal_metrics_monthly_key', 'month', 'status', 'team_id', 'assignee_id',
+                 'industry', 'lead_source_id'),
+    )
+
+    def __repr__(self):
+        return f'<DealMetricsMonthly {self.month} {self.status}: {self.deal_count}>'
+
+
+class PipelineSnapshot(db.Model):
+    """Daily snapshot of the open pipeline (written by utils/pipeline_snapshots.py)"""
+    __tablename__ = 'pipeline_snapshots'
+
+    id = db.Column(db.Integer, primary_key=True)
+    snapshot_date = db.Column(db.Date, nullable=False)
+    stage = db.Column(db.String(50), nullable=False)
+    team_id = db.Column(db.Integer, nullable=True)
+    assignee_id = db.Column(db.Integer, nullable=True)
+    deal_count = db.Column(db.Integer, nullable=False, default=0)
+    amount_sum = db.Column(db.Float, nullable=False, default=0)
+
+    # Comparisons and trends read by snapshot date (range) first
+    __table_args__ = (
+        db.Index('ix_pipeline_snapshots_key', 'snapshot_date', 'stage', 'team_id', 'assignee_id'),
+    )
+
+    def __repr__(self):
+        return f'<PipelineSnapshot {self.snapshot_date} {self.stage}: {self.deal_count}>'
+
+
+class BackgroundJob(db.Model):
+    """Export/import job run by the local worker pool (utils/jobs.py)"""
+    __tablename__ = 'background_jobs'
+
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    kind = db.Column(db.String(20), nullable=False)  # 'export' / 'import'
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued / running / retrying / done / failed / expired
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    params = db.Column(db.Text, nullable=True)  # JSON
+    total = db.Column(db.Integer, nullable=True)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    file_path = db.Column(db.String(500), nullable=True)
+    filename = db.Column(db.String(300), nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=True, index=True)
+    # Import results and resume point (checkpoint_row = last row committed; written in the chunk's transaction)
+    succeeded = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    checkpoint_row = db.Column(db.Integer, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)  # last sign of life from the worker; stale jobs are resumed
+    claimed_by = db.Column(db.String(32), nullable=True)  # claim token of the worker allowed to run / checkpoint the job
+    attempts = db.Column(db.Integer, nullable=False, default=0)  # starts incl. resumes; retryable failures stop at JOB_MAX_ATTEMPTS
+
+    def __repr__(self):
+        return f'<BackgroundJob {self.id} {self.kind} {self.status}>'
+
 class Task(db.Model):
     __tablename__ = 'tasks'
     
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+Maintenance helper: rebuild the deal_metrics_monthly rollup table from the
+deals table. Run after bulk updates that bypass the ORM (raw SQL, restores).
+"""
+from app import app, db
+from models import DealMetricsMonthly
+from utils.deal_metrics import rebuild_deal_metrics
+
+
+def run_rebuild():
+    with app.app_context():
+        print("=" * 70)
+        print("CONNECT+ Deal Metrics Rebuild")
+        print("=" * 70)
+
+        db.create_all()
+        print("✓ deal_metrics_monthly table ensured")
+
+        with db.engine.begin() as conn:
+            rebuild_deal_metrics(conn)
+            rows = conn.execute(db.select(db.func.count(DealMetricsMonthly.id))).scalar()
+
+        print(f"✓ {rows} rollup rows written")
+        print("=" * 70)
+        print("Rebuild completed successfully.")
+
+
+if __name__ == '__main__':
+    run_rebuild()
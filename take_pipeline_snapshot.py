@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Maintenance helper: write today's pipeline_snapshots rows from the current
+open deals. Use from cron when the in-process daily job is disabled
+(ENABLE_PIPELINE_SNAPSHOTS=False), e.g. with multiple app workers.
+Past days cannot be backfilled, since only the current deal state is known.
+
+Usage: python take_pipeline_snapshot.py
+"""
+from app import app, db
+from models import PipelineSnapshot
+from utils.pipeline_snapshots import take_pipeline_snapshot
+
+
+def run_snapshot():
+    with app.app_context():
+        print("=" * 70)
+        print("CONNECT+ Pipeline Snapshot")
+        print("=" * 70)
+
+        db.create_all()
+        print("✓ pipeline_snapshots table ensured")
+
+        with db.engine.begin() as conn:
+            snapshot_date = take_pipeline_snapshot(conn)
+            rows = conn.execute(db.select(db.func.count(PipelineSnapshot.id)).where(
+                PipelineSnapshot.snapshot_date == snapshot_date
+            )).scalar()
+
+        print(f"✓ {rows} snapshot rows written for {snapshot_date}")
+        print("=" * 70)
+        print("Snapshot completed successfully.")
+
+
+if __name__ == '__main__':
+    run_snapshot()
@@ -0,0 +1,278 @@
+"""
+案件分析のキューブ（軸 × 指標）集計エンジン
+
+軸（dimensions）・指標（measures）・絞り込み（filters）の指定を1本の集計SQLに組み立てる。
+業界別・リードソース別・担当者別などの分析はすべてこのエンジンで集計する。
+
+- 基準日（basis）が成約日（closed）で、軸・絞り込み・指標が月次集計テーブルで賄える場合は
+  deal_metrics()（月単位の部分は deal_metrics_monthly）から集計する
+- それ以外は案件テーブルを1回のGROUP BYで集計する
+- query_cube() の結果は基本集計値（件数・受注件数・金額の合計など）を保持するため、
+  summarize() で軸を減らして合算し直せる（一括取得で複数の分析に使い回す）
+"""
+from datetime import datetime
+
+from database import db
+from models import Company, Deal, LeadSource, Team, User
+from utils.date_range import date_range_condition
+from utils.deal_metrics import deal_metrics, month_expr, filter_condition
+
+WON_STATUSES = ('WON', '受注')
+LOST_STATUSES = ('LOST', '失注')
+
+# 軸 → 案件のカラム（'month' は基準日から求める）
+DIMENSION_COLUMNS = {
+    'industry': Company.industry,
+    'lead_source': Deal.lead_source_id,
+    'assignee': Deal.assignee_id,
+    'team': Deal.team_id,
+    'month': None,
+    'stage': Deal.stage,
+    'new_or_existing': Deal.new_or_existing,
+    'probability_rank': Deal.probability_rank,
+}
+
+# 絞り込みに使える項目（軸 + ステータス）
+FILTER_COLUMNS = dict(DIMENSION_COLUMNS, status=Deal.status)
+
+# ID の軸の表示名の取得元
+DIMENSION_LABELS = {
+    'lead_source': LeadSource,
+    'assignee': User,
+    'team': Team,
+}
+
+# 月次集計テーブル（deal_metrics_monthly）で扱える軸・絞り込み → 集計キー
+ROLLUP_KEYS = {
+    'industry': 'industry',
+    'lead_source': 'lead_source_id',
+    'assignee': 'assignee_id',
+    'team': 'team_id',
+    'month': 'month',
+    'status': 'status',
+}
+ROLLUP_AGGREGATES = {'count', 'won', 'lost', 'revenue', 'gross_profit'}
+
+BASES = ('closed', 'created', 'outcome')
+
+
+def _ratio(numerator, denominator, empty=0):
+    return numerator / denominator if denominator else empty
+
+
+# 指標 → (必要な基本集計値, 基本集計値から指標を求める関数)
+MEASURES = {
+    'count': (('count',), lambda b: b['count']),
+    'won': (('won',), lambda b: b['won']),
+    'lost': (('lost',), lambda b: b['lost']),
+    'win_rate': (('won', 'lost'), lambda b: round(_ratio(b['won'], b['won'] + b['lost']), 4)),
+    'revenue': (('revenue',), lambda b: b['revenue']),
+    'gross_profit': (('gross_profit',), lambda b: b['gross_profit']),
+    'avg_amount': (('revenue', 'won'), lambda b: _ratio(b['revenue'], b['won'])),
+    'first_contact': (('first_contact',), lambda b: b['first_contact']),
+    'avg_lead_time': (('lead_time_sum', 'lead_time_count'),
+                      lambda b: _ratio(b['lead_time_sum'], b['lead_time_count'], None)),
+}
+
+
+class CubeError(ValueError):
+    """キューブの指定（軸・指標・絞り込み・基準日）が不正"""
+
+
+def period_deal_condition(start_date, end_date):
+    """集計対象の案件（期間内に受注・失注した案件と、期間開始以降に作成された進行中案件）"""
+    return db.or_(
+        db.and_(Deal.status == 'WON', Deal.won_date >= start_date, Deal.won_date <= end_date),
+        db.and_(Deal.status == 'LOST', Deal.lost_date >= start_date, Deal.lost_date <= end_date),
+        db.and_(Deal.status == 'OPEN', Deal.created_at >= datetime.combine(start_date, datetime.min.time()))
+    )
+
+
+def _date_diff_days(end, start):
+    """日付の差（日数）を求めるSQL式"""
+    if db.engine.dialect.name == 'postgresql':
+        return end - start
+    return db.func.julianday(end) - db.func.julianday(start)
+
+
+def _base_aggregates():
+    is_won = Deal.status.in_(WON_STATUSES)
+    has_lead_time = db.and_(is_won, Deal.first_contact_date.isnot(None), Deal.won_date.isnot(None))
+    lead_time = db.case((has_lead_time, _date_diff_days(Deal.won_date, Deal.first_contact_date)))
+    return {
+        'count': db.func.count(Deal.id),
+        'won': db.func.sum(db.case((is_won, 1), else_=0)),
+        'lost': db.func.sum(db.case((Deal.status.in_(LOST_STATUSES), 1), else_=0)),
+        'revenue': db.func.sum(db.case((is_won, Deal.amount), else_=0)),
+        'gross_profit': db.func.sum(db.case((is_won, Deal.gross_profit), else_=0)),
+        'first_contact': db.func.sum(db.case((Deal.first_contact_date.isnot(None), 1), else_=0)),
+        'lead_time_sum': db.func.sum(lead_time),
+        'lead_time_count': db.func.count(lead_time),
+    }
+
+
+def _basis_column(basis):
+    if basis == 'closed':
+        return Deal.closed_at
+    if basis == 'created':
+        return Deal.created_at
+    return db.func.coalesce(Deal.won_date, Deal.lost_date, Deal.created_at)
+
+
+def _basis_condition(basis, start_date, end_date):
+    if basis == 'outcome':
+        if start_date is None or end_date is None:
+            raise CubeError('basis=outcome には期間の指定が必要です')
+        return period_deal_condition(start_date, end_date)
+    column = _basis_column(basis)
+    return db.and_(column.isnot(None), date_range_condition(column, start_date, end_date))
+
+
+def required_aggregates(measures):
+    names = set()
+    for measure in measures:
+        names.update(MEASURES[measure][0])
+    return names
+
+
+def validate(dimensions, measures, filters, basis):
+    unknown = [name for name in dimensions if name not in DIMENSION_COLUMNS]
+    unknown += [name for name in measures if name not in MEASURES]
+    unknown += [name for name in filters if name not in FILTER_COLUMNS]
+    if unknown:
+        raise CubeError(f"不明な軸・指標・絞り込みです: {', '.join(unknown)}")
+    if basis not in BASES:
+        raise CubeError(f"basis は {' / '.join(BASES)} のいずれかを指定してください")
+
+
+def _uses_rollup(dimensions, aggregates, filters, basis, start_date, end_date):
+    return (
+        basis == 'closed' and start_date is not None and end_date is not None
+        and all(name in ROLLUP_KEYS for name in dimensions)
+        and all(name in ROLLUP_KEYS for name in filters)
+        and aggregates <= ROLLUP_AGGREGATES
+    )
+
+
+def _query_rollup(dimensions, filters, start_date, end_date):
+    group_by = tuple(ROLLUP_KEYS[name] for name in dimensions) + ('status',)
+    metrics = deal_metrics(start_date, end_date, group_by=group_by,
+                           filters={ROLLUP_KEYS[name]: value for name, value in filters.items()})
+    rows = {}
+    for m in metrics:
+        key = tuple(m[ROLLUP_KEYS[name]] for name in dimensions)
+        base = rows.setdefault(key, dict.fromkeys(ROLLUP_AGGREGATES, 0))
+        base['count'] += m['deal_count']
+        if m['status'] in WON_STATUSES:
+            base['won'] += m['deal_count']
+            base['revenue'] += m['amount_sum']
+            base['gross_profit'] += m['gross_profit_sum']
+        elif m['status'] in LOST_STATUSES:
+            base['lost'] += m['deal_count']
+    return list(rows.items())
+
+
+def _query_deals(dimensions, aggregates, filters, basis, start_date, end_date):
+    base_columns = _base_aggregates()
+    names = sorted(aggregates)
+    columns = [
+        month_expr(_basis_column(basis)) if name == 'month' else DIMENSION_COLUMNS[name]
+        for name in dimensions
+    ]
+    query = db.session.query(*columns, *[base_columns[name] for name in names]).select_from(Deal)
+    if 'industry' in dimensions or 'industry' in filters:
+        query = query.outerjoin(Company, Company.id == Deal.company_id)
+    query = query.filter(_basis_condition(basis, start_date, end_date))
+    for name, value in filters.items():
+        column = month_expr(_basis_column(basis)) if name == 'month' else FILTER_COLUMNS[name]
+        query = query.filter(filter_condition(column, value))
+    if columns:
+        query = query.group_by(*columns)
+
+    return [
+        (tuple(row[:len(columns)]), {name: row[len(columns) + i] or 0 for i, name in enumerate(names)})
+        for row in query.all()
+    ]
+
+
+def query_cube(dimensions, measures, start_date=None, end_date=None, basis='closed', filters=None):
+    """
+    軸ごとの基本集計値を求める
+
+    Args:
+        dimensions: 軸（DIMENSION_COLUMNS のキー）のリスト
+        measures: 指標（MEASURES のキー）のリスト。必要な基本集計値だけを集計する
+        start_date, end_date: 期間（基準日が入る日の範囲。両端の日を含む）
+        basis: 基準日（closed: 成約日 / created: 作成日 / outcome: 受注日・失注日・作成日）
+        filters: 絞り込み（FILTER_COLUMNS のキー → 値。リスト・タプルは IN、None は未設定）
+
+    Returns:
+        list[tuple]: (軸の値のタプル, 基本集計値のdict)
+    """
+    dimensions = list(dimensions)
+    filters = dict(filters or {})
+    validate(dimensions, measures, filters, basis)
+    aggregates = required_aggregates(measures) | {'count'}
+    if _uses_rollup(dimensions, aggregates, filters, basis, start_date, end_date):
+        return _query_rollup(dimensions, filters, start_date, end_date)
+    return _query_deals(dimensions, aggregates, filters, basis, start_date, end_date)
+
+
+def summarize(rows, row_dimensions, dimensions, measures):
+    """
+    query_cube() の結果を軸 dimensions（row_dimensions のサブセット）で合算し、指標を求める
+
+    Returns:
+        list[dict]: 軸の値と指標の値（件数が0の組み合わせは除く）
+    """
+    positions = [row_dimensions.index(name) for name in dimensions]
+    totals = {}
+    for key, base in rows:
+        target = totals.setdefault(tuple(key[i] for i in positions), {})
+        for name, value in base.items():
+            target[name] = target.get(name, 0) + (value or 0)
+
+    results = []
+    for key, base in totals.items():
+        if not base.get('count'):
+            continue
+        item = dict(zip(dimensions, key))
+        for measure in measures:
+            item[measure] = MEASURES[measure][1](base)
+        results.append(item)
+    return results
+
+
+def run_cube(dimensions, measures, start_date=None, end_date=None, basis='closed', filters=None):
+    """軸・指標・絞り込みを1回の集計で求める（query_cube + summarize）"""
+    rows = query_cube(dimensions, measures, start_date, end_date, basis, filters)
+    return summarize(rows, list(dimensions), list(dimensions), measures)
+
+
+def parse_filters(args):
+    """リクエストパラメータ（<項目>=値[,値...]）から絞り込みを作る（ID の軸は整数に変換）"""
+    filters = {}
+    for name in FILTER_COLUMNS:
+        values = [value.strip() for raw in args.getlist(name) for value in raw.split(',') if value.strip()]
+        if not values:
+            continue
+        if name in DIMENSION_LABELS:
+            try:
+                values = [int(value) for value in values]
+            except ValueError:
+                raise CubeError(f"{name} には ID を指定してください")
+        filters[name] = values if len(values) > 1 else values[0]
+    return filters
+
+
+def label_dimensions(items, dimensions):
+    """ID の軸（リードソース・担当者・チーム）に表示名（<軸>_name）を付ける（軸ごとに1クエリ）"""
+    for name in dimensions:
+        model = DIMENSION_LABELS.get(name)
+        if model is None:
+            continue
+        ids = {item[name] for item in items if item[name] is not None}
+        names = dict(db.session.query(model.id, model.name).filter(model.id.in_(ids)).all()) if ids else {}
+        for item in items:
+            item[f'{name}_name'] = names.get(item[name])
+    return items
@@ -0,0 +1,388 @@
+"""
+一括インポートユーティリティ
+
+CSV/Excel の行を IMPORT_CHUNK_ROWS 件ずつまとめて INSERT（executemany）し、チャンクごとにコミットする。
+
+- 企業名の重複チェック・案件の企業名/担当者名の解決は、最初に1回だけ読み込んだ
+  (名前, ID) の集合・辞書で行う（行ごとの SELECT はしない）
+- Core の INSERT はマッパーイベント・バリデータを通らないため、企業タグ（company_tags）、
+  案件のステージ遷移履歴・月次集計、検索インデックス（FTS5 シャドウテーブル）はチャンクごとにまとめて書き込む
+- 進捗は progress(最終行番号, 成功件数, エラー件数, メッセージ) としてコミットしたチャンクごとに通知する
+- checkpoint() をチャンクと同じトランザクションで呼ぶため、中断したインポートは
+  resume_from に記録済みの最終行番号を渡して続きから再開できる
+- キャッシュのコミットフックも通らないため、集計キャッシュの更新は呼び出し側で行う
+"""
+from datetime import datetime
+
+from sqlalchemy.exc import DataError, IntegrityError
+
+from database import db
+from models import Company, CompanyTag, Deal, User
+from utils.deal_metrics import add_new_deals
+from utils.import_utils import (
+    validate_company_row, validate_deal_row, normalize_industry_name, DEAL_STATUS_MAP
+)
+from utils.search_index import fts_enabled, index_rows
+from utils.stage_history import record_new_deals
+
+# 1回の INSERT・コミットにまとめる行数
+IMPORT_CHUNK_ROWS = 1000
+
+# 警告（取り込みはできた・重複でスキップした行）のメッセージに含まれる語
+WARNING_MARKERS = ('スキップしました', '変換しました')
+
+# 案件インポートの項目 → 対応するヘッダー（日本語・英語の順に、値のある方を使う）
+DEAL_IMPORT_FIELDS = {
+    'company_name': ('企業名', 'company_name'),
+    'title': ('案件名', 'title'),
+    'stage': ('ステージ', 'stage'),
+    'amount': ('金額', 'amount'),
+    'status': ('ステータス', 'status'),
+    'heat_score': ('温度感スコア', 'heat_score'),
+    'assignee': ('担当者', 'assignee'),
+    'appointment_date': ('アポイント日', 'appointment_date'),
+    'next_action': ('次回アクション', 'next_action'),
+    'win_reason_category': ('受注理由カテゴリ', 'win_reason_category'),
+    'win_reason_detail': ('受注理由詳細', 'win_reason_detail'),
+    'lost_reason_category': ('失注理由カテゴリ', 'lost_reason_category'),
+    'lost_reason_detail': ('失注理由詳細', 'lost_reason_detail'),
+    'closed_at': ('クローズ日', 'closed_at'),
+    'note': ('メモ', 'note'),
+    'meeting_minutes': ('議事録', 'meeting_minutes'),
+}
+
+_companies = Company.__table__
+_company_tags = CompanyTag.__table__
+_deals = Deal.__table__
+
+
+def _int_or_none(value):
+    return int(value) if value else None
+
+
+def _company_industry(row, industry_categories):
+    """業界名を取得して正規化（バリデーションで正規化済みの場合はそれを使用）"""
+    industry_raw = row.get('業界') or row.get('industry', '')
+    industry = row.get('_normalized_industry')
+    if not industry and industry_raw:
+        industry = normalize_industry_name(industry_raw)
+        # 正規化後の業界名が有効な業界カテゴリに含まれていない場合はNoneにする
+        if industry not in industry_categories:
+            industry = None
+    return industry_raw, industry
+
+
+def _company_values(row, name, industry):
+    """1行分の企業の INSERT 値（数値に変換できない値は ValueError）"""
+    return {
+        'name': name,
+        'industry': industry,
+        'location': row.get('所在地') or row.get('location', '') or None,
+        'hq_location': row.get('本社所在地') or row.get('hq_location', '') or None,
+        'employee_size': _int_or_none(row.get('従業員数') or row.get('employee_size')),
+        'website': row.get('ウェブサイト') or row.get('website', '') or None,
+        'heat_score': _int_or_none(row.get('温度感スコア') or row.get('heat_score')),
+        'tags': row.get('タグ') or row.get('tags', '') or None,
+        'memo': row.get('メモ') or row.get('memo', '') or None,
+        'needs': row.get('ニーズ') or row.get('needs', '') or None,
+        'kpi_current': row.get('現状KPI') or row.get('kpi_current', '') or None,
+    }
+
+
+def _insert_companies(batch):
+    """企業をまとめて INSERT し、企業タグ・検索インデックスも同じトランザクションで書き込む"""
+    # RETURNING で必要なカラムを受け取るため、入力の順序との対応は不要（sort_by_parameter_order なし）
+    inserted = db.session.execute(
+        _companies.insert().returning(
+            _companies.c.id, _companies.c.name, _companies.c.industry, _companies.c.location,
+            _companies.c.tags
+        ),
+        batch
+    ).all()
+
+    tag_rows = [
+        {'company_id': row.id, 'tag': tag}
+        for row in inserted for tag in Company.parse_tags(row.tags)
+    ]
+    if tag_rows:
+        db.session.execute(_company_tags.insert(), tag_rows)
+
+    connection = db.session.connection()
+    if fts_enabled(connection):
+        index_rows(connection, 'companies', inserted)
+    return len(inserted)
+
+
+def is_warning_message(message):
+    """インポートのメッセージが警告か（それ以外はエラー）"""
+    return any(marker in message for marker in WARNING_MARKERS)
+
+
+class RowError(Exception):
+    """取り込めない行（messages: エラーメッセージのリスト）"""
+
+    def __init__(self, messages):
+        super().__init__('; '.join(messages))
+        self.messages = messages
+
+
+def _import_in_chunks(rows, prepare, insert, chunk_size, progress=None, discard=None,
+                      checkpoint=None, resume_from=None):
+    """
+    行を prepare() で INSERT 値に変換し、chunk_size 行ごとに insert() してコミット
+
+    prepare(行番号, 行, messages) は INSERT 値を返す（スキップする行は None、エラーの行は RowError）。
+    insert(INSERT 値のリスト) は登録した件数を返す。データが原因で失敗したチャンク（IntegrityError /
+    DataError）はロールバックし、discard(INSERT 値のリスト) で重複判定用の状態などを戻してから
+    エラーとして記録する。それ以外の例外（タイムアウト・接続断・実行権の喪失など）はロールバックして
+    そのまま送出する（チェックポイントは進めないため、再開時はそのチャンクからやり直す）。
+
+    チャンクは読んだ行数で区切るため、エラー・スキップの行だけが続いても進捗は記録される。
+    checkpoint(最終行番号, 成功件数, エラー件数) はチャンクと同じトランザクションで（コミットの直前に）呼ぶ。
+    resume_from=(最終行番号, 成功件数, エラー件数) を指定した場合は、その行までを読み飛ばして続きから処理する。
+    """
+    last_row, success_count, error_count = resume_from or (1, 0, 0)
+    skip_until = last_row
+    messages = []
+    batch = []
+    batch_rows = []
+
+    def flush():
+        nonlocal success_count, error_count
+        try:
+            inserted = insert(batch) if batch else 0
+            if checkpoint:
+                checkpoint(last_row, success_count + inserted, error_count)
+            db.session.commit()
+            success_count += inserted
+        except (IntegrityError, DataError) as e:
+            # このチャンクだけを取り消す（前のチャンクはコミット済み）
+            db.session.rollback()
+            if discard:
+                discard(batch)
+            messages.append(f"行{batch_rows[0]}〜{batch_rows[-1]}: エラー - {str(e)}" if batch_rows
+                            else f"行{last_row}: エラー - {str(e)}")
+            error_count += len(batch)
+            if checkpoint:
+                checkpoint(last_row, success_count, error_count)
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        batch.clear()
+        batch_rows.clear()
+        if progress:
+            progress(last_row, success_count, error_count, list(messages))
+            messages.clear()
+
+    chunk_start = skip_until
+    for idx, row in enumerate(rows, start=2):  # 行番号は2から（ヘッダーを考慮）
+        if idx <= skip_until:
+            continue
+        last_row = idx
+        try:
+            values = prepare(idx, row, messages)
+        except RowError as e:
+            messages.extend(e.messages)
+            error_count += 1
+            values = None
+        if values is not None:
+            batch.append(values)
+            batch_rows.append(idx)
+        if idx - chunk_start >= chunk_size:
+            flush()
+            chunk_start = idx
+
+    if last_row > chunk_start:
+        flush()
+    elif progress:
+        progress(last_row, success_count, error_count, [])
+    return success_count, error_count, messages
+
+
+def import_company_rows(rows, industry_categories, chunk_size=IMPORT_CHUNK_ROWS, progress=None,
+                        checkpoint=None, resume_from=None):
+    """
+    企業データの行をチャンクごとに一括インポート
+
+    Args:
+        rows: 行のdict（ヘッダー → 値）の iterable（行番号は2から数える）
+        industry_categories: 有効な業界名のリスト
+        chunk_size: 1回の INSERT・コミットにまとめる行数
+        progress: コミットしたチャンクごとに progress(最終行番号, 成功件数, エラー件数, メッセージ) を呼ぶ
+            （そのチャンクのエラー・警告メッセージを渡し、戻り値のリストには残さない）
+        checkpoint: チャンクのコミットの直前に同じトランザクションで checkpoint(最終行番号, 成功件数, エラー件数) を呼ぶ
+        resume_from: 再開時の (最終行番号, 成功件数, エラー件数)。その行までを読み飛ばす
+
+    Returns:
+        tuple: (成功件数, エラー件数, エラー・警告メッセージのリスト（progress 指定時は空）)
+    """
+    # 既存の企業名（ファイル内の重複も検出できるよう、登録した企業名も追加していく）
+    existing_names = set(db.session.scalars(db.select(Company.name)))
+
+    def prepare(idx, row, messages):
+        # バリデーション
+        validation_errors = validate_company_row(row, idx, industry_categories)
+        if validation_errors:
+            raise RowError(validation_errors)
+
+        # 企業名を取得（日本語または英語ヘッダーに対応）
+        company_name = (row.get('企業名') or row.get('name', '')).strip()
+        if not company_name:
+            raise RowError([f"行{idx}: 企業名が空です"])
+
+        # 既存の企業をチェック（重複は警告として記録するが、エラーカウントには含めない）
+        if company_name in existing_names:
+            messages.append(f"行{idx}: 企業 '{company_name}' は既に存在するためスキップしました")
+            return None
+
+        industry_raw, industry = _company_industry(row, industry_categories)
+        # マッピングが適用された場合は警告として記録
+        if row.get('_industry_mapped') and industry_raw:
+            messages.append(f"行{idx}: 業界 '{industry_raw}' を '{industry}' に変換しました")
+
+        try:
+            values = _company_values(row, company_name, industry)
+        except (TypeError, ValueError) as e:
+            raise RowError([f"行{idx}: エラー - {str(e)}"])
+        existing_names.add(company_name)
+        return values
+
+    def discard(batch):
+        existing_names.difference_update(values['name'] for values in batch)
+
+    return _import_in_chunks(rows, prepare, _insert_companies, chunk_size, progress, discard,
+                             checkpoint, resume_from)
+
+
+def header_plan(headers, fields):
+    """
+    ファイルのヘッダーから、項目ごとに参照するヘッダーのリストを作る（ファイルごとに1回）
+
+    fields は 項目 → 対応するヘッダー（優先順）の dict。ファイルに無いヘッダーは参照しない。
+    """
+    headers = set(headers)
+    return {field: [header for header in aliases if header in headers] for field, aliases in fields.items()}
+
+
+def normalize_row(row, plan):
+    """行を 項目 → 値 の dict にする（対応するヘッダーのうち最初に値のあるもの、無ければ空文字）"""
+    normalized = {}
+    for field, headers in plan.items():
+        value = ''
+        for header in headers:
+            if row.get(header):
+                value = row[header]
+                break
+        normalized[field] = value
+    return normalized
+
+
+def _parse_appointment_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+    except ValueError:
+        return None
+
+
+def _parse_closed_at(value):
+    try:
+        if not value:
+            return None
+        if len(value) > 10:
+            return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return None
+
+
+def _insert_deals(batch, user_id):
+    """案件をまとめて INSERT し、ステージ遷移履歴・月次集計・検索インデックスも同じトランザクションで書き込む"""
+    inserted = db.session.execute(
+        _deals.insert().returning(
+            _deals.c.id, _deals.c.title, _deals.c.stage, _deals.c.status, _deals.c.stage_entered_at,
+            _deals.c.closed_at, _deals.c.company_id, _deals.c.team_id, _deals.c.assignee_id,
+            _deals.c.lead_source_id, _deals.c.amount, _deals.c.gross_profit
+        ),
+        batch
+    ).all()
+
+    connection = db.session.connection()
+    record_new_deals(connection, inserted, user_id)
+    add_new_deals(connection, inserted)
+    if fts_enabled(connection):
+        index_rows(connection, 'deals', inserted)
+    return len(inserted)
+
+
+def import_deal_rows(rows, team_id=None, user_id=None, chunk_size=IMPORT_CHUNK_ROWS, progress=None,
+                     checkpoint=None, resume_from=None):
+    """
+    案件データの行をチャンクごとに一括インポート
+
+    Args:
+        rows: 行のdict（ヘッダー → 値）の iterable（行番号は2から数える）
+        team_id: 担当者のチームが無い場合に使うチームID（インポートしたユーザーのチーム）
+        user_id: ステージ遷移履歴に記録するユーザーID
+        chunk_size: 1回の INSERT・コミットにまとめる行数
+        progress: コミットしたチャンクごとに progress(最終行番号, 成功件数, エラー件数, メッセージ) を呼ぶ
+            （そのチャンクのエラー・警告メッセージを渡し、戻り値のリストには残さない）
+        checkpoint: チャンクのコミットの直前に同じトランザクションで checkpoint(最終行番号, 成功件数, エラー件数) を呼ぶ
+        resume_from: 再開時の (最終行番号, 成功件数, エラー件数)。その行までを読み飛ばす
+
+    Returns:
+        tuple: (成功件数, エラー件数, エラーメッセージのリスト（progress 指定時は空）)
+    """
+    # 企業名 → ID（同名の企業は後から登録したもの）、担当者名 → (ID, チームID)（同名は先に登録したもの）
+    company_ids = dict(db.session.execute(db.select(Company.name, Company.id).order_by(Company.id)).all())
+    users = {
+        name: (assignee_id, assignee_team_id)
+        for name, assignee_id, assignee_team_id in db.session.execute(
+            db.select(User.name, User.id, User.team_id).order_by(User.id.desc())
+        ).all()
+    }
+    plan = None
+
+    def prepare(idx, row, messages):
+        nonlocal plan
+        if plan is None:
+            plan = header_plan(row.keys(), DEAL_IMPORT_FIELDS)
+        fields = normalize_row(row, plan)
+
+        # バリデーション
+        errors = validate_deal_row(fields, idx, company_ids)
+        if errors:
+            raise RowError(errors)
+        deal_title = fields['title'].strip()
+        company_name = fields['company_name'].strip()
+        stage = fields['stage'] or '初回接触'
+        status = fields['status'] or 'OPEN'
+        amount = float(fields['amount']) if fields['amount'] else 0
+
+        # 担当者IDを設定（担当者名から解決。担当者にチームがあればそのチーム）
+        assignee_name = fields['assignee']
+        assignee_id, assignee_team_id = users.get(assignee_name, (None, None)) if assignee_name else (None, None)
+
+        return {
+            'company_id': company_ids[company_name],
+            'title': deal_title,
+            'stage': stage,
+            'amount': amount,
+            'status': DEAL_STATUS_MAP.get(status, status),
+            'heat_score': fields['heat_score'] or 'C',
+            'assignee': assignee_name or None,
+            'assignee_id': assignee_id,
+            'appointment_date': _parse_appointment_date(fields['appointment_date']),
+            'next_action': fields['next_action'] or None,
+            'win_reason_category': fields['win_reason_category'] or None,
+            'win_reason_detail': fields['win_reason_detail'] or None,
+            'lost_reason_category': fields['lost_reason_category'] or None,
+            'lost_reason_detail': fields['lost_reason_detail'] or None,
+            'closed_at': _parse_closed_at(fields['closed_at']),
+            'note': fields['note'] or None,
+            'meeting_minutes': fields['meeting_minutes'] or None,
+            'team_id': assignee_team_id or team_id,
+        }
+
+    return _import_in_chunks(rows, prepare, lambda batch: _insert_deals(batch, user_id), chunk_size, progress,
+                             checkpoint=checkpoint, resume_from=resume_from)
@@ -0,0 +1,125 @@
+"""
+プロセス内の簡易キャッシュユーティリティ
+
+集計APIなど、短時間に同じ条件で繰り返し呼ばれる重いクエリの結果を
+TTL（有効秒数）付きで保持する。ワーカープロセスごとのキャッシュのため、
+TTLは数十秒〜数分程度の短い値で使う。
+"""
+import json
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class TTLCache:
+    """有効期限付きのスレッドセーフなキャッシュ"""
+
+    def __init__(self, ttl=30, maxsize=512):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """キャッシュ値を返す（未登録・期限切れの場合は None）"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            if len(self._data) >= self.maxsize:
+                self._evict()
+            self._data[key] = (time.monotonic() + (ttl if ttl is not None else self.ttl), value)
+
+    def get_or_set(self, key, factory, ttl=None):
+        """キャッシュ値を返す。無ければ factory() の結果を登録して返す"""
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.set(key, value, ttl)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _evict(self):
+        """期限切れを削除し、それでも満杯なら最も早く期限が切れるものから削除"""
+        now = time.monotonic()
+        for key in [k for k, (expires_at, _) in self._data.items() if expires_at < now]:
+            del self._data[key]
+        overflow = len(self._data) - self.maxsize + 1
+        if overflow > 0:
+            for key in sorted(self._data, key=lambda k: self._data[k][0])[:overflow]:
+                del self._data[key]
+
+
+def make_cache_key(*parts, **params):
+    """エンドポイント名・条件などからキャッシュキー文字列を生成（パラメータ順に依存しない）"""
+    normalized = {key: value for key, value in params.items() if value not in (None, '', [])}
+    return json.dumps([parts, normalized], ensure_ascii=False, sort_keys=True, default=str)
+
+
+class DataVersions:
+    """
+    データ種別ごとのバージョン番号（更新のたびに増える）
+
+    キャッシュキーにバージョンを含めると、更新後は新しいキーで引くため
+    古いエントリを消さなくても再計算される（古いエントリはTTL・件数上限で消える）。
+    """
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, *names):
+        with self._lock:
+            return tuple(self._versions.get(name, 0) for name in names)
+
+    def bump(self, *names):
+        with self._lock:
+            for name in names:
+                self._versions[name] = self._versions.get(name, 0) + 1
+
+
+def _call_on_commit(key, callback, models):
+    """指定モデルの追加・更新・削除を含むトランザクションのコミット時に callback を呼ぶ"""
+    def after_flush(session, flush_context):
+        changed = list(session.new) + list(session.dirty) + list(session.deleted)
+        if any(isinstance(obj, models) for obj in changed):
+            session.info.setdefault('on_commit_callbacks', {})[key] = callback
+
+    def after_commit(session):
+        for callback in session.info.pop('on_commit_callbacks', {}).values():
+            callback()
+
+    def after_rollback(session):
+        session.info.pop('on_commit_callbacks', None)
+
+    event.listen(Session, 'after_flush', after_flush)
+    event.listen(Session, 'after_commit', after_commit)
+    event.listen(Session, 'after_rollback', after_rollback)
+
+
+def clear_on_commit(cache, *models):
+    """
+    指定モデルの追加・更新・削除を含むトランザクションのコミット時にキャッシュを消去
+
+    Core の一括INSERTなどセッションを経由しない更新は検知できないため、
+    その場合は TTL の経過で反映される。
+    """
+    _call_on_commit(('clear', id(cache)), cache.clear, models)
+
+
+def bump_on_commit(versions, name, *models):
+    """指定モデルの追加・更新・削除を含むトランザクションのコミット時にバージョンを上げる"""
+    _call_on_commit(('bump', id(versions), name), lambda: versions.bump(name), models)
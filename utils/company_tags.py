@@ -0,0 +1,51 @@
+"""
+企業タグ（company_tags）ユーティリティ
+
+company_tags は companies.tags（カンマ区切りの表示用コピー）を正規化したもので、タグの絞り込みに使う。
+通常は Company.tags のバリデータ・一括インポートで同期するため、
+ここでは導入直後・移行時に companies.tags から作り直す処理だけを持つ。
+"""
+from database import db
+from models import Company, CompanyTag
+
+# 一度に INSERT する行数
+BATCH_SIZE = 1000
+
+_companies = Company.__table__
+_company_tags = CompanyTag.__table__
+
+
+def rebuild_company_tags(connection):
+    """
+    companies.tags から company_tags を作り直す
+
+    Returns:
+        tuple[int, int]: (走査した企業数, 書き込んだタグの行数)
+    """
+    connection.execute(_company_tags.delete())
+    rows = connection.execute(
+        db.select(_companies.c.id, _companies.c.tags).where(_companies.c.tags.isnot(None), _companies.c.tags != '')
+    ).all()
+    batch = []
+    inserted = 0
+    for company_id, tags in rows:
+        batch.extend({'company_id': company_id, 'tag': tag} for tag in Company.parse_tags(tags))
+        if len(batch) >= BATCH_SIZE:
+            connection.execute(_company_tags.insert(), batch)
+            inserted += len(batch)
+            batch = []
+    if batch:
+        connection.execute(_company_tags.insert(), batch)
+        inserted += len(batch)
+    return len(rows), inserted
+
+
+def ensure_company_tags():
+    """company_tags が空でタグ付きの企業がある場合（導入直後）は作り直す"""
+    with db.engine.begin() as conn:
+        has_tags = conn.execute(db.select(_company_tags.c.id).limit(1)).first()
+        has_tagged = conn.execute(
+            db.select(_companies.c.id).where(_companies.c.tags.isnot(None), _companies.c.tags != '').limit(1)
+        ).first()
+        if has_tagged and not has_tags:
+            rebuild_company_tags(conn)
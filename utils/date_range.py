@@ -0,0 +1,47 @@
+"""
+日付範囲の検索条件ユーティリティ
+
+日時カラムを db.func.date() などで加工して比較するとインデックスが使われないため、
+日付の範囲 [開始日, 終了日] を「開始日 00:00 以上、終了日翌日 00:00 未満」の
+半開区間に変換し、カラムをそのまま比較する条件を組み立てる。
+"""
+from datetime import date, datetime, time, timedelta
+
+from database import db
+
+
+def _to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+def day_start(value):
+    """日付の 00:00:00 を返す"""
+    return datetime.combine(_to_date(value), time.min)
+
+
+def date_range_condition(column, start_date=None, end_date=None):
+    """
+    日時カラムが [start_date, end_date]（両端の日を含む）に入る条件を返す
+
+    Args:
+        column: 日時カラム（インデックスを使えるよう加工せずに比較する）
+        start_date: 開始日（None の場合は下限なし）
+        end_date: 終了日（None の場合は上限なし）
+    """
+    conditions = []
+    if start_date is not None:
+        conditions.append(column >= day_start(start_date))
+    if end_date is not None:
+        conditions.append(column < day_start(_to_date(end_date) + timedelta(days=1)))
+    if not conditions:
+        return db.true()
+    return db.and_(*conditions)
+
+
+def month_range(year, month):
+    """指定月の (月初日, 月末日) を返す"""
+    start = date(year, month, 1)
+    next_month = date(year + (month == 12), month % 12 + 1, 1)
+    return start, next_month - timedelta(days=1)
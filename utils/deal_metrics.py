@@ -0,0 +1,328 @@
+"""
+案件の月次集計（deal_metrics_monthly）ユーティリティ
+
+成約日時（closed_at）のある案件を
+(成約月, チーム, 担当者, 業界, リードソース, ステータス) ごとに
+件数・金額合計・粗利合計として保持する。
+
+- Deal の追加・更新・削除と Company.industry の変更時に、差分だけを加減算して同期する
+  （Core の一括INSERTで追加した案件は add_new_deals() でまとめて加算する）
+- rebuild_deal_metrics() で案件テーブルから作り直す
+- deal_metrics() は期間のうち月単位で揃う部分を集計テーブルから、
+  月の途中から/途中までの端数部分を案件テーブルから集計して合算する
+"""
+from datetime import timedelta
+
+from sqlalchemy import event, inspect
+
+from database import db
+from models import Company, Deal, DealMetricsMonthly
+from utils.date_range import date_range_condition
+
+# 集計キー（DealMetricsMonthly のカラム）
+DIMENSIONS = ('month', 'team_id', 'assignee_id', 'industry', 'lead_source_id', 'status')
+
+# 集計キー・集計値に影響する Deal の属性
+TRACKED_DEAL_ATTRIBUTES = ('closed_at', 'status', 'team_id', 'assignee_id', 'lead_source_id',
+                           'company_id', 'amount', 'gross_profit')
+
+_deals = Deal.__table__
+_companies = Company.__table__
+_metrics = DealMetricsMonthly.__table__
+
+
+def month_expr(column, bind=None):
+    """日時カラムを 'YYYY-MM' 文字列にするSQL式（SQLite / PostgreSQL）"""
+    bind = bind if bind is not None else db.engine
+    if bind.dialect.name == 'postgresql':
+        return db.func.to_char(column, 'YYYY-MM')
+    return db.func.strftime('%Y-%m', column)
+
+
+def _metrics_source(bind=None):
+    """案件テーブルから集計キーごとの件数・金額・粗利を求めるSELECT"""
+    return db.select(
+        month_expr(_deals.c.closed_at, bind).label('month'),
+        _deals.c.team_id,
+        _deals.c.assignee_id,
+        _companies.c.industry,
+        _deals.c.lead_source_id,
+        _deals.c.status,
+        db.func.count(_deals.c.id).label('deal_count'),
+        db.func.coalesce(db.func.sum(_deals.c.amount), 0).label('amount_sum'),
+        db.func.coalesce(db.func.sum(_deals.c.gross_profit), 0).label('gross_profit_sum'),
+    ).select_from(
+        _deals.outerjoin(_companies, _companies.c.id == _deals.c.company_id)
+    ).where(
+        _deals.c.closed_at.isnot(None)
+    ).group_by(
+        month_expr(_deals.c.closed_at, bind), _deals.c.team_id, _deals.c.assignee_id,
+        _companies.c.industry, _deals.c.lead_source_id, _deals.c.status
+    )
+
+
+def rebuild_deal_metrics(connection):
+    """集計テーブルを案件テーブルから作り直す"""
+    connection.execute(_metrics.delete())
+    columns = list(DIMENSIONS) + ['deal_count', 'amount_sum', 'gross_profit_sum']
+    connection.execute(_metrics.insert().from_select(columns, _metrics_source(connection)))
+
+
+def ensure_deal_metrics():
+    """集計テーブルが空で成約済み案件がある場合（導入直後）は作り直す"""
+    with db.engine.begin() as conn:
+        has_metrics = conn.execute(db.select(_metrics.c.id).limit(1)).first()
+        has_closed = conn.execute(
+            db.select(_deals.c.id).where(_deals.c.closed_at.isnot(None)).limit(1)
+        ).first()
+        if has_closed and not has_metrics:
+            rebuild_deal_metrics(conn)
+
+
+def _apply_delta(connection, key, sign, deal_count, amount_sum, gross_profit_sum):
+    """集計キーの行に差分を加算（行が無ければ作成）"""
+    if key is None or not deal_count:
+        return
+    match = db.and_(*[
+        _metrics.c[name].is_(None) if value is None else _metrics.c[name] == value
+        for name, value in key.items()
+    ])
+    target_id = db.select(db.func.min(_metrics.c.id)).where(match).scalar_subquery()
+    result = connection.execute(_metrics.update().where(_metrics.c.id == target_id).values(
+        deal_count=_metrics.c.deal_count + sign * deal_count,
+        amount_sum=_metrics.c.amount_sum + sign * amount_sum,
+        gross_profit_sum=_metrics.c.gross_profit_sum + sign * gross_profit_sum,
+    ))
+    if result.rowcount == 0:
+        connection.execute(_metrics.insert().values(
+            deal_count=sign * deal_count,
+            amount_sum=sign * amount_sum,
+            gross_profit_sum=sign * gross_profit_sum,
+            **key
+        ))
+
+
+def _company_industry(connection, company_id):
+    if company_id is None:
+        return None
+    return connection.execute(
+        db.select(_companies.c.industry).where(_companies.c.id == company_id)
+    ).scalar()
+
+
+def _deal_row(connection, deal_id):
+    """案件の現在値（DB上の値）を返す"""
+    return connection.execute(
+        db.select(*[_deals.c[name] for name in TRACKED_DEAL_ATTRIBUTES]).where(_deals.c.id == deal_id)
+    ).mappings().first()
+
+
+def _apply_deal(connection, values, sign):
+    """案件1件分を集計テーブルに加算（sign=1）または減算（sign=-1）"""
+    if values is None or values['closed_at'] is None:
+        return
+    key = {
+        'month': values['closed_at'].strftime('%Y-%m'),
+        'team_id': values['team_id'],
+        'assignee_id': values['assignee_id'],
+        'industry': _company_industry(connection, values['company_id']),
+        'lead_source_id': values['lead_source_id'],
+        'status': values['status'],
+    }
+    _apply_delta(connection, key, sign, 1, values['amount'] or 0, values['gross_profit'] or 0)
+
+
+def add_new_deals(connection, deals):
+    """
+    Core の一括INSERTで追加した案件をまとめて集計テーブルに加算
+
+    マッパーイベントを通らない追加で使う。集計キーごとに合計してから加算するため、
+    更新は案件数ではなく集計キーの数だけになる。
+    deals は TRACKED_DEAL_ATTRIBUTES を属性に持つ行（Row）の iterable。
+    """
+    closed = [deal for deal in deals if deal.closed_at is not None]
+    if not closed:
+        return
+    industries = dict(connection.execute(
+        db.select(_companies.c.id, _companies.c.industry).where(
+            _companies.c.id.in_({deal.company_id for deal in closed})
+        )
+    ).all())
+    totals = {}
+    for deal in closed:
+        key = (deal.closed_at.strftime('%Y-%m'), deal.team_id, deal.assignee_id,
+               industries.get(deal.company_id), deal.lead_source_id, deal.status)
+        total = totals.setdefault(key, [0, 0, 0])
+        total[0] += 1
+        total[1] += deal.amount or 0
+        total[2] += deal.gross_profit or 0
+    for key, total in totals.items():
+        _apply_delta(connection, dict(zip(DIMENSIONS, key)), 1, *total)
+
+
+def move_team_metrics(connection, from_team_id, to_team_id):
+    """
+    from_team_id の集計行を to_team_id の集計行に合算して付け替える
+
+    Query.update() など、マッパーイベントを通らない案件の team_id の一括変更と同じトランザクションで呼ぶ。
+    """
+    rows = connection.execute(
+        db.select(_metrics).where(_metrics.c.team_id == from_team_id)
+    ).mappings().all()
+    connection.execute(_metrics.delete().where(_metrics.c.team_id == from_team_id))
+    for row in rows:
+        key = {name: row[name] for name in DIMENSIONS}
+        _apply_delta(connection, dict(key, team_id=to_team_id), 1,
+                     row['deal_count'], row['amount_sum'], row['gross_profit_sum'])
+
+
+def _after_deal_insert(mapper, connection, target):
+    _apply_deal(connection, _deal_row(connection, target.id), 1)
+
+
+def _after_deal_update(mapper, connection, target):
+    state = inspect(target)
+    changed = {
+        name: state.attrs[name].history.deleted[0]
+        for name in TRACKED_DEAL_ATTRIBUTES
+        if state.attrs[name].history.deleted
+    }
+    if not changed:
+        return
+    new_values = _deal_row(connection, target.id)
+    old_values = dict(new_values, **changed)
+    _apply_deal(connection, old_values, -1)
+    _apply_deal(connection, new_values, 1)
+
+
+def _before_deal_delete(mapper, connection, target):
+    # 削除後は値を読めないため、DELETEの直前に現在値を減算する
+    _apply_deal(connection, _deal_row(connection, target.id), -1)
+
+
+def _after_company_update(mapper, connection, target):
+    history = inspect(target).attrs.industry.history
+    if not history.deleted:
+        return
+    old_industry, new_industry = history.deleted[0], target.industry
+    if old_industry == new_industry:
+        return
+    rows = connection.execute(
+        _metrics_source(connection).where(_deals.c.company_id == target.id)
+    ).mappings().all()
+    for row in rows:
+        key = {name: row[name] for name in DIMENSIONS}
+        totals = (row['deal_count'], row['amount_sum'], row['gross_profit_sum'])
+        _apply_delta(connection, dict(key, industry=old_industry), -1, *totals)
+        _apply_delta(connection, dict(key, industry=new_industry), 1, *totals)
+
+
+def _load_previous_value(target, value, oldvalue, initiator):
+    return value
+
+
+def register_deal_metrics_events():
+    """Deal / Company の変更時に集計テーブルを同期するイベントを登録"""
+    # 変更前の値を差分計算に使うため、未ロードの属性も変更時に旧値を読み込む
+    for name in TRACKED_DEAL_ATTRIBUTES:
+        event.listen(getattr(Deal, name), 'set', _load_previous_value, active_history=True, retval=True)
+    event.listen(Company.industry, 'set', _load_previous_value, active_history=True, retval=True)
+
+    event.listen(Deal, 'after_insert', _after_deal_insert)
+    event.listen(Deal, 'after_update', _after_deal_update)
+    event.listen(Deal, 'before_delete', _before_deal_delete)
+    event.listen(Company, 'after_update', _after_company_update)
+
+
+def _split_period(start_date, end_date):
+    """
+    期間を (集計テーブルで読む月の範囲, 案件テーブルで読む端数の日付範囲リスト) に分割
+    """
+    first_month = start_date if start_date.day == 1 else \
+        (start_date.replace(day=28) + timedelta(days=4)).replace(day=1)
+    last_month_end = end_date if (end_date + timedelta(days=1)).day == 1 else \
+        end_date.replace(day=1) - timedelta(days=1)
+    if first_month > last_month_end:
+        return None, [(start_date, end_date)]
+    edges = []
+    if start_date < first_month:
+        edges.append((start_date, first_month - timedelta(days=1)))
+    if last_month_end < end_date:
+        edges.append((last_month_end + timedelta(days=1), end_date))
+    months = (first_month.strftime('%Y-%m'), last_month_end.strftime('%Y-%m'))
+    return months, edges
+
+
+def filter_condition(column, value):
+    """filters の値（単一値 / リスト・タプル / None）から条件を作る"""
+    if isinstance(value, (list, tuple, set)):
+        return column.in_(list(value))
+    if value is None:
+        return column.is_(None)
+    return column == value
+
+
+def deal_metrics(start_date, end_date, group_by=(), filters=None):
+    """
+    成約日時が [start_date, end_date] の案件を集計キーごとに集計
+
+    Args:
+        start_date, end_date: 期間（両端の日を含む）
+        group_by: 集計キー（DIMENSIONS のサブセット）
+        filters: 集計キー → 値（リスト・タプルは IN、None は未設定）の絞り込み
+
+    Returns:
+        list[dict]: 集計キーと deal_count / amount_sum / gross_profit_sum
+    """
+    group_by = tuple(group_by)
+    filters = filters or {}
+    months, edges = _split_period(start_date, end_date)
+    totals = {}
+
+    def add_rows(rows):
+        for row in rows:
+            key = tuple(row[:len(group_by)])
+            counts = totals.setdefault(key, [0, 0.0, 0.0])
+            counts[0] += row[-3] or 0
+            counts[1] += row[-2] or 0
+            counts[2] += row[-1] or 0
+
+    if months:
+        columns = [getattr(DealMetricsMonthly, name) for name in group_by]
+        query = db.session.query(
+            *columns,
+            db.func.sum(DealMetricsMonthly.deal_count),
+            db.func.sum(DealMetricsMonthly.amount_sum),
+            db.func.sum(DealMetricsMonthly.gross_profit_sum),
+        ).filter(DealMetricsMonthly.month.between(*months), *[
+            filter_condition(getattr(DealMetricsMonthly, name), value) for name, value in filters.items()
+        ])
+        add_rows(query.group_by(*columns).all() if columns else query.all())
+
+    deal_columns = {
+        'month': month_expr(Deal.closed_at),
+        'team_id': Deal.team_id,
+        'assignee_id': Deal.assignee_id,
+        'industry': Company.industry,
+        'lead_source_id': Deal.lead_source_id,
+        'status': Deal.status,
+    }
+    for edge_start, edge_end in edges:
+        columns = [deal_columns[name] for name in group_by]
+        query = db.session.query(
+            *columns,
+            db.func.count(Deal.id),
+            db.func.sum(Deal.amount),
+            db.func.sum(Deal.gross_profit),
+        ).select_from(Deal).outerjoin(Company, Company.id == Deal.company_id).filter(
+            date_range_condition(Deal.closed_at, edge_start, edge_end), *[
+                filter_condition(deal_columns[name], value) for name, value in filters.items()
+            ]
+        )
+        add_rows(query.group_by(*columns).all() if columns else query.all())
+
+    return [
+        dict(zip(group_by, key), deal_count=counts[0], amount_sum=counts[1], gross_profit_sum=counts[2])
+        for key, counts in totals.items()
+        if counts[0]
+    ]
@@ -1,12 +1,24 @@
 """
 CSV/Excel インポートユーティリティ
 """
+import codecs
 import csv
 import io
-from datetime import datetime
+from datetime import date, datetime
+from itertools import chain
+from zipfile import BadZipFile
 from openpyxl import load_workbook
+from openpyxl.utils.exceptions import InvalidFileException
 from werkzeug.utils import secure_filename
 
+# CSVの文字コード判定に使うバイト数と、判定する文字コード（順に試す）
+# （BOM付き/なしのUTF-8、Excel が日本語環境で保存する Shift_JIS（Windows拡張の cp932））
+CSV_SNIFF_BYTES = 64 * 1024
+CSV_ENCODINGS = ('utf-8-sig', 'cp932')
+
+# 壊れた・形式の異なるファイルを読んだときの例外（入力エラーとして扱う）
+IMPORT_PARSE_ERRORS = (BadZipFile, InvalidFileException, csv.Error, UnicodeError, KeyError)
+
 # 業界名のマッピング（一般的な別名に対応）
 INDUSTRY_NAME_MAPPING = {
     # マーケティング・広告関連
@@ -109,60 +121,146 @@ def normalize_industry_name(industry_name):
     return industry_name
 
 
-def parse_csv_file(file):
-    """CSVファイルをパースしてデータ行のリストを返す"""
-    file_content = file.read()
-    
-    # UTF-8でデコードを試行
-    try:
-        content_str = file_content.decode('utf-8-sig')  # BOMを除去
-    except UnicodeDecodeError:
-        # Shift-JISでデコードを試行
+def _encoding_sample(stream):
+    """
+    文字コードの判定に使うバイト列（最初の非ASCIIバイトから CSV_SNIFF_BYTES バイト程度）
+
+    先頭がASCIIだけの部分は判定の手がかりにならないため読み飛ばす（保持はしない）。
+    ASCIIの直後の非ASCIIバイトは UTF-8 / Shift_JIS のどちらでも文字の先頭になる。
+    """
+    while True:
+        chunk = stream.read(CSV_SNIFF_BYTES)
+        if not chunk:
+            return b''
+        if not chunk.isascii():
+            start = next(index for index, byte in enumerate(chunk) if byte >= 0x80)
+            return chunk[start:] + stream.read(start)
+
+
+def detect_csv_encoding(sample):
+    """
+    バイト列から文字コードを判定
+
+    CSV_ENCODINGS を順に試し、デコードできた文字コードを返す
+    （末尾で切れた多バイト文字はエラーにしない）。どれにも当てはまらない場合は None。
+    """
+    for encoding in CSV_ENCODINGS:
         try:
-            content_str = file_content.decode('shift_jis')
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
         except UnicodeDecodeError:
-            content_str = file_content.decode('utf-8', errors='ignore')
-    
-    file.stream.seek(0)
-    
-    reader = csv.DictReader(io.StringIO(content_str))
-    rows = []
-    for row in reader:
-        # 空の行をスキップ
-        if any(row.values()):
-            rows.append(row)
-    return rows
+            continue
+    return None
+
+
+def parse_csv_file(file):
+    """
+    CSVファイルをパースしてデータ行のdictを順に返すジェネレータ
+
+    文字コードは最初の非ASCII部分の CSV_SNIFF_BYTES バイト程度で判定し、アップロードのストリームを
+    TextIOWrapper で少しずつデコードしながら読む（ファイル全体をメモリに載せない）。
+    判定できない場合は UTF-8 として読む。判定後の部分にデコードできないバイトがあっても
+    インポートを途中で止めないよう、そのバイトは置換文字（U+FFFD）にする。
+    """
+    stream = getattr(file, 'stream', file)
+    encoding = detect_csv_encoding(_encoding_sample(stream))
+    stream.seek(0)
+
+    text = io.TextIOWrapper(stream, encoding=encoding or 'utf-8', errors='replace', newline='')
+    try:
+        for row in csv.DictReader(text):
+            # 空の行をスキップ
+            if any(row.values()):
+                yield row
+    finally:
+        # アップロードのストリームは閉じずに切り離す
+        # （途中で止まったジェネレータが、呼び出し側でファイルを閉じた後に破棄される場合は何もしない）
+        if not stream.closed:
+            text.detach()
+
+
+def peek_rows(rows):
+    """
+    行のイテレータにデータがあるかを先頭の1行だけ読んで確認
+
+    Returns:
+        iterator | None: データが無ければ None、あれば先頭の行を戻したイテレータ
+    """
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return None
+    return chain([first], rows)
+
+
+def _format_datetime(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _format_date(value):
+    return value.strftime('%Y-%m-%d')
+
+
+# Excelのセルの値の型 → 文字列への変換（それ以外の型は str()）
+EXCEL_VALUE_FORMATTERS = {
+    datetime: _format_datetime,
+    date: _format_date,
+    str: str,
+}
 
 
 def parse_excel_file(file):
-    """Excelファイルをパースしてデータ行のリストを返す"""
-    wb = load_workbook(file, data_only=True)
-    ws = wb.active
-    
-    # ヘッダー行を取得
-    headers = []
-    for cell in ws[1]:
-        headers.append(str(cell.value) if cell.value else '')
-    
-    # データ行を取得
-    rows = []
-    for row in ws.iter_rows(min_row=2, values_only=False):
-        row_dict = {}
-        for idx, cell in enumerate(row):
-            if idx < len(headers):
-                value = cell.value
-                # 日付型の場合は文字列に変換
-                if isinstance(value, datetime):
-                    value = value.strftime('%Y-%m-%d %H:%M:%S')
-                elif hasattr(value, 'date'):  # date型の場合
-                    value = value.strftime('%Y-%m-%d')
-                row_dict[headers[idx]] = str(value) if value is not None else ''
-        
-        # 空の行をスキップ
-        if any(row_dict.values()):
-            rows.append(row_dict)
-    
-    return rows
+    """
+    Excelファイルをパースしてデータ行のdictを順に返すジェネレータ
+
+    ブックは読み取り専用モード（read_only）で開き、セルのオブジェクトを作らずに
+    行の値（values_only）を順に読む（シート全体をメモリに載せない）。
+    値は列ごとに直前の値の型の変換を覚えておき、型が変わった場合だけ変換を選び直す。
+    """
+    wb = load_workbook(getattr(file, 'stream', file), read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+
+        # ヘッダー行を取得
+        headers = [str(value) if value else '' for value in next(rows, ())]
+        # 列ごとの (値の型, 変換)
+        plan = [(str, str)] * len(headers)
+
+        # データ行を取得
+        for values in rows:
+            row_dict = {}
+            for idx, header in enumerate(headers):
+                value = values[idx] if idx < len(values) else None
+                if value is None:
+                    row_dict[header] = ''
+                    continue
+                value_type, formatter = plan[idx]
+                if type(value) is not value_type:
+                    value_type = type(value)
+                    formatter = EXCEL_VALUE_FORMATTERS.get(value_type, str)
+                    plan[idx] = (value_type, formatter)
+                row_dict[header] = formatter(value)
+
+            # 空の行をスキップ
+            if any(row_dict.values()):
+                yield row_dict
+    finally:
+        # 読み取り専用モードではファイルを開いたままにするため、読み終えたら閉じる
+        wb.close()
+
+
+def read_import_rows(file, file_ext):
+    """
+    アップロードの拡張子に応じてパースしたデータ行のdictを順に返すジェネレータ
+
+    ファイルが壊れている・形式が違うなどで読めない場合は、読み込みの途中でも ValueError を送出する
+    （タイムアウトなど再試行で解決するエラーと区別するため）。
+    """
+    rows = parse_csv_file(file) if file_ext == 'csv' else parse_excel_file(file)
+    try:
+        yield from rows
+    except IMPORT_PARSE_ERRORS as e:
+        raise ValueError(f'ファイルを読み込めません（{type(e).__name__}: {e}）') from e
 
 
 def validate_company_row(row, row_num, industry_categories=None):
@@ -209,44 +307,43 @@ def validate_company_row(row, row_num, industry_categories=None):
     return errors
 
 
-def validate_deal_row(row, row_num, companies_dict):
-    """案件データの行をバリデーション"""
+# 案件インポートで指定できるステージ・ステータスと、ステータスの変換（日本語 → 英語）
+DEAL_IMPORT_STAGES = ['初回接触', '提案', '見積', '交渉', '成約']
+DEAL_IMPORT_STATUSES = ['OPEN', 'WON', 'LOST', '進行中', '受注', '失注', '成約']
+DEAL_STATUS_MAP = {'進行中': 'OPEN', '受注': 'WON', '失注': 'LOST', '成約': 'WON'}
+
+
+def validate_deal_row(fields, row_num, companies_dict):
+    """
+    案件データの行をバリデーション
+
+    fields は normalize_row() で列名を揃えた行（title / company_name / stage / status / amount など）。
+    ステージ・ステータスが空の場合は既定値（初回接触 / OPEN）として扱う。
+    """
     errors = []
     
     # 必須フィールド
-    if not row.get('案件名') and not row.get('title'):
+    if not fields['title'].strip():
         errors.append(f"行{row_num}: 案件名は必須です")
     
-    company_name = row.get('企業名') or row.get('company_name', '')
+    company_name = fields['company_name'].strip()
     if not company_name:
         errors.append(f"行{row_num}: 企業名は必須です")
     elif company_name not in companies_dict:
         errors.append(f"行{row_num}: 企業 '{company_name}' が見つかりません（先に企業を登録してください）")
     
-    # ステージのバリデーション（オプション）
-    stage = row.get('ステージ') or row.get('stage', '')
-    if stage:
-        valid_stages = ['初回接触', '提案', '見積', '交渉', '成約']
-        if stage not in valid_stages:
-            errors.append(f"行{row_num}: 無効なステージ '{stage}' です")
-    
-    # ステータスのバリデーション（オプション）
-    status = row.get('ステータス') or row.get('status', '')
-    if status:
-        valid_statuses = ['OPEN', 'WON', 'LOST', '進行中', '受注', '失注', '成約']
-        if status not in valid_statuses:
-            # ステータス名を英語に変換
-            status_map = {'進行中': 'OPEN', '受注': 'WON', '失注': 'LOST', '成約': 'WON'}
-            if status in status_map:
-                row['status'] = status_map[status]
-            else:
-                errors.append(f"行{row_num}: 無効なステータス '{status}' です")
+    # ステージ・ステータスのバリデーション（ステータスは日本語も可。登録時に DEAL_STATUS_MAP で変換）
+    stage = fields['stage'] or '初回接触'
+    if stage not in DEAL_IMPORT_STAGES:
+        errors.append(f"行{row_num}: 無効なステージ '{stage}' です")
+    status = fields['status'] or 'OPEN'
+    if status not in DEAL_IMPORT_STATUSES:
+        errors.append(f"行{row_num}: 無効なステータス '{status}' です")
     
     # 金額のバリデーション（オプション）
-    amount = row.get('金額') or row.get('amount', '')
-    if amount:
+    if fields['amount']:
         try:
-            float(amount)
+            float(fields['amount'])
         except ValueError:
             errors.append(f"行{row_num}: 金額は数値で指定してください")
     
@@ -0,0 +1,387 @@
+"""
+バックグラウンドジョブ（background_jobs）ユーティリティ
+
+エクスポートなど時間のかかる処理をリクエストの外で実行する。
+
+- create_job() でジョブを登録し、submit_job() でプロセス内のワーカープール（スレッド）に渡す
+- ジョブの処理は register_job_handler() で種類（kind）ごとに登録する
+  （handler(job, progress) → ジョブに保存する値のdict）
+- 進捗は JobProgress が JOB_PROGRESS_ROWS 件ごとに別トランザクションで書き込むため、
+  処理中でも /api/jobs/<id> から参照できる
+- 成果物のファイルは JobProgress.set_artifact() で書き出す前にパスを記録し、完了・失敗から
+  JOB_ARTIFACT_TTL 経過後に cleanup_expired_jobs() で削除する
+- ジョブは実行権（claimed_by のトークン）を条件付き更新で取得したワーカーだけが実行する
+- 再開可能なジョブ（インポート）はチャンクのコミットと同じトランザクションで
+  JobProgress.checkpoint() によりチェックポイントを記録する。プロセスの停止などで
+  JOB_STALE_AFTER の間ハートビートが途絶えたジョブは resume_stalled_jobs() で再開する
+  （再開できないジョブ（エクスポート）は fail_stalled_jobs() で失敗にする）
+- 再開可能なジョブが入力エラー（ValueError）以外の例外で止まった場合は失敗にせず
+  再試行待ち（retrying）にし、JOB_RETRY_AFTER 後に JOB_MAX_ATTEMPTS 回まで再開の対象にする
+"""
+import json
+import os
+import tempfile
+import threading
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from database import db
+from models import BackgroundJob
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+JOB_ARTIFACT_DIR = os.environ.get('JOB_ARTIFACT_DIR') or os.path.join(tempfile.gettempdir(), 'connectplus_jobs')
+JOB_ARTIFACT_TTL = timedelta(hours=int(os.environ.get('JOB_ARTIFACT_TTL_HOURS', '24')))
+JOB_PROGRESS_ROWS = 1000
+JOB_STALE_AFTER = timedelta(seconds=int(os.environ.get('JOB_STALE_SECONDS', '300')))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_RETRY_AFTER = timedelta(seconds=int(os.environ.get('JOB_RETRY_SECONDS', '30')))
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+_handlers = {}
+_cleanups = {}
+_resumable_kinds = set()
+_jobs = BackgroundJob.__table__
+
+# このプロセスのワーカープールに渡した（待機中・実行中の）ジョブ
+_local_jobs = Counter()
+_local_lock = threading.Lock()
+
+
+class JobClaimLost(Exception):
+    """ジョブの実行権が別のワーカーに移った（停止したとみなされて再開された）"""
+
+
+def register_job_handler(kind, handler, resumable=False, cleanup=None):
+    """
+    ジョブの種類ごとの処理を登録
+
+    resumable=True の処理は、再開時に job.checkpoint_row 以降から処理を続けられること。
+    cleanup(job) はジョブが終了した（完了・再開しない失敗）ときに呼ぶ（再開用の入力ファイルの削除など）。
+    """
+    _handlers[kind] = handler
+    if cleanup:
+        _cleanups[kind] = cleanup
+    if resumable:
+        _resumable_kinds.add(kind)
+
+
+def artifact_path(job_id, extension):
+    """ジョブの成果物ファイルのパス（ディレクトリが無ければ作成）"""
+    os.makedirs(JOB_ARTIFACT_DIR, exist_ok=True)
+    return os.path.join(JOB_ARTIFACT_DIR, f'{job_id}.{extension}')
+
+
+def create_job(kind, user_id, params=None, total=None):
+    """ジョブを登録（コミットまで行う）"""
+    job = BackgroundJob(
+        id=uuid.uuid4().hex,
+        kind=kind,
+        status='queued',
+        user_id=user_id,
+        params=json.dumps(params or {}, ensure_ascii=False),
+        total=total,
+        processed=0
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def submit_job(app, job_id, claim=None):
+    """
+    ジョブをワーカープールで実行する（期限切れの成果物の削除もここで行う）
+
+    claim には resume_stalled_jobs() で取得した実行権のトークンを渡す（省略時は待機中のジョブとして開始する）。
+    """
+    cleanup_expired_jobs()
+    with _local_lock:
+        _local_jobs[job_id] += 1
+    return _executor.submit(_run_job, app, job_id, claim)
+
+
+def _update_job(job_id, claim=None, **values):
+    """
+    ジョブの行を別トランザクションで更新（処理中のセッションとは独立してすぐに反映する）
+
+    claim を指定した場合は実行権を持つ間だけ更新し、更新できたかを返す。
+    """
+    condition = _jobs.c.id == job_id
+    if claim is not None:
+        condition = db.and_(condition, _jobs.c.claimed_by == claim)
+    with db.engine.begin() as conn:
+        return conn.execute(_jobs.update().where(condition).values(**values)).rowcount > 0
+
+
+class JobProgress:
+    """ジョブの進捗（処理件数）とチェックポイントの記録"""
+
+    def __init__(self, job_id, claim=None):
+        self.job_id = job_id
+        self.claim = claim
+        self.processed = 0
+
+    def set_total(self, total):
+        _update_job(self.job_id, self.claim, total=total, heartbeat_at=datetime.utcnow())
+
+    def set_artifact(self, path):
+        """成果物のパスを書き出す前に記録（失敗・中断した場合も期限切れの削除の対象にする）"""
+        _update_job(self.job_id, self.claim, file_path=path, heartbeat_at=datetime.utcnow())
+
+    def advance(self, count=1):
+        before = self.processed
+        self.processed += count
+        if before // JOB_PROGRESS_ROWS != self.processed // JOB_PROGRESS_ROWS:
+            if not _update_job(self.job_id, self.claim, processed=self.processed, heartbeat_at=datetime.utcnow()):
+                raise JobClaimLost(self.job_id)
+
+    def checkpoint(self, checkpoint_row, processed, succeeded, failed):
+        """
+        再開用のチェックポイントを記録（コミットは呼び出し側で行う）
+
+        処理中のセッションのトランザクションで書き込むため、チャンクのデータと同時にコミットされる。
+        実行権が別のワーカーに移っていた場合は JobClaimLost を送出する（呼び出し側でチャンクをロールバックする）。
+        """
+        result = db.session.execute(_jobs.update().where(
+            _jobs.c.id == self.job_id, _jobs.c.claimed_by == self.claim
+        ).values(
+            checkpoint_row=checkpoint_row, processed=processed, succeeded=succeeded, failed=failed,
+            heartbeat_at=datetime.utcnow()
+        ))
+        if not result.rowcount:
+            raise JobClaimLost(self.job_id)
+        self.processed = processed
+
+    def iterate(self, records):
+        """records を順に返しながら処理件数を数える"""
+        for record in records:
+            yield record
+            self.advance()
+
+
+def _claim_job(job_id, condition, claim):
+    """condition を満たすジョブの実行権を claim のトークンで取得（取得できたかを返す）"""
+    now = datetime.utcnow()
+    with db.engine.begin() as conn:
+        return conn.execute(_jobs.update().where(_jobs.c.id == job_id, condition).values(
+            claimed_by=claim, heartbeat_at=now
+        )).rowcount > 0
+
+
+def _run_job(app, job_id, claim=None):
+    """
+    ジョブを実行する
+
+    claim を省略した場合は待機中で誰も実行権を持たないジョブだけを、指定した場合はその実行権を
+    持つジョブだけを開始する。開始は status・claimed_by の条件付き更新で行うため、
+    同じジョブを2つのワーカーが同時に実行することはない。
+
+    再開可能なジョブが ValueError（入力エラー）以外の例外で止まった場合は、実行権を手放して
+    retrying にする（JOB_RETRY_AFTER 後に resume_stalled_jobs() がチェックポイントから再開する）。
+    """
+    job = None
+    with app.app_context():
+        try:
+            if claim is None:
+                claim = uuid.uuid4().hex
+                startable = db.and_(_jobs.c.status == 'queued', _jobs.c.claimed_by.is_(None))
+            else:
+                startable = db.and_(_jobs.c.status.in_(('queued', 'running', 'retrying')), _jobs.c.claimed_by == claim)
+            now = datetime.utcnow()
+            with db.engine.begin() as conn:
+                started = conn.execute(_jobs.update().where(_jobs.c.id == job_id, startable).values(
+                    status='running', claimed_by=claim, heartbeat_at=now, attempts=_jobs.c.attempts + 1,
+                    started_at=db.func.coalesce(_jobs.c.started_at, now)
+                )).rowcount
+            if not started:
+                return
+            job = db.session.get(BackgroundJob, job_id)
+            progress = JobProgress(job_id, claim)
+            progress.processed = job.processed or 0
+            values = _handlers[job.kind](job, progress) or {}
+            db.session.rollback()
+            now = datetime.utcnow()
+            if _update_job(job_id, claim, status='done', processed=progress.processed, error=None, finished_at=now,
+                           expires_at=now + JOB_ARTIFACT_TTL, **values):
+                _cleanup_job(job)
+        except JobClaimLost:
+            # 停止したとみなされて別のワーカーが再開したため、このワーカーは手を引く
+            db.session.rollback()
+        except Exception as e:
+            db.session.rollback()
+            if (job is not None and job.kind in _resumable_kinds and not isinstance(e, ValueError)
+                    and job.attempts < JOB_MAX_ATTEMPTS):
+                # タイムアウト・接続断など: コミット済みのチャンクはそのままに、チェックポイントから再開させる
+                _update_job(job_id, claim, status='retrying', claimed_by=None, error=str(e),
+                            heartbeat_at=datetime.utcnow())
+            elif _update_job(job_id, claim, status='failed', error=str(e), finished_at=datetime.utcnow(),
+                             expires_at=datetime.utcnow() + JOB_ARTIFACT_TTL):
+                if job is not None:
+                    _cleanup_job(job)
+        finally:
+            db.session.remove()
+            with _local_lock:
+                _local_jobs[job_id] -= 1
+                if _local_jobs[job_id] <= 0:
+                    del _local_jobs[job_id]
+
+
+def _cleanup_job(job):
+    """終了したジョブの cleanup(job) を呼ぶ（失敗してもジョブの結果は変えない）"""
+    cleanup = _cleanups.get(job.kind)
+    if cleanup:
+        try:
+            cleanup(job)
+        except Exception as e:
+            print(f"⚠️ ジョブ {job.id} の後片付けに失敗しました: {e}")
+
+
+def _stale_condition(now):
+    """待機中・実行中で JOB_STALE_AFTER の間ハートビートが途絶えた（または開始されないまま時間が経った）ジョブの条件"""
+    stale_before = now - JOB_STALE_AFTER
+    return db.and_(
+        _jobs.c.status.in_(('queued', 'running')),
+        db.or_(
+            _jobs.c.heartbeat_at < stale_before,
+            db.and_(_jobs.c.heartbeat_at.is_(None), _jobs.c.created_at < stale_before),
+        ),
+    )
+
+
+def _stalled_condition(now):
+    """
+    再開する再開可能なジョブの条件
+
+    - 待機中・実行中で JOB_STALE_AFTER の間ハートビートが途絶えた（または開始されないまま時間が経った）
+    - 再試行待ち（retrying）になってから JOB_RETRY_AFTER が経った
+    """
+    return db.and_(
+        _jobs.c.kind.in_(_resumable_kinds),
+        db.or_(
+            _stale_condition(now),
+            db.and_(_jobs.c.status == 'retrying', _jobs.c.heartbeat_at < now - JOB_RETRY_AFTER),
+        ),
+    )
+
+
+def fail_stalled_jobs(job_id=None):
+    """
+    ハートビートが途絶えた再開できないジョブ（エクスポートなど）を失敗にする
+
+    ワーカーのプロセスが再起動・タイムアウトで止まったジョブが running のまま残らないようにする。
+    成果物（書きかけのファイル）は失敗から JOB_ARTIFACT_TTL 経過後に cleanup_expired_jobs() で削除する。
+    このプロセスのワーカープールで待機中・実行中のジョブは対象にしない。
+
+    Args:
+        job_id: 指定した場合はそのジョブだけを対象にする
+
+    Returns:
+        list[str]: 失敗にしたジョブのID
+    """
+    now = datetime.utcnow()
+    condition = db.and_(_jobs.c.kind.notin_(_resumable_kinds), _stale_condition(now))
+    if job_id is not None:
+        condition = db.and_(condition, _jobs.c.id == job_id)
+    failed = []
+    for (stalled_id,) in db.session.execute(db.select(_jobs.c.id).where(condition)).all():
+        with _local_lock:
+            if stalled_id in _local_jobs:
+                continue
+        with db.engine.begin() as conn:
+            updated = conn.execute(_jobs.update().where(_jobs.c.id == stalled_id, condition).values(
+                status='failed', claimed_by=None, error='ワーカーが停止したため中断しました。もう一度実行してください。',
+                finished_at=now, expires_at=now + JOB_ARTIFACT_TTL
+            )).rowcount
+        if updated:
+            failed.append(stalled_id)
+    return failed
+
+
+def resume_stalled_jobs(app, job_id=None):
+    """
+    中断した再開可能なジョブをチェックポイントから再開する（再開できないジョブは fail_stalled_jobs() で失敗にする）
+
+    複数のプロセスから同時に呼ばれても1つのワーカーだけが再開するよう、実行権（claimed_by）を
+    条件付きで更新して取得できた場合だけワーカープールに渡す。実行権を失った元のワーカーは
+    次のチェックポイントで JobClaimLost となり、そのチャンクはコミットされない。
+    このプロセスのワーカープールで待機中・実行中のジョブは対象にしない。
+
+    Args:
+        job_id: 指定した場合はそのジョブだけを対象にする
+
+    Returns:
+        list[str]: 再開したジョブのID
+    """
+    fail_stalled_jobs(job_id)
+    if not _resumable_kinds:
+        return []
+    now = datetime.utcnow()
+    condition = _stalled_condition(now)
+    if job_id is not None:
+        condition = db.and_(condition, _jobs.c.id == job_id)
+    resumed = []
+    for (stalled_id,) in db.session.execute(db.select(_jobs.c.id).where(condition)).all():
+        with _local_lock:
+            if stalled_id in _local_jobs:
+                continue
+        claim = uuid.uuid4().hex
+        if _claim_job(stalled_id, _stalled_condition(now), claim):
+            submit_job(app, stalled_id, claim)
+            resumed.append(stalled_id)
+    return resumed
+
+
+def cleanup_expired_jobs():
+    """
+    期限切れのジョブの成果物を削除する
+
+    完了したジョブはステータスを expired にする。失敗したジョブは成果物（書きかけのファイル）だけを削除する。
+    """
+    expired = db.session.query(BackgroundJob).filter(
+        db.or_(
+            BackgroundJob.status == 'done',
+            db.and_(BackgroundJob.status == 'failed', BackgroundJob.file_path.isnot(None)),
+        ),
+        BackgroundJob.expires_at < datetime.utcnow()
+    ).all()
+    for job in expired:
+        if job.file_path and os.path.exists(job.file_path):
+            try:
+                os.remove(job.file_path)
+            except OSError:
+                continue
+        if job.status == 'done':
+            job.status = 'expired'
+        job.file_path = None
+    if expired:
+        db.session.commit()
+
+
+def job_to_dict(job):
+    """ジョブの状態（/api/jobs/<id> のレスポンス）"""
+    progress = None
+    if job.total:
+        progress = round(min(job.processed / job.total, 1) * 100, 1)
+    elif job.status == 'done':
+        progress = 100
+    rows_per_sec = None
+    if job.started_at and job.processed:
+        elapsed = ((job.finished_at or datetime.utcnow()) - job.started_at).total_seconds()
+        rows_per_sec = round(job.processed / elapsed, 1) if elapsed > 0 else None
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'total': job.total,
+        'processed': job.processed,
+        'succeeded': job.succeeded,
+        'failed': job.failed,
+        'rows_per_sec': rows_per_sec,
+        'progress': progress,
+        'filename': job.filename,
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'expires_at': job.expires_at.isoformat() if job.expires_at else None,
+    }
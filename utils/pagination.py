@@ -0,0 +1,111 @@
+"""
+キーセット（カーソル）ページネーションユーティリティ
+"""
+import base64
+import json
+from datetime import datetime, date
+
+from database import db
+
+DEFAULT_PER_PAGE = 50
+MAX_PER_PAGE = 200
+
+
+def parse_per_page(value, default=DEFAULT_PER_PAGE):
+    """1ページあたりの件数をパース（1〜MAX_PER_PAGEに丸める）"""
+    try:
+        per_page = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(per_page, MAX_PER_PAGE))
+
+
+def encode_cursor(sort_key, value, row_id):
+    """ソートキー・最終行の値・IDからカーソル文字列を生成"""
+    value_type = None
+    if isinstance(value, datetime):
+        value, value_type = value.isoformat(), 'datetime'
+    elif isinstance(value, date):
+        value, value_type = value.isoformat(), 'date'
+    payload = json.dumps({'k': sort_key, 'v': value, 't': value_type, 'id': row_id},
+                         ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort_key):
+    """
+    カーソル文字列をデコードして (値, ID) を返す
+
+    不正なカーソルや、別のソートキーで発行されたカーソルの場合は None を返す
+    （先頭ページから表示し直す）
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        if payload.get('k') != sort_key:
+            return None
+        value = payload.get('v')
+        if value is not None and payload.get('t') == 'datetime':
+            value = datetime.fromisoformat(value)
+        elif value is not None and payload.get('t') == 'date':
+            value = date.fromisoformat(value)
+        return value, int(payload['id'])
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+
+def keyset_paginate(query, sort_expr, id_column, sort_key, cursor=None,
+                    per_page=DEFAULT_PER_PAGE, descending=False, nullable=False):
+    """
+    キーセット方式でクエリを1ページ分だけ取得
+
+    OFFSETを使わず「前ページ最終行の (ソート値, ID) より後ろ」をWHERE条件で指定するため、
+    ページ位置に関わらずインデックスを使って一定コストで取得できる。
+    NULLを含む列（nullable=True）はNULLを常に末尾に並べる。
+
+    Args:
+        query: ベースクエリ（フィルタ適用済み、ORDER BY未指定）
+        sort_expr: ソート対象の列またはSQL式
+        id_column: タイブレーク用の一意な列（主キー）
+        sort_key: カーソルに埋め込むソート識別子（ソート変更時に古いカーソルを無効化）
+        cursor: 前ページの next_cursor
+        per_page: 1ページあたりの件数
+        descending: 降順の場合True
+        nullable: sort_exprがNULLを取り得る場合True
+
+    Returns:
+        tuple: (items, next_cursor) - 次ページがない場合 next_cursor は None
+    """
+    query = query.add_columns(sort_expr.label('_sort_value'))
+
+    position = decode_cursor(cursor, sort_key)
+    if position is not None:
+        last_value, last_id = position
+        id_after = id_column < last_id if descending else id_column > last_id
+        if last_value is None:
+            # NULLグループの途中：残りのNULL行のみ
+            query = query.filter(sort_expr.is_(None), id_after)
+        else:
+            value_after = sort_expr < last_value if descending else sort_expr > last_value
+            condition = db.or_(value_after, db.and_(sort_expr == last_value, id_after))
+            if nullable:
+                condition = db.or_(condition, sort_expr.is_(None))
+            query = query.filter(condition)
+
+    ordered_sort = sort_expr.desc() if descending else sort_expr.asc()
+    if nullable:
+        ordered_sort = ordered_sort.nulls_last()
+    ordered_id = id_column.desc() if descending else id_column.asc()
+
+    rows = query.order_by(ordered_sort, ordered_id).limit(per_page + 1).all()
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+
+    items = [row[0] for row in rows]
+    next_cursor = None
+    if has_next and rows:
+        last_row = rows[-1]
+        next_cursor = encode_cursor(sort_key, last_row[-1], getattr(last_row[0], id_column.key))
+    return items, next_cursor
@@ -0,0 +1,132 @@
+"""
+パイプラインの日次スナップショット（pipeline_snapshots）ユーティリティ
+
+進行中案件を (スナップショット日, ステージ, チーム, 担当者) ごとに件数・金額合計として記録する。
+
+- take_pipeline_snapshot() は今日の行を作り直す（同じ日に何度実行しても結果は同じ）
+  案件の現在の状態しか読めないため、過去の日付のスナップショットは作れない
+- 毎日 SNAPSHOT_HOUR:SNAPSHOT_MINUTE に APScheduler のジョブで記録し、
+  ワーカーの起動時にその日のスナップショットが無ければ ensure_pipeline_snapshot() で記録する
+- 前期比較・パイプライン推移は案件テーブルを集計し直さず、スナップショットを日付で読む
+"""
+from datetime import date
+
+from database import db
+from models import Deal, PipelineSnapshot
+
+# スナップショットの集計キー（PipelineSnapshot のカラム）
+DIMENSIONS = ('stage', 'team_id', 'assignee_id')
+
+# 日次ジョブの実行時刻（その日の終わりの状態を記録する）
+SNAPSHOT_HOUR = 23
+SNAPSHOT_MINUTE = 50
+
+_deals = Deal.__table__
+_snapshots = PipelineSnapshot.__table__
+
+
+def take_pipeline_snapshot(connection):
+    """
+    進行中案件の現在の状態を今日のスナップショットとして記録
+
+    Returns:
+        date: 記録したスナップショット日
+    """
+    snapshot_date = date.today()
+    if connection.dialect.name == 'postgresql':
+        # 複数プロセスのジョブが同時に実行しても行が重複しないように直列化する
+        connection.execute(db.text("SELECT pg_advisory_xact_lock(hashtext('pipeline_snapshots'))"))
+    connection.execute(_snapshots.delete().where(_snapshots.c.snapshot_date == snapshot_date))
+    connection.execute(_snapshots.insert().from_select(
+        ['snapshot_date', 'stage', 'team_id', 'assignee_id', 'deal_count', 'amount_sum'],
+        db.select(
+            db.literal(snapshot_date, db.Date),
+            _deals.c.stage,
+            _deals.c.team_id,
+            _deals.c.assignee_id,
+            db.func.count(_deals.c.id),
+            db.func.coalesce(db.func.sum(_deals.c.amount), 0),
+        ).where(
+            _deals.c.status.in_(Deal.OPEN_STATUSES)
+        ).group_by(_deals.c.stage, _deals.c.team_id, _deals.c.assignee_id)
+    ))
+    return snapshot_date
+
+
+def ensure_pipeline_snapshot():
+    """今日のスナップショットが無い場合（初回起動・ジョブ未実行）は記録する"""
+    with db.engine.begin() as conn:
+        exists = conn.execute(
+            db.select(_snapshots.c.id).where(_snapshots.c.snapshot_date == date.today()).limit(1)
+        ).first()
+        if not exists:
+            take_pipeline_snapshot(conn)
+
+
+def start_pipeline_snapshot_scheduler(app):
+    """スナップショットを毎日記録する APScheduler のジョブを開始"""
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from apscheduler.triggers.cron import CronTrigger
+
+    def run_snapshot():
+        with app.app_context():
+            with db.engine.begin() as conn:
+                take_pipeline_snapshot(conn)
+
+    scheduler = BackgroundScheduler(daemon=True)
+    scheduler.add_job(
+        run_snapshot,
+        trigger=CronTrigger(hour=SNAPSHOT_HOUR, minute=SNAPSHOT_MINUTE),
+        id='daily_pipeline_snapshot',
+        name='Daily pipeline snapshot',
+        replace_existing=True
+    )
+    scheduler.start()
+    return scheduler
+
+
+def pipeline_snapshot_total(on_or_before, conditions=()):
+    """
+    on_or_before 以前で最新のスナップショットの合計
+
+    Args:
+        on_or_before: 基準日（この日以前で最も新しいスナップショットを使う）
+        conditions: PipelineSnapshot に対する絞り込み条件（表示範囲など）
+
+    Returns:
+        dict | None: snapshot_date / deal_count / amount_sum（スナップショットが無ければ None）
+    """
+    snapshot_date = db.session.query(db.func.max(PipelineSnapshot.snapshot_date)).filter(
+        PipelineSnapshot.snapshot_date <= on_or_before
+    ).scalar()
+    if snapshot_date is None:
+        return None
+    deal_count, amount_sum = db.session.query(
+        db.func.coalesce(db.func.sum(PipelineSnapshot.deal_count), 0),
+        db.func.coalesce(db.func.sum(PipelineSnapshot.amount_sum), 0),
+    ).filter(PipelineSnapshot.snapshot_date == snapshot_date, *conditions).one()
+    return {'snapshot_date': snapshot_date, 'deal_count': deal_count, 'amount_sum': amount_sum}
+
+
+def pipeline_trend(start_date, end_date, group_by=None, conditions=()):
+    """
+    期間内のスナップショット日ごとのパイプライン（件数・金額合計）
+
+    Args:
+        start_date, end_date: スナップショット日の範囲（両端の日を含む）
+        group_by: 内訳の集計キー（DIMENSIONS のいずれか、None は合計のみ）
+        conditions: PipelineSnapshot に対する絞り込み条件（表示範囲など）
+
+    Returns:
+        list[tuple]: (snapshot_date, [内訳の値,] deal_count, amount_sum) をスナップショット日順に
+    """
+    columns = [PipelineSnapshot.snapshot_date]
+    if group_by:
+        columns.append(getattr(PipelineSnapshot, group_by))
+    return db.session.query(
+        *columns,
+        db.func.sum(PipelineSnapshot.deal_count),
+        db.func.sum(PipelineSnapshot.amount_sum),
+    ).filter(
+        PipelineSnapshot.snapshot_date.between(start_date, end_date), *conditions
+    ).group_by(*columns).order_by(*columns).all()
@@ -0,0 +1,306 @@
+"""
+検索インデックスユーティリティ
+
+- PostgreSQL: pg_trgm の GIN インデックスを作成し、ILIKE '%語%' をインデックス検索にする
+- SQLite: エンティティごとに FTS5 のシャドウテーブルを作成し、文字バイグラムで索引化する
+  （空白で区切られない日本語の企業名でも部分一致できるようにする）
+
+SQLite のシャドウテーブルは Company / Deal / Contact / Task の
+after_insert / after_update / after_delete イベントで同期する。
+イベントを通らない Core の一括INSERT（インポート）で追加した行は index_rows() で索引化する。
+
+選択フォームの候補検索（前方一致）は、PostgreSQL では同じ trigram インデックス、
+SQLite では NOCASE 照合のインデックスに対する範囲検索で行う。
+"""
+import re
+import unicodedata
+
+from sqlalchemy import event
+
+from database import db
+from models import Company, Deal, Contact, Task, User
+
+# テーブル名 → (モデル, 索引化するカラム)
+SEARCH_FIELDS = {
+    'companies': (Company, ('name', 'industry', 'location')),
+    'deals': (Deal, ('title',)),
+    'contacts': (Contact, ('name', 'email')),
+    'tasks': (Task, ('title', 'deal_name')),
+}
+
+# 前方一致検索の対象（テーブル名 → (モデル, カラム)）
+PREFIX_FIELDS = {
+    'companies': (Company, 'name'),
+    'users': (User, 'name'),
+}
+
+# 前方一致の範囲検索の上限に使う文字（UTF-8で最大のコードポイント）
+_PREFIX_UPPER_BOUND = '\U0010ffff'
+
+_WORD_RUN = re.compile(r'[^\W_]+')
+
+# 接続先ごとのFTS5シャドウテーブル利用可否のキャッシュ
+_fts_ready = {}
+
+
+def fts_table_name(table_name):
+    """シャドウテーブル名を返す"""
+    return f'{table_name}_fts'
+
+
+def _normalize(text):
+    """全角/半角・大文字/小文字の揺れを吸収"""
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def _run_bigrams(run):
+    """連続した文字列をバイグラムに分割（末尾の1文字も単独トークンとして残す）"""
+    if len(run) == 1:
+        return [run]
+    return [run[i:i + 2] for i in range(len(run) - 1)] + [run[-1]]
+
+
+def to_bigram_tokens(text):
+    """索引用にテキストを空白区切りのバイグラム列へ変換"""
+    tokens = []
+    for run in _WORD_RUN.findall(_normalize(text)):
+        tokens.extend(_run_bigrams(run))
+    return ' '.join(tokens)
+
+
+def to_match_query(term):
+    """
+    検索語をFTS5のMATCH式へ変換
+
+    各語をバイグラムのフレーズ検索にすることで部分一致と同等の結果になる。
+    1文字の語はバイグラムの前方一致で検索する。
+    """
+    phrases = []
+    for run in _WORD_RUN.findall(_normalize(term)):
+        if len(run) == 1:
+            phrases.append(f'"{run}"*')
+        else:
+            bigrams = [run[i:i + 2] for i in range(len(run) - 1)]
+            phrases.append('"' + ' '.join(bigrams) + '"')
+    return ' AND '.join(phrases)
+
+
+def _is_postgres(bind):
+    return bind.dialect.name == 'postgresql'
+
+
+def fts_enabled(bind=None):
+    """SQLiteのFTS5シャドウテーブルが利用可能か"""
+    bind = bind if bind is not None else db.engine
+    if bind.dialect.name != 'sqlite':
+        return False
+    key = str(bind.engine.url)
+    if key not in _fts_ready:
+        with bind.engine.connect() as conn:
+            found = conn.execute(
+                db.text("SELECT name FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {'name': fts_table_name('companies')}
+            ).first()
+        _fts_ready[key] = found is not None
+    return _fts_ready[key]
+
+
+def _index_row(connection, table_name, target):
+    """1件分のシャドウテーブル行を置き換え"""
+    _, columns = SEARCH_FIELDS[table_name]
+    fts = fts_table_name(table_name)
+    connection.execute(db.text(f'DELETE FROM {fts} WHERE rowid = :id'), {'id': target.id})
+    params = {'id': target.id}
+    params.update({col: to_bigram_tokens(getattr(target, col)) for col in columns})
+    connection.execute(
+        db.text(f"INSERT INTO {fts} (rowid, {', '.join(columns)}) "
+                f"VALUES (:id, {', '.join(':' + c for c in columns)})"),
+        params
+    )
+
+
+def _remove_row(connection, table_name, target):
+    connection.execute(db.text(f'DELETE FROM {fts_table_name(table_name)} WHERE rowid = :id'),
+                       {'id': target.id})
+
+
+def _make_listeners(table_name):
+    def after_save(mapper, connection, target):
+        if fts_enabled(connection):
+            _index_row(connection, table_name, target)
+
+    def after_delete(mapper, connection, target):
+        if fts_enabled(connection):
+            _remove_row(connection, table_name, target)
+
+    return after_save, after_delete
+
+
+def register_search_index_events():
+    """モデルの変更時にFTS5シャドウテーブルを同期するイベントを登録"""
+    for table_name, (model, _) in SEARCH_FIELDS.items():
+        after_save, after_delete = _make_listeners(table_name)
+        event.listen(model, 'after_insert', after_save)
+        event.listen(model, 'after_update', after_save)
+        event.listen(model, 'after_delete', after_delete)
+
+
+def index_rows(connection, table_name, rows):
+    """
+    新しく追加した行をシャドウテーブルへまとめて索引化（SQLiteのみ）
+
+    Core の一括INSERTなどマッパーイベントを通らない追加で使う。
+    rows は id と索引化するカラムを属性に持つ行（Row）の iterable。
+    """
+    _, columns = SEARCH_FIELDS[table_name]
+    fts = fts_table_name(table_name)
+    batch = []
+    for row in rows:
+        params = {'id': row.id}
+        params.update({col: to_bigram_tokens(getattr(row, col)) for col in columns})
+        batch.append(params)
+    if batch:
+        connection.execute(
+            db.text(f"INSERT INTO {fts} (rowid, {', '.join(columns)}) "
+                    f"VALUES (:id, {', '.join(':' + c for c in columns)})"),
+            batch
+        )
+
+
+def rebuild_search_index(connection):
+    """FTS5シャドウテーブルを元テーブルから作り直す（SQLiteのみ）"""
+    for table_name, (model, columns) in SEARCH_FIELDS.items():
+        fts = fts_table_name(table_name)
+        connection.execute(db.text(f'DELETE FROM {fts}'))
+        rows = connection.execute(
+            db.select(model.__table__.c.id, *[model.__table__.c[col] for col in columns])
+        )
+        index_rows(connection, table_name, rows)
+
+
+def ensure_search_index(rebuild=False):
+    """
+    検索インデックスを作成（存在しない場合のみ）
+
+    PostgreSQL では pg_trgm 拡張と GIN インデックス、
+    SQLite では FTS5 シャドウテーブルを作成し、新規作成時は既存データから索引を構築する。
+    """
+    engine = db.engine
+    if _is_postgres(engine):
+        with engine.begin() as conn:
+            conn.execute(db.text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+            for table_name, (_, columns) in SEARCH_FIELDS.items():
+                for col in columns:
+                    conn.execute(db.text(
+                        f'CREATE INDEX IF NOT EXISTS ix_{table_name}_{col}_trgm '
+                        f'ON {table_name} USING gin ({col} gin_trgm_ops)'
+                    ))
+            for table_name, (_, col) in PREFIX_FIELDS.items():
+                conn.execute(db.text(
+                    f'CREATE INDEX IF NOT EXISTS ix_{table_name}_{col}_trgm '
+                    f'ON {table_name} USING gin ({col} gin_trgm_ops)'
+                ))
+        return
+
+    if engine.dialect.name != 'sqlite':
+        return
+
+    with engine.begin() as conn:
+        for table_name, (_, col) in PREFIX_FIELDS.items():
+            conn.execute(db.text(
+                f'CREATE INDEX IF NOT EXISTS ix_{table_name}_{col}_nocase '
+                f'ON {table_name} ({col} COLLATE NOCASE)'
+            ))
+        created = False
+        for table_name, (_, columns) in SEARCH_FIELDS.items():
+            fts = fts_table_name(table_name)
+            exists = conn.execute(
+                db.text("SELECT name FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {'name': fts}
+            ).first()
+            if not exists:
+                conn.execute(db.text(
+                    f"CREATE VIRTUAL TABLE {fts} USING fts5("
+                    f"{', '.join(columns)}, tokenize = 'unicode61 remove_diacritics 0')"
+                ))
+                created = True
+        if created or rebuild:
+            rebuild_search_index(conn)
+    _fts_ready[str(engine.url)] = True
+
+
+def _ilike_condition(model, columns, term):
+    return db.or_(*[getattr(model, col).ilike(f'%{term}%') for col in columns])
+
+
+def search_condition(table_name, term):
+    """
+    検索語に一致する行を絞り込むWHERE条件を返す
+
+    SQLiteでFTS5が使える場合はシャドウテーブルへのMATCH、
+    それ以外（PostgreSQLのtrigramインデックスを含む）はILIKEの部分一致になる。
+    """
+    model, columns = SEARCH_FIELDS[table_name]
+    match_query = to_match_query(term)
+    if match_query and fts_enabled():
+        fts = fts_table_name(table_name)
+        matched_ids = db.select(db.literal_column('rowid')).select_from(db.table(fts)).where(
+            db.literal_column(fts).op('MATCH')(match_query)
+        )
+        return model.id.in_(matched_ids)
+    return _ilike_condition(model, columns, term)
+
+
+def ranked_search(query, table_name, term):
+    """
+    検索語に一致する行を関連度順に並べたクエリを返す（関連度は最後のカラムとして追加）
+
+    SQLite(FTS5)は bm25、PostgreSQL は pg_trgm の similarity を関連度として使う。
+    """
+    model, columns = SEARCH_FIELDS[table_name]
+    match_query = to_match_query(term)
+    if match_query and fts_enabled():
+        fts = fts_table_name(table_name)
+        ranked = db.select(
+            db.literal_column('rowid').label('id'),
+            (-db.func.bm25(db.literal_column(fts))).label('score')
+        ).select_from(db.table(fts)).where(
+            db.literal_column(fts).op('MATCH')(match_query)
+        ).subquery()
+        return query.join(ranked, ranked.c.id == model.id).add_columns(ranked.c.score) \
+            .order_by(ranked.c.score.desc())
+    if _is_postgres(db.engine):
+        score = db.func.greatest(*[
+            db.func.similarity(db.func.coalesce(getattr(model, col), ''), term) for col in columns
+        ]) if len(columns) > 1 else db.func.similarity(db.func.coalesce(getattr(model, columns[0]), ''), term)
+        return query.filter(_ilike_condition(model, columns, term)) \
+            .add_columns(score.label('score')).order_by(score.desc())
+    return query.filter(_ilike_condition(model, columns, term)).add_columns(db.literal(0.0).label('score'))
+
+
+def _escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def prefix_sort_column(table_name):
+    """前方一致検索の結果を並べる列（SQLiteでは前方一致と同じNOCASEインデックス順）"""
+    model, col = PREFIX_FIELDS[table_name]
+    column = getattr(model, col)
+    if db.engine.dialect.name == 'sqlite':
+        return column.collate('NOCASE')
+    return column
+
+
+def prefix_condition(table_name, term):
+    """
+    名前の前方一致（大文字/小文字を区別しない）のWHERE条件を返す
+
+    SQLite は NOCASE インデックスに対する範囲検索、
+    PostgreSQL は trigram インデックスを使う ILIKE '語%' になる。
+    """
+    model, col = PREFIX_FIELDS[table_name]
+    column = getattr(model, col)
+    if db.engine.dialect.name == 'sqlite':
+        nocase = prefix_sort_column(table_name)
+        return db.and_(nocase >= term, nocase < term + _PREFIX_UPPER_BOUND)
+    return column.ilike(_escape_like(term) + '%', escape='\\')
@@ -0,0 +1,190 @@
+"""
+案件のステージ遷移履歴（deal_stage_transitions）ユーティリティ
+
+ステージに入るたびに1行記録する。受注・失注は '受注' / '失注' ステージへの遷移として記録し、
+直前のステージの滞留が終わった時点を残す。
+ステージファネルは遷移履歴をウィンドウ関数で前後に並べ、
+各ステージの滞留日数（平均・中央値）と次ステージ以降への転換率を1クエリで求める。
+"""
+from datetime import datetime
+
+from database import db
+from models import Deal, DealStageTransition
+from utils.date_range import date_range_condition
+
+# クローズ時に記録するステージ名（ステータス → ステージ）
+CLOSED_STAGES = {'WON': '受注', '受注': '受注', 'LOST': '失注', '失注': '失注'}
+
+_transitions = DealStageTransition.__table__
+_deals = Deal.__table__
+
+
+def record_stage_transition(deal, stage, from_stage=None, entered_at=None, user_id=None):
+    """案件がステージに入ったことを記録（コミットは呼び出し側で行う）"""
+    transition = DealStageTransition(
+        deal=deal,
+        from_stage=from_stage,
+        stage=stage,
+        entered_at=entered_at or datetime.utcnow(),
+        user_id=user_id
+    )
+    db.session.add(transition)
+    return transition
+
+
+def record_deal_changes(deal, old_stage, old_status, user_id=None, at=None):
+    """
+    編集前後のステージ・ステータスを比較して遷移を記録
+
+    - クローズ（WON/LOST）した場合は '受注' / '失注' への遷移
+    - クローズ済みから進行中に戻した場合は現在のステージへの遷移
+    - それ以外でステージが変わった場合はそのステージへの遷移
+    """
+    at = at or datetime.utcnow()
+    old_closed = CLOSED_STAGES.get(old_status)
+    new_closed = CLOSED_STAGES.get(deal.status)
+    if new_closed and new_closed != old_closed:
+        record_stage_transition(deal, new_closed, old_closed or old_stage, at, user_id)
+    elif not new_closed and (old_closed or deal.stage != old_stage):
+        record_stage_transition(deal, deal.stage, old_closed or old_stage, at, user_id)
+
+
+def _initial_transitions(stage, status, entered_at, closed_at):
+    """新規案件の初期の遷移 (from_stage, stage, entered_at) のリスト"""
+    transitions = [(None, stage, entered_at)]
+    closed_stage = CLOSED_STAGES.get(status)
+    if closed_stage:
+        transitions.append((stage, closed_stage, max(closed_at or entered_at, entered_at)))
+    return transitions
+
+
+def record_new_deal(deal, user_id=None):
+    """新規作成・インポートした案件の初期ステージ（とクローズ）を記録"""
+    entered_at = deal.stage_entered_at or datetime.utcnow()
+    for from_stage, stage, at in _initial_transitions(deal.stage, deal.status, entered_at, deal.closed_at):
+        record_stage_transition(deal, stage, from_stage, at, user_id)
+
+
+def record_new_deals(connection, deals, user_id=None):
+    """
+    Core の一括INSERTで追加した案件の初期ステージ（とクローズ）をまとめて記録
+
+    deals は id / stage / status / stage_entered_at / closed_at を属性に持つ行（Row）の iterable。
+    """
+    rows = [
+        {'deal_id': deal.id, 'from_stage': from_stage, 'stage': stage, 'entered_at': at, 'user_id': user_id}
+        for deal in deals
+        for from_stage, stage, at in _initial_transitions(
+            deal.stage, deal.status, deal.stage_entered_at or datetime.utcnow(), deal.closed_at
+        )
+    ]
+    if rows:
+        connection.execute(_transitions.insert(), rows)
+
+
+def ensure_stage_transitions():
+    """遷移履歴が空の場合（導入直後）は案件の現在の状態から初期履歴を作成"""
+    with db.engine.begin() as conn:
+        if conn.execute(db.select(_transitions.c.id).limit(1)).first():
+            return
+        entered_at = db.func.coalesce(_deals.c.stage_entered_at, _deals.c.created_at, db.func.current_timestamp())
+        conn.execute(_transitions.insert().from_select(
+            ['deal_id', 'from_stage', 'stage', 'entered_at'],
+            db.select(_deals.c.id, db.null(), _deals.c.stage, entered_at)
+        ))
+        closed_stage = db.case(
+            *[(_deals.c.status == status, stage) for status, stage in CLOSED_STAGES.items()]
+        )
+        conn.execute(_transitions.insert().from_select(
+            ['deal_id', 'from_stage', 'stage', 'entered_at'],
+            db.select(_deals.c.id, _deals.c.stage, closed_stage, _deals.c.closed_at).where(
+                _deals.c.status.in_(list(CLOSED_STAGES)),
+                _deals.c.closed_at.isnot(None),
+            )
+        ))
+
+
+def _days_between(start, end):
+    """2つの日時の差（日数, 小数）を求めるSQL式"""
+    if db.engine.dialect.name == 'postgresql':
+        return db.func.extract('epoch', end - start) / 86400.0
+    return db.func.julianday(end) - db.func.julianday(start)
+
+
+def stage_funnel(stage_order, start_date=None, end_date=None):
+    """
+    期間内にステージに入った案件のファネル集計
+
+    Args:
+        stage_order: ステージの並び（後ろほど先のステージ。'失注' は前進として扱わない）
+        start_date, end_date: ステージに入った日の範囲
+
+    Returns:
+        dict: ステージ名 → {count, amount, converted, avg_days, median_days}
+            count: ステージに入った案件数 / converted: その後より先のステージに進んだ案件数
+            avg_days / median_days: 次のステージに移るまでの滞留日数（移っていない滞留は除く）
+    """
+    t = _transitions.c
+    rank = db.case(
+        *[(t.stage == stage, index) for index, stage in enumerate(stage_order, start=1) if stage != '失注'],
+        else_=0
+    )
+    order = (t.entered_at, t.id)
+
+    # 案件ごとに遷移を時系列に並べ、次の遷移日時と以降に到達した最も先のステージを求める
+    history = db.select(
+        t.deal_id,
+        t.stage,
+        t.entered_at,
+        rank.label('stage_rank'),
+        db.func.lead(t.entered_at).over(partition_by=t.deal_id, order_by=order).label('exited_at'),
+        db.func.max(rank).over(partition_by=t.deal_id, order_by=order, rows=(1, None)).label('later_rank'),
+    ).subquery()
+
+    dwell = db.case((history.c.exited_at.isnot(None),
+                     _days_between(history.c.entered_at, history.c.exited_at)))
+    stays = db.select(
+        history.c.stage,
+        history.c.deal_id,
+        db.func.row_number().over(
+            partition_by=(history.c.stage, history.c.deal_id), order_by=history.c.entered_at
+        ).label('visit'),
+        (history.c.later_rank > history.c.stage_rank).label('converted'),
+        dwell.label('dwell'),
+        db.func.row_number().over(
+            partition_by=(history.c.stage, history.c.exited_at.is_(None)), order_by=dwell
+        ).label('dwell_pos'),
+        db.func.count(dwell).over(partition_by=history.c.stage).label('dwell_count'),
+    ).where(
+        history.c.stage.in_(stage_order),
+        date_range_condition(history.c.entered_at, start_date, end_date)
+    ).subquery()
+
+    first_visit = stays.c.visit == 1
+    is_median = db.and_(
+        stays.c.dwell.isnot(None),
+        stays.c.dwell_pos.in_(((stays.c.dwell_count + 1) // 2, (stays.c.dwell_count + 2) // 2))
+    )
+    rows = db.session.execute(
+        db.select(
+            stays.c.stage,
+            db.func.count(db.distinct(stays.c.deal_id)).label('count'),
+            db.func.sum(db.case((first_visit, _deals.c.amount), else_=0)).label('amount'),
+            db.func.count(db.distinct(db.case((stays.c.converted, stays.c.deal_id)))).label('converted'),
+            db.func.avg(stays.c.dwell).label('avg_days'),
+            db.func.avg(db.case((is_median, stays.c.dwell))).label('median_days'),
+        ).select_from(
+            stays.join(_deals, _deals.c.id == stays.c.deal_id)
+        ).group_by(stays.c.stage)
+    ).all()
+
+    return {
+        row.stage: {
+            'count': row.count or 0,
+            'amount': row.amount or 0,
+            'converted': row.converted or 0,
+            'avg_days': round(float(row.avg_days), 1) if row.avg_days is not None else None,
+            'median_days': round(float(row.median_days), 1) if row.median_days is not None else None,
+        }
+        for row in rows
+    }